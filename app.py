@@ -1,89 +1,313 @@
-import streamlit as st
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import Dict, List, Tuple
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from src import metrics
+from src.image_context import ImageContext
 from src.image_processing import process_image, plot_results
-from src.tesseract import process_image_tesseract, parse_ocr_tesseract, parse_image_tesseract
-from src.utils import draw_rectangles_yandex, elapsed_time, draw_rectangles_tesseract, encode_file_to_base64, \
-    get_color_zones
-from src.yandex import send_ocr_request_yandex, process_ocr_yandex, process_dict_yandex
+from src.pipeline import combine_confidence, in_band, warm_up
+from src.scheduler import DeadlineExceeded, Overloaded, Scheduler
+from src.utils import draw_rectangles_yandex, elapsed_time, draw_rectangles_tesseract, color_zone_edges, \
+    color_zone_regions, filter_color_zones, draw_color_zones
+from src.yandex import process_ocr_yandex, process_dict_yandex
 
 
 block_percentile = 0.18  # зона в которую должен входить блок, чтобы считать его за переписку
+CACHE_ENTRIES = 32  # сколько последних загрузок хранить в кэше результатов по каждому движку
+# движки, прогреваемые при старте (через запятую, пустая строка - без прогрева)
+WARM_UP_ENGINES = os.environ.get("WARM_UP_ENGINES", "no_ocr,tesseract")
+APP_WORKERS = int(os.environ.get("APP_WORKERS", os.cpu_count() or 1))  # потоков обработки загрузок
+# срок обработки изображения движками с OCR в секундах (по умолчанию без срока): после него вместо OCR
+# принимается решение без OCR
+APP_DEADLINE = float(os.environ.get("APP_DEADLINE", 0)) or None
+APP_MAX_QUEUE = int(os.environ.get("APP_MAX_QUEUE", APP_WORKERS * 4))  # принятых изображений, остальные отклоняются
 
 
-def on_upload_yandex(file, temp, folder_id, api_key):
-    """ Вызывает обработку загруженного изображения и отображает результат """
-    with st.spinner("Detecting image..."):
-        try:
-            start_time = time.time()  # засекаем время
-            image = encode_file_to_base64(file.getvalue())
-            ocr_response = send_ocr_request_yandex(api_key, image, folder_id)
-            elapsed1 = elapsed_time(start_time, time.time())
-            print(f"send_ocr_request_yandex обработан за {elapsed1}")
-            # parse OCR result
-            if 'error' in ocr_response:
-                raise Exception(ocr_response['error'])
-            full_text, result_dict = process_ocr_yandex(ocr_response, block_percentile)
-            print(f"process_ocr_yandex обработан за {elapsed_time(start_time, time.time())}")
-            start2 = time.time()
-            image_with_zones_found, bounding_boxes = get_color_zones(file, ocr_response, block_percentile)
-            elapsed2 = elapsed_time(start2, time.time())
-            print(f"get_color_zones обработан за {elapsed_time(start_time, time.time())}")
-            confidence = process_dict_yandex(result_dict, bounding_boxes)
-            decision = "Переписка" if confidence >= temp else "Не переписка"
-            decision += (f". Уверенность: {confidence} при уровне {temp}. "
-                         f"Время выполнения: {elapsed_time(start_time, time.time())}\n"
-                         f"send_ocr_request_yandex обработан за {elapsed1}\n"
-                         f"get_color_zones обработан за {elapsed2}")
-        except Exception as e:
-            st.error(f"Error: {e}")
-            st.stop()
+def format_timings(timings) -> str:
+    """ Форматирует время этапов запроса построчно """
+    return "\n".join(f"{stage} обработан за {elapsed_time(0, value)}"
+                     for stage, value in timings.items() if stage != "total")
+
+
+def discard_late(deadline_at) -> None:
+    """
+    Результат OCR, готовый после срока (time.time()), отбрасывается: исключение не попадает в кэш st.cache_data,
+    иначе повторный запуск скрипта показал бы вместо уже показанного решения без OCR (degraded) решение OCR.
+    """
+    if deadline_at is not None and time.time() >= deadline_at:
+        raise DeadlineExceeded("результат OCR получен после срока")
+
+
+@st.cache_resource(show_spinner=False)
+def warm_up_workers() -> None:
+    """
+    Прогрев один раз на процесс, а не при каждом перезапуске скрипта: импорты и модели Tesseract.
+    Клиенты YandexOCR с пулом соединений и так общие для процесса (get_yandex_client).
+    """
+    warm_up(tuple(engine for engine in WARM_UP_ENGINES.split(",") if engine))
+
+
+# Результаты обработки кэшируются по содержимому загрузки и параметрам движка: порог в них не входит,
+# поэтому изменение ползунка или галочки "Настроить порог" только заново принимает решение.
+# Визуализации в кэш не входят: overlay - данные для их построения, рисуются они только при показе (render_*).
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def analyze_yandex(data: bytes, folder_id, api_key, _deadline_at=None) -> Dict:
+    """
+    Уверенность, время этапов и данные визуализации для YandexOCR (без решения по порогу).
+    _deadline_at не входит в ключ кэша: после него результат отбрасывается (discard_late).
+    """
+    from src.yandex_client import get_yandex_client
+    with metrics.trace("yandex") as current:
+        context = ImageContext(data)
+        # пока выполняется запрос к OCR, ищем края изображения
+        request = get_yandex_client(folder_id, api_key).submit(context)
+        edges = color_zone_edges(context)
+        ocr_response = request.result()
+        # parse OCR result
+        if 'error' in ocr_response:
+            raise Exception(ocr_response['error'])
+        full_text, result_dict = process_ocr_yandex(ocr_response, block_percentile)
+        fill_im, regions = color_zone_regions(edges, ocr_response)
+        bounding_boxes = filter_color_zones(regions, edges.shape[1], block_percentile)
+        confidence = process_dict_yandex(result_dict, bounding_boxes)
+    discard_late(_deadline_at)
+    overlay = (ocr_response['result']['textAnnotation']['blocks'], result_dict['sentences'], fill_im, bounding_boxes)
+    return {"confidence": confidence, "timings": current.timings, "overlay": overlay}
+
+
+def render_yandex(data: bytes, overlay) -> List[Tuple]:
+    blocks, sentences, fill_im, bounding_boxes = overlay
+    return [(draw_rectangles_yandex(ImageContext(data), blocks, sentences, encode=False), "Обработанное изображение"),
+            (draw_color_zones(fill_im, bounding_boxes), "Найденные зоны")]
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def analyze_tesseract(data: bytes, _deadline_at=None) -> Dict:
+    """ Уверенность, время этапов и данные визуализации для Tesseract (без решения по порогу), как analyze_yandex """
+    # как в src.pipeline: pytesseract и tesserocr загружаются только для Tesseract
+    from src.tesseract import process_image_tesseract, confidence_tesseract, parse_image_tesseract
+    with metrics.trace("tesseract") as current:
+        context = ImageContext(data)
+        # get OCR result
+        ocr_result, image_width, image_height = parse_image_tesseract(context)
+        processed_result = process_image_tesseract(ocr_result, image_width, image_height, block_percentile)
+        confidence = confidence_tesseract(processed_result)
+    discard_late(_deadline_at)
+    return {"confidence": confidence, "timings": current.timings,
+            "overlay": (ocr_result, processed_result['text_blocks'])}
+
+
+def render_tesseract(data: bytes, overlay) -> List[Tuple]:
+    ocr_result, text_blocks = overlay
+    return [(draw_rectangles_tesseract(ImageContext(data), ocr_result, text_blocks, encode=False),
+             "Обработанное изображение")]
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def analyze_without_ocr(data: bytes) -> Dict:
+    """ Уверенность, время этапов и данные визуализации без OCR (без решения по порогу) """
+    with metrics.trace("no_ocr") as current:
+        confidence, bounding_boxes, fill_im = process_image(ImageContext(data), block_percentile)
+    return {"confidence": confidence, "timings": current.timings, "overlay": (fill_im, bounding_boxes)}
+
+
+def render_without_ocr(data: bytes, overlay) -> List[Tuple]:
+    fill_im, bounding_boxes = overlay
+    if fill_im is None:
+        return []
+    return [(plot_results(fill_im, bounding_boxes, encode=False), "Обработанное изображение")]
+
+
+def analyze_hybrid(data: bytes, ocr_engine, *args, _deadline_at=None) -> Dict:
+    """
+    Решение без OCR, а OCR (ocr_engine) - только если уверенность попала в полосу неуверенности
+    (как движок hybrid в src.pipeline); обе обработки берутся из кэша, если уже выполнялись.
+    """
+    pixel = analyze_without_ocr(data)
+    if not in_band(pixel["confidence"]):
+        return dict(pixel, overlay=("no_ocr", pixel["overlay"]))
+    analyze, _ = ENGINES[ocr_engine]
+    ocr = analyze(data, *args, _deadline_at=_deadline_at)
+    timings = {f"{stage} (без OCR)": value for stage, value in pixel["timings"].items() if stage != "total"}
+    timings.update(ocr["timings"])
+    timings["total"] = pixel["timings"]["total"] + ocr["timings"]["total"]
+    return {"confidence": combine_confidence(pixel["confidence"], ocr["confidence"]), "timings": timings,
+            "overlay": (ocr_engine, ocr["overlay"])}
+
+
+def render_hybrid(data: bytes, overlay) -> List[Tuple]:
+    engine, engine_overlay = overlay
+    return ENGINES[engine][1](data, engine_overlay)
+
+
+# движок -> (обработка с кэшем, построение визуализаций по ее результату)
+ENGINES = {
+    "yandex": (analyze_yandex, render_yandex),
+    "tesseract": (analyze_tesseract, render_tesseract),
+    "no_ocr": (analyze_without_ocr, render_without_ocr),
+    "hybrid": (analyze_hybrid, render_hybrid),
+}
+
+
+@st.cache_resource(show_spinner=False)
+def get_worker_pool() -> ThreadPoolExecutor:
+    """
+    Общий для всех сессий пул обработки загрузок из нескольких файлов. Потоки, а не процессы: результаты
+    попадают в общий кэш st.cache_data, а тяжелые этапы (OpenCV, Tesseract, запросы к OCR) отпускают GIL.
+    """
+    return ThreadPoolExecutor(max_workers=APP_WORKERS, thread_name_prefix="app_worker")
+
 
+@st.cache_resource(show_spinner=False)
+def get_scheduler() -> Scheduler:
+    """ Сроки и ограниченная очередь над пулом обработки, общие для всех сессий """
+    return Scheduler(get_worker_pool(), APP_MAX_QUEUE)
+
+
+@st.cache_resource(show_spinner=False)
+def get_request_pool() -> ThreadPoolExecutor:
+    """
+    Потоки, ожидающие результатов изображений из нескольких файлов (сами изображения обрабатываются в
+    get_worker_pool): файлы сверх очереди ждут места в ней здесь, а их срок отсчитывается с приема.
+    """
+    return ThreadPoolExecutor(max_workers=APP_MAX_QUEUE, thread_name_prefix="app_request")
+
+
+def analyze_in_context(ctx, analyze, *args, **kwargs) -> Dict:
+    """ Вызов analyze в потоке пула от имени сессии ctx (нужен st.cache_data и предупреждениям streamlit) """
+    add_script_run_ctx(threading.current_thread(), ctx)
+    return analyze(*args, **kwargs)
+
+
+def analyze_with_deadline(ctx, engine, data: bytes, block: bool, *args) -> Dict:
+    """
+    Обработка изображения в пуле со сроком APP_DEADLINE: если OCR не успел или упал, результат без OCR
+    (degraded), а опоздавший результат OCR отбрасывается. no_ocr выполняется без срока.
+    Без места в очереди - Overloaded (block=True - ждать места не дольше срока).
+    """
+    analyze, _ = ENGINES[engine]
+    if engine == "no_ocr":
+        return get_scheduler().run(partial(analyze_in_context, ctx, analyze, data), None, None, engine, block)
+    scheduler = get_scheduler()
+    wait = scheduler.primary_wait(APP_DEADLINE)
+    deadline_at = time.time() + wait if wait is not None else None
+    call = partial(analyze_in_context, ctx, analyze, data, *args, _deadline_at=deadline_at)
+    fallback = partial(analyze_in_context, ctx, analyze_without_ocr, data)
+    return scheduler.run(call, APP_DEADLINE, fallback, engine, block)
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def overlay_images(engine, data: bytes, *args) -> List[Tuple]:
+    """ Визуализации (массив RGB, подпись) результата движка; строятся при первом показе изображения """
+    analyze, render = ENGINES[engine]
+    return render(data, analyze(data, *args)["overlay"])
+
+
+def decision_text(confidence, temp: float) -> str:
+    return "Переписка" if confidence >= temp else "Не переписка"
+
+
+def result_images(engine, data: bytes, result: Dict, *args) -> List[Tuple]:
+    """ Визуализации движка, давшего результат (для degraded - без OCR) """
+    if result["degraded"]:
+        return overlay_images("no_ocr", data)
+    return overlay_images(engine, data, *args)
+
+
+def show_result(data: bytes, result: Dict, temp: float, images: List[Tuple]) -> None:
+    """ Принимает решение по порогу и отображает результат - единственное, что зависит от ползунка """
+    if result["degraded"]:
+        reason = "не ответил за отведенное время" if result["degraded_reason"] == "deadline" else "вернул ошибку"
+        st.warning(f"OCR {reason}, решение принято без OCR")
+    confidence = result["confidence"]
+    decision = decision_text(confidence, temp)
+    decision += (f". Уверенность: {confidence} при уровне {temp}. "
+                 f"Время выполнения: {elapsed_time(0, result['timings']['total'])}\n"
+                 f"{format_timings(result['timings'])}")
     st.text_area(label="Result", value=decision, height=40)
-    col1, col2, col3 = st.columns([1, 1, 1], gap='medium')
-    with col1:
-        st.image(file, caption="Загруженное изображение")
-    with col2:
-        st.image(draw_rectangles_yandex(file,
-                                        ocr_response['result']['textAnnotation']['blocks'],
-                                        result_dict['sentences']),
-                 caption="Обработанное изображение", use_column_width=True)
-    with col3:
-        st.image(image_with_zones_found, caption='Найденные зоны')
-
-
-def on_upload_tesseract(file, temp: float):
-    """ Вызывает обработку загруженного изображения и отображает результат """
+    # массивы передаются в st.image без кодирования в PNG
+    columns = st.columns([1] * max(2, len(images) + 1), gap='medium')
+    with columns[0]:
+        st.image(data, caption="Загруженное изображение")
+    for column, (image, caption) in zip(columns[1:], images):
+        with column:
+            st.image(image, caption=caption, use_column_width=True)
+
+
+def on_upload(engine, file, temp: float, *args):
+    """ Вызывает обработку загруженного изображения (или берет ее из кэша) и отображает результат """
+    data = file.getvalue()
     with st.spinner("Detecting image..."):
         try:
-            start_time = time.time()  # засекаем время
-            # get OCR result
-            ocr_result, image_width, image_height = parse_image_tesseract(file)
-            print(f"parse_image обработан за {elapsed_time(start_time, time.time())}")
-            processed_result = process_image_tesseract(ocr_result, image_width, image_height, block_percentile)
-            print(f"process_image обработан за {elapsed_time(start_time, time.time())}")
-            metrics = parse_ocr_tesseract(processed_result)
-            confidence = round(min(metrics[0] * 0.3 + metrics[1] * 0.05 + processed_result["blocks_overall"] * 0.07,
-                                   1.0), 2)
-            decision = "Переписка" if confidence >= temp else "Не переписка"
-            decision += (f". Уверенность: {confidence} при уровне {temp}. "
-                         f"Время выполнения: {elapsed_time(start_time, time.time())}")
+            result = analyze_with_deadline(get_script_run_ctx(), engine, data, False, *args)
+        except Overloaded:
+            st.error("Сервис перегружен, попробуйте позже")
+            st.stop()
+        except DeadlineExceeded:
+            st.error(f"Изображение не обработано за {APP_DEADLINE} с")
+            st.stop()
         except Exception as e:
             print(f"Error: {e}")
             st.error(f"Error: {e}")
             st.stop()
+    # визуализация строится после решения и не входит в его время
+    show_result(data, result, temp, result_images(engine, data, result, *args))
 
-    st.text_area(label="Result", value=decision, height=40)
-    col1, col2 = st.columns([1, 1], gap='medium')
-    with col1:
-        st.image(file, caption="Загруженное изображение")
-    with col2:
-        st.image(draw_rectangles_tesseract(file, ocr_result, processed_result['text_blocks']),
-                 caption="Обработанное изображение", use_column_width=True)
+
+def on_upload_many(engine, files, temp: float, *args):
+    """
+    Обрабатывает несколько загруженных изображений параллельно в пуле и заполняет таблицу по мере готовности.
+    Изображения сверх очереди ждут в ней места, срок каждого отсчитывается с приема.
+    Визуализации строятся только для выбранной в таблице строки.
+    """
+    uploads = [file.getvalue() for file in files]
+    rows = [{"Файл": file.name, "Решение": "обрабатывается", "Уверенность": None, "Время, мс": None}
+            for file in files]
+    results = [None] * len(files)
+    table = st.empty()
+    summary = st.empty()
+    ctx = get_script_run_ctx()
+    start_time = time.perf_counter()
+    futures = {get_request_pool().submit(analyze_with_deadline, ctx, engine, data, True, *args): index
+               for index, data in enumerate(uploads)}
+    for done, future in enumerate(as_completed(futures), start=1):
+        index = futures[future]
+        try:
+            result = results[index] = future.result()
+            decision = decision_text(result["confidence"], temp)
+            rows[index].update({"Решение": decision + (" (без OCR)" if result["degraded"] else ""),
+                                "Уверенность": result["confidence"],
+                                "Время, мс": round(result["timings"]["total"] * 1000, 1)})
+        except Overloaded:
+            rows[index]["Решение"] = "Отклонено: очередь заполнена"
+        except Exception as e:
+            print(f"Error: {files[index].name}: {e}")
+            rows[index]["Решение"] = f"Ошибка: {e}"
+        elapsed = time.perf_counter() - start_time
+        if done < len(files):
+            table.dataframe(rows, use_container_width=True)
+        summary.text(f"Обработано {done} из {len(files)} за {elapsed_time(0, elapsed)}, "
+                     f"{done / elapsed:.1f} изобр./с")
+    event = table.dataframe(rows, use_container_width=True, on_select="rerun", selection_mode="single-row",
+                            key="results_table")
+    conversations = sum(1 for result in results if result is not None and result["confidence"] >= temp)
+    st.caption(f"Переписок: {conversations} из {len(files)}. Выберите строку, чтобы посмотреть найденные блоки.")
+    for index in event.selection.rows:
+        if results[index] is not None:
+            st.subheader(files[index].name)
+            show_result(uploads[index], results[index], temp,
+                        result_images(engine, uploads[index], results[index], *args))
 
 
 def main():
     """ Создает объекты streamlit-сервиса """
-    uploader = st.file_uploader("Choose image for detection", type=['png', 'jpg', 'jpeg'])
+    warm_up_workers()
+    uploader = st.file_uploader("Choose images for detection", type=['png', 'jpg', 'jpeg'],
+                                accept_multiple_files=True)
     slider_value = st.empty()
     show_slider = st.checkbox("Настроить порог")
     if show_slider:
@@ -100,41 +324,28 @@ def main():
         if ocr_choosen == "Использовать YandexOCR":
             folder_id = st.text_input("Введите folder_id")
             api_key = st.text_input("Введите API KEY")
+        hybrid = st.checkbox("Вызывать OCR, только если решение без OCR неуверенное")
     if uploader:
         temp = slider_value if isinstance(slider_value, float) else 0.7
+        args = ()
         if use_ocr and ocr_choosen == "Использовать YandexOCR":
-            if folder_id != "" and api_key != "":
-                on_upload_yandex(uploader, temp, folder_id, api_key)
-            else:
+            if folder_id == "" or api_key == "":
                 st.error(f"Необходимо ввести действующие folder_id и api_key")
                 st.stop()
+            engine, args = "yandex", (folder_id, api_key)
         elif use_ocr and ocr_choosen == "Использовать Tesseract":
-            on_upload_tesseract(uploader, temp)
+            engine = "tesseract"
         else:
-            on_upload_without_ocr(uploader, temp)
-
-
-def on_upload_without_ocr(file, temp: float):
-    with st.spinner("Detecting image..."):
-        try:
-            start_time = time.time()  # засекаем время
-            confidence, bounding_boxes, fill_im = process_image(file, block_percentile)
-            elapsed = elapsed_time(start_time, time.time())
-            print(f"process_image обработан за {elapsed}")
-            decision = "Переписка" if confidence >= temp else "Не переписка"
-            decision += (f". Уверенность: {confidence} при уровне {temp}. "
-                         f"Время выполнения: {elapsed}\n")
-        except Exception as e:
-            st.error(f"Error: {e}")
-            st.stop()
-    st.text_area(label="Result", value=decision, height=40)
-    col1, col2 = st.columns([1, 1], gap='medium')
-    with col1:
-        st.image(file, caption="Загруженное изображение")
-    with col2:
-        if fill_im is not None:
-            st.image(plot_results(fill_im, bounding_boxes), caption="Обработанное изображение", use_column_width=True)
+            engine = "no_ocr"
+        if use_ocr and hybrid:
+            engine, args = "hybrid", (engine,) + args
+        if len(uploader) == 1:
+            on_upload(engine, uploader[0], temp, *args)
+        else:
+            on_upload_many(engine, uploader, temp, *args)
 
 
 if __name__ == "__main__":
+    if os.environ.get("METRICS_PORT"):
+        metrics.serve_metrics(int(os.environ["METRICS_PORT"]))
     main()
@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from functools import partial
+from typing import Dict, Iterator, Set
+import numpy as np
+from src.image_processing import BOX_DETECTORS
+from src.ocr_store import OCRStore
+from src.pipeline import ENGINES, OCR_ENGINES, SCORERS, classify, warm_up
+from src.utils import get_image_files
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def iter_input_paths(inputs) -> Iterator[str]:
+    """ Перебирает пути к изображениям: директории обходятся рекурсивно, '-' означает чтение путей из stdin """
+    for item in inputs:
+        if item == "-":
+            for line in sys.stdin:
+                path = line.strip()
+                if path:
+                    yield path
+        elif os.path.isdir(item):
+            yield from get_image_files(item, IMAGE_EXTENSIONS)
+        else:
+            yield item
+
+
+def load_done_paths(output_path) -> Set[str]:
+    """
+    Читает уже записанный jsonl и возвращает пути обработанных изображений (для продолжения прерванного запуска).
+    Записи с ошибками и недописанные строки удаляются из файла: эти изображения обрабатываются заново,
+    и новая запись не дублирует старую.
+    """
+    done = set()
+    if not output_path or not os.path.exists(output_path):
+        return done
+    kept = []
+    with open(output_path, encoding='utf-8') as f:
+        lines = f.readlines()
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue  # последняя строка могла не дописаться при прерывании
+        if "path" in record and "error" not in record:
+            done.add(record["path"])
+            kept.append(line if line.endswith("\n") else line + "\n")
+    if len(kept) != len(lines):
+        temp_path = output_path + ".tmp"
+        with open(temp_path, "w", encoding='utf-8') as f:
+            f.writelines(kept)
+        os.replace(temp_path, output_path)
+    return done
+
+
+def classify_path(path, with_boxes=False, **kwargs) -> Dict:
+    """ Классифицирует одно изображение и возвращает запись для jsonl (ошибки не пробрасываются) """
+    try:
+        result = classify(path, **kwargs)
+    except Exception as e:
+        return {"path": path, "error": str(e)}
+    record = {"path": path}
+    for key in ("verdict", "is_conversation", "confidence", "messages", "side_switches", "timings"):
+        record[key] = result[key]
+    for key in ("pixel_confidence", "ocr_engine", "ocr_confidence"):
+        if key in result:
+            record[key] = result[key]
+    if with_boxes:
+        record["boxes"] = result["boxes"]
+    return record
+
+
+def run_batch(inputs, output_path=None, workers=None, engine="no_ocr", temp=0.7, block_percentile=0.18,
+              folder_id=None, api_key=None, with_boxes=False, detector="skimage", prefilter=False, roi=False,
+              ocr_store=None, ocr_engine=None, band=None, scorer="rules") -> Dict:
+    """
+    Раздает изображения по процессам и пишет результаты в jsonl по мере готовности.
+    ocr_store - OCRStore для записи ответов OCR (или их воспроизведения без обращения к OCR).
+    ocr_engine, band - OCR и полуинтервал уверенности, в котором он вызывается, для движка hybrid
+    (band None - полоса по умолчанию для scorer).
+    scorer - оценка уверенности без OCR (SCORERS).
+    """
+    workers = workers or os.cpu_count() or 1
+    done = load_done_paths(output_path)
+    output = open(output_path, "a", encoding='utf-8') if output_path else sys.stdout
+    task = partial(classify_path, with_boxes=with_boxes, engine=engine, temp=temp,
+                   block_percentile=block_percentile, folder_id=folder_id, api_key=api_key, detector=detector,
+                   prefilter=prefilter, roi=roi, ocr_store=ocr_store, ocr_engine=ocr_engine, band=band,
+                   scorer=scorer)
+    stats = {"processed": 0, "skipped": 0, "errors": 0, "conversations": 0}
+    latencies = []
+    start_time = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=partial(warm_up, (engine,), detector)) as pool:
+            pending = set()
+            for path in iter_input_paths(inputs):
+                if path in done:
+                    stats["skipped"] += 1
+                    continue
+                done.add(path)
+                pending.add(pool.submit(task, path))
+                # ограничиваем количество задач в очереди, чтобы не держать в памяти весь список
+                if len(pending) >= workers * 4:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                else:
+                    finished = {future for future in pending if future.done()}
+                    pending -= finished
+                # готовые результаты пишутся сразу, а не когда заполнится очередь
+                for future in finished:
+                    write_record(future.result(), output, stats, latencies)
+            for future in as_completed(pending):
+                write_record(future.result(), output, stats, latencies)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start_time
+    stats["elapsed"] = round(elapsed, 3)
+    stats["images_per_second"] = round(stats["processed"] / elapsed, 2) if elapsed > 0 else 0
+    if latencies:
+        stats["latency_p50"] = round(float(np.percentile(latencies, 50)), 4)
+        stats["latency_p95"] = round(float(np.percentile(latencies, 95)), 4)
+    return stats
+
+
+def write_record(record, output, stats, latencies) -> None:
+    """ Пишет одну строку jsonl и обновляет статистику """
+    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+    output.flush()
+    stats["processed"] += 1
+    if "error" in record:
+        stats["errors"] += 1
+        return
+    stats["conversations"] += int(record["is_conversation"])
+    latencies.append(record["timings"]["total"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пакетная классификация скриншотов с выводом в jsonl")
+    parser.add_argument("inputs", nargs="+", help="директории, файлы изображений или '-' для чтения путей из stdin")
+    parser.add_argument("-o", "--output", default=None,
+                        help="файл jsonl (дописывается, уже обработанные изображения пропускаются), "
+                             "по умолчанию stdout")
+    parser.add_argument("--engine", default="no_ocr", choices=ENGINES)
+    parser.add_argument("--workers", type=int, default=None, help="количество процессов (по умолчанию - число ядер)")
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--block-percentile", type=float, default=0.18)
+    parser.add_argument("--folder-id", default=os.environ.get("YANDEX_FOLDER_ID"))
+    parser.add_argument("--api-key", default=os.environ.get("YANDEX_API_KEY"))
+    parser.add_argument("--boxes", action="store_true", help="добавлять найденные блоки в вывод")
+    parser.add_argument("--detector", default="skimage", choices=BOX_DETECTORS, help="реализация поиска блоков")
+    parser.add_argument("--prefilter", action="store_true", help="отсекать очевидные не переписки по миниатюре")
+    parser.add_argument("--roi", action="store_true", help="tesseract: распознавать только найденные блоки сообщений")
+    parser.add_argument("--ocr", default=None, choices=OCR_ENGINES,
+                        help="hybrid: OCR (по умолчанию yandex при наличии ключей, иначе tesseract)")
+    parser.add_argument("--band", type=float, nargs=2, default=None, metavar=("LOW", "HIGH"),
+                        help="hybrid: OCR вызывается при уверенности без OCR в [LOW, HIGH) (по умолчанию "
+                             "0.2 1.0 для формулы, полоса из файла для обученной модели)")
+    parser.add_argument("--scorer", default="rules", choices=SCORERS,
+                        help="уверенность без OCR: формула или обученная модель (train_scorer.py, SCORER_MODEL)")
+    parser.add_argument("--ocr-store", default=None, help="файл sqlite для записи ответов OCR (см. rescore.py)")
+    parser.add_argument("--replay", action="store_true", help="брать ответы OCR только из --ocr-store, без OCR")
+    args = parser.parse_args()
+    if args.replay and not args.ocr_store:
+        parser.error("--replay requires --ocr-store")
+    store = OCRStore(args.ocr_store, mode="replay" if args.replay else "record") if args.ocr_store else None
+    summary = run_batch(args.inputs, args.output, args.workers, args.engine, args.threshold, args.block_percentile,
+                        args.folder_id, args.api_key, args.boxes, args.detector, args.prefilter, args.roi, store,
+                        args.ocr, tuple(args.band) if args.band else None, args.scorer)
+    print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
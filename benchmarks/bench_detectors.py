@@ -0,0 +1,59 @@
+"""
+Сравнение реализаций поиска блоков (image_processing.BOX_DETECTORS) по скорости и совпадению с skimage.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_detectors --repeats 5
+"""
+import argparse
+import time
+from io import BytesIO
+import numpy as np
+from benchmarks.corpus import load_corpus
+from src.image_processing import BOX_DETECTORS, process_image
+
+
+def boxes_agree(expected, actual, tolerance=2) -> bool:
+    """ Блоки совпадают по количеству, сторонам и координатам с точностью до tolerance пикселей """
+    if len(expected) != len(actual):
+        return False
+    return all(side == other_side and max(abs(a - b) for a, b in zip(box, other_box)) <= tolerance
+               for (box, side), (other_box, other_side) in zip(expected, actual))
+
+
+def run_benchmark(directory="imgs", repeats=5, with_synthetic=True, temp=0.7):
+    corpus = load_corpus(directory, with_synthetic)
+    reference = {name: process_image(BytesIO(data))[:2] for name, data, _ in corpus}
+    report = {}
+    for detector in BOX_DETECTORS:
+        latencies, verdicts, boxes, correct = [], 0, 0, 0
+        for name, data, label in corpus:
+            process_image(BytesIO(data), detector=detector)  # прогрев
+            for _ in range(repeats):
+                start_time = time.perf_counter()
+                confidence, bounding_boxes, _ = process_image(BytesIO(data), detector=detector)
+                latencies.append(time.perf_counter() - start_time)
+            expected_confidence, expected_boxes = reference[name]
+            verdicts += (confidence >= temp) == (expected_confidence >= temp)
+            boxes += boxes_agree(expected_boxes, bounding_boxes)
+            correct += (confidence >= temp) == bool(label)
+        report[detector] = {
+            "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+            "p95_ms": float(np.percentile(latencies, 95)) * 1000,
+            "verdict_agreement": verdicts / len(corpus),
+            "boxes_agreement": boxes / len(corpus),
+            "accuracy": correct / len(corpus),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сравнение реализаций поиска блоков")
+    parser.add_argument("--images", default="imgs", help="директория корпуса")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--no-synthetic", action="store_true", help="не добавлять синтетические изображения")
+    args = parser.parse_args()
+    result = run_benchmark(args.images, args.repeats, not args.no_synthetic)
+    print(f"{'detector':<12}{'p50 ms':>10}{'p95 ms':>10}{'verdicts':>10}{'boxes':>10}{'accuracy':>10}")
+    for name, values in result.items():
+        print(f"{name:<12}{values['p50_ms']:>10.1f}{values['p95_ms']:>10.1f}{values['verdict_agreement']:>10.2f}"
+              f"{values['boxes_agreement']:>10.2f}{values['accuracy']:>10.2f}")
@@ -0,0 +1,116 @@
+"""
+Память на запрос по реализациям поиска блоков: пик выделенной памяти (tracemalloc, учитывает массивы NumPy и
+OpenCV), новые страницы процесса (minor page faults), число выделений буферов (src.buffers) и объем удерживаемых
+буферов. Каждая реализация прогоняется в новом процессе python, поэтому в отчете есть и итоговый maxrss.
+Корпус проходится дважды: первый проход выделяет буферы `lowmem`, второй показывает установившийся режим.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_memory --save memory.json
+    python -m benchmarks.bench_memory --compare memory.json
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tracemalloc
+from io import BytesIO
+
+TASKS = ("boxes", "color_zones")
+PASSES = ("first", "second")
+
+
+def run_task(task, detector, data, response) -> None:
+    from src.image_processing import BOX_DETECTORS
+    from src.utils import color_zone_edges, color_zone_regions
+    if task == "boxes":
+        BOX_DETECTORS[detector](BytesIO(data))
+    else:
+        color_zone_regions(color_zone_edges(BytesIO(data), detector), response, detector)
+
+
+def child(task, detector, directory, with_synthetic) -> None:
+    """ Замер в дочернем процессе: печатает json со средними и наибольшими значениями на запрос по проходам """
+    from benchmarks.corpus import load_corpus
+    from benchmarks.yandex_stub import make_response
+    from src.buffers import get_buffers
+    corpus = [(data, make_response(data) if task == "color_zones" else None)
+              for _, data, _ in load_corpus(directory, with_synthetic)]
+    run_task(task, detector, *corpus[0])  # импорты и кэши модулей не относятся к запросу
+    buffers = get_buffers()
+    result = {}
+    for name in PASSES:
+        peaks, faults, allocations = [], [], []
+        for data, response in corpus:
+            minflt, count = resource.getrusage(resource.RUSAGE_SELF).ru_minflt, buffers.allocations
+            tracemalloc.start()
+            run_task(task, detector, data, response)
+            peaks.append(tracemalloc.get_traced_memory()[1] / 2 ** 20)
+            tracemalloc.stop()
+            faults.append(resource.getrusage(resource.RUSAGE_SELF).ru_minflt - minflt)
+            allocations.append(buffers.allocations - count)
+        result[name] = {"peak_mb": sum(peaks) / len(peaks), "peak_mb_max": max(peaks),
+                        "page_faults": sum(faults) / len(faults), "buffer_allocations": sum(allocations)}
+    result["retained_mb"] = buffers.nbytes / 2 ** 20
+    result["maxrss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(result))
+
+
+def run_benchmark(detectors, tasks, directory="imgs", with_synthetic=True):
+    report = {}
+    for task in tasks:
+        for detector in detectors:
+            output = subprocess.run([sys.executable, "-m", "benchmarks.bench_memory", "--child", task, detector,
+                                     directory, "1" if with_synthetic else "0"],
+                                    check=True, capture_output=True, text=True).stdout
+            report[f"{task}/{detector}"] = json.loads(output.strip().splitlines()[-1])
+    return report
+
+
+def print_report(report) -> None:
+    print(f"{'run':<22}{'pass':>8}{'peak MB':>10}{'max MB':>10}{'faults':>10}{'buf allocs':>12}"
+          f"{'retained MB':>13}{'maxrss MB':>11}")
+    for name, values in report.items():
+        for stage in PASSES:
+            row = values[stage]
+            tail = f"{values['retained_mb']:>13.1f}{values['maxrss_mb']:>11.1f}" if stage == PASSES[-1] else ""
+            print(f"{name:<22}{stage:>8}{row['peak_mb']:>10.1f}{row['peak_mb_max']:>10.1f}{row['page_faults']:>10.0f}"
+                  f"{row['buffer_allocations']:>12}" + tail)
+
+
+def compare_reports(report, baseline, tolerance=0.2):
+    """ Регрессии: средний пик памяти или число новых страниц во втором проходе выросли больше чем на tolerance """
+    regressions = []
+    for name, values in report.items():
+        old = baseline.get(name)
+        for metric in ("peak_mb", "page_faults"):
+            if old and values["second"][metric] > old["second"][metric] * (1 + tolerance) + 1:
+                regressions.append(f"{name}/{metric}: {old['second'][metric]:.1f} -> {values['second'][metric]:.1f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5] == "1")
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description="Пиковая память и выделения на запрос по реализациям поиска блоков")
+    parser.add_argument("--images", default="imgs")
+    parser.add_argument("--no-synthetic", action="store_true", help="не добавлять синтетические изображения")
+    parser.add_argument("--detectors", nargs="+", default=["skimage", "opencv", "lowmem"])
+    parser.add_argument("--tasks", nargs="+", default=list(TASKS), choices=TASKS)
+    parser.add_argument("--save", help="сохранить отчет в json (базовая линия)")
+    parser.add_argument("--compare", help="сравнить с сохраненной базовой линией")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимый относительный рост")
+    args = parser.parse_args()
+    result = run_benchmark(args.detectors, args.tasks, args.images, not args.no_synthetic)
+    print_report(result)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            found = compare_reports(result, json.load(f), args.tolerance)
+        if found:
+            print("\nРегрессии:\n" + "\n".join(found))
+            sys.exit(1)
+        print("\nРегрессий не найдено")
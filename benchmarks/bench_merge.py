@@ -0,0 +1,357 @@
+"""
+Объединение блоков OCR в сообщения: векторный движок src.block_merge (process_image_tesseract,
+process_ocr_yandex) против прежних циклов по словам и блокам на больших синтетических ответах OCR
+(длинные скриншоты с тысячами слов). Перед замером проверяется, что результаты совпадают.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_merge --words 2000 5000 20000
+"""
+import argparse
+import random
+import re
+import time
+from typing import Dict, Tuple
+import numpy as np
+from src.metrics import inc
+from src.tesseract import process_image_tesseract
+from src.yandex import get_coords_yandex, process_ocr_yandex
+
+
+def make_tesseract_details(words=5000, width=1080, seed=0, noise=0.0) -> Tuple[Dict, int, int]:
+    """
+    Словарь image_to_data длинного скриншота переписки: сообщения слева и справа по несколько строк,
+    отметки времени, широкие блоки посередине и пустые слова. noise - доля слов в случайных местах.
+    :return: (details, ширина, высота)
+    """
+    rnd = random.Random(seed)
+    details = {key: [] for key in ('text', 'left', 'top', 'width', 'height')}
+    line_height = int(width * 0.03)
+    y = int(width * 0.05)
+    while len(details['text']) < words:
+        kind = rnd.choice(("left", "right", "right", "left", "middle", "wide"))
+        message_width = int(width * rnd.uniform(0.3, 0.7)) if kind != "wide" else int(width * 0.95)
+        x = {"left": int(width * 0.05), "right": width - int(width * 0.05) - message_width,
+             "middle": (width - message_width) // 2, "wide": int(width * 0.02)}[kind]
+        for _ in range(rnd.randint(1, 4)):
+            position = x + rnd.randint(0, 10)
+            while position < x + message_width:
+                word_width = rnd.randint(20, 120)
+                is_noise = rnd.random() < noise
+                values = ("" if rnd.random() < 0.05 else "слово",
+                          rnd.randint(0, width - 1) if is_noise else position,
+                          rnd.randint(0, max(y, 1)) if is_noise else y + rnd.randint(-3, 3),
+                          word_width, line_height + rnd.randint(-4, 4))
+                for key, value in zip(details, values):
+                    details[key].append(value)
+                position += word_width + rnd.randint(5, 20)
+            y += line_height + rnd.randint(0, int(line_height * 0.6))
+        y += rnd.randint(0, line_height * 3)
+    return details, width, y + line_height
+
+
+def make_yandex_response(blocks=2000, width=1080, seed=0, noise=0.0) -> Dict:
+    """ Ответ recognizeText длинного скриншота: блоки сообщений, отметки времени и блоки посередине """
+    rnd = random.Random(seed)
+    items = []
+    line_height = int(width * 0.03)
+    y = int(width * 0.05)
+    for _ in range(blocks):
+        kind = rnd.choice(("left", "right", "middle", "wide", "time", "time"))
+        lines = 1 if kind == "time" else rnd.randint(1, 3)
+        block_width = int(width * (0.06 if kind == "time" else rnd.uniform(0.3, 0.7)))
+        x = {"left": int(width * 0.05), "right": width - int(width * 0.05) - block_width,
+             "middle": (width - block_width) // 2, "wide": int(width * 0.02),
+             "time": rnd.choice((int(width * 0.05), width - int(width * 0.12)))}[kind]
+        if kind == "wide":
+            block_width = int(width * 0.95)
+        if rnd.random() < noise:
+            x, y = rnd.randint(0, width - block_width), max(0, y - rnd.randint(0, line_height * 5))
+        x2, y2 = x + block_width, y + lines * line_height
+        texts = [f"{rnd.randint(0, 23)}:{rnd.randint(0, 59):02d}"] if kind == "time" else ["текст"] * lines
+        bounding_box = {"vertices": [{"x": str(x), "y": str(y)}, {"x": str(x), "y": str(y2)},
+                                     {"x": str(x2), "y": str(y2)}, {"x": str(x2 - rnd.randint(0, 5)), "y": str(y)}]}
+        items.append({"boundingBox": bounding_box,
+                      "lines": [{"boundingBox": bounding_box, "text": text, "words": []} for text in texts]})
+        y = y2 + rnd.randint(0, line_height * 2)
+    return {"result": {"textAnnotation": {"width": str(width), "height": str(y + line_height), "blocks": items,
+                                          "fullText": "текст"}}}
+
+
+def process_image_tesseract_loop(details, image_width, image_height, block_percentile, reduce_factor=1.37) -> Dict:
+    """ Прежняя реализация process_image_tesseract: цикл по словам со словарем текущего сообщения """
+    text_blocks = []  # Список для хранения информации о текстовых блоках
+    full_text = ""  # тут храним весь найденный текст (для чего? кек)
+    current_message = {  # храним данные текущего сообщения
+        "text": "",
+        "coords": [0, 0, 0, -100],  # x1, y1, x2, y2
+        "side": ""  # "response", "user" or "middle"
+    }
+    for i in range(len(details['text'])):
+        if details['text'][i].strip() != '':
+            full_text += f"{details['text'][i]} "
+            # смотрим насколько далеко был предыдущий блок (сравниваем нижнюю y-координату предыдущего
+            # блока с верхней y-координатой текущего), если блок расположен слишком близко, он может относиться
+            # к предыдущей строке (или быть временной отметкой)
+            current_y = details['top'][i]  # текущая верхняя y-координата
+            previous_block_too_close = current_y < current_message["coords"][3] + image_height * 0.02
+            # если верхний левый угол блока находится слева, то предполагаем что это ответ на сообщение
+            if details['left'][i] < image_width * block_percentile:
+                # если текущее предложение отсутствует
+                if current_message["text"] == "":
+                    current_message["coords"] = [details['left'][i], details['top'][i],
+                                                 details['left'][i] + details['width'][i],
+                                                 details['top'][i] + details['height'][i]]
+                    current_message['side'] = "response"
+                else:
+                    # если блок расположен близко к предыдущему, считаем что он ему принадлежит
+                    if previous_block_too_close:
+                        current_message["coords"][0] = min(details['left'][i],
+                                                           current_message["coords"][0])
+                        current_message["coords"][2] = max(details['left'][i] + details['width'][i],
+                                                           current_message["coords"][2])
+                        current_message["coords"][3] = max(details['top'][i] + details['height'][i],
+                                                           current_message["coords"][3])
+                        if (current_message["coords"][2] <= image_width * (1 - block_percentile) and
+                                current_message["coords"][0] <= image_width * block_percentile):
+                            current_message['side'] = "response"
+                    # если это новый блок, добавляем предыдущее сообщение и создаем новое
+                    else:
+                        if not (current_message["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
+                                current_message["coords"][0] <= image_width * (block_percentile / reduce_factor)):
+                            text_blocks.append(current_message.copy())
+                        current_message["text"] = ""
+                        current_message["coords"] = [details['left'][i], details['top'][i],
+                                                     details['left'][i] + details['width'][i],
+                                                     details['top'][i] + details['height'][i]]
+                        current_message['side'] = "response"
+                current_message["text"] += f"{details['text'][i]} "
+            # или если верхний правый угол блока находится справа, то предполагаем что это сообщение пользователя
+            elif details['left'][i] + details['width'][i] > image_width * (1 - block_percentile):
+                # если текущее сообщение отсутствует
+                if current_message["text"] == "":
+                    current_message["coords"] = [details['left'][i], details['top'][i],
+                                                 details['left'][i] + details['width'][i],
+                                                 details['top'][i] + details['height'][i]]
+                    current_message['side'] = "user"
+                else:
+                    # если блок расположен близко к предыдущему, считаем что он ему принадлежит
+                    if previous_block_too_close:
+                        # расширяем х- и y-координаты влево, вправо и вниз
+                        current_message["coords"][0] = min(details['left'][i],
+                                                           current_message["coords"][0])
+                        current_message["coords"][1] = min(details['top'][i],
+                                                           current_message["coords"][1])
+                        current_message["coords"][2] = max(details['left'][i] + details['width'][i],
+                                                           current_message["coords"][2])
+                        current_message["coords"][3] = max(details['top'][i] + details['height'][i],
+                                                           current_message["coords"][3])
+                        # проверяем на сторону, возможно предыдущий блок был слишком близко расположен к процентилю
+                        # границы и неправильно записан в response. проверяем по block_percentile, если ближе к правой
+                        # границе чем к левой то меняем сторону. если сторона=response, то не сменится на user
+                        if (current_message["coords"][2] >= image_width * (1 - block_percentile) and
+                                current_message["coords"][0] >= image_width * block_percentile):
+                            current_message['side'] = "user"
+                    else:
+                        if not (current_message["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
+                                current_message["coords"][0] <= image_width * (block_percentile / reduce_factor)):
+                            text_blocks.append(current_message.copy())
+                        current_message["text"] = ""
+                        current_message["coords"] = [details['left'][i], details['top'][i],
+                                                     details['left'][i] + details['width'][i],
+                                                     details['top'][i] + details['height'][i]]
+                        current_message['side'] = "user"
+                current_message["text"] += f"{details['text'][i]} "
+            # если блок не входит в процентную зону краев картинки
+            else:
+                # если блок расположен близко к предыдущему, считаем что он ему принадлежит
+                if previous_block_too_close:
+                    # расширяем границы текущего блока влево, вправо и вниз
+                    current_message["coords"][0] = min(details['left'][i],
+                                                       current_message["coords"][0])
+                    current_message["coords"][2] = max(details['left'][i] + details['width'][i],
+                                                       current_message["coords"][2])
+                    current_message["coords"][3] = max(details['top'][i] + details['height'][i],
+                                                       current_message["coords"][3])
+                else:
+                    # если предыдущий блок не центральный, а относится к какой-то части, то добавляем его
+                    if (current_message["text"] != "" and not
+                       (current_message["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
+                       current_message["coords"][0] <= image_width * (block_percentile / reduce_factor))):
+                        text_blocks.append(current_message.copy())
+                    current_message["text"] = ""
+                    current_message["coords"] = [details['left'][i], details['top'][i],
+                                                 details['left'][i] + details['width'][i],
+                                                 details['top'][i] + details['height'][i]]
+                    current_message['side'] = "middle"
+                current_message["text"] += f"{details['text'][i]} "
+
+    if (current_message["text"] != "" and not
+       (current_message["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
+       current_message["coords"][0] <= image_width * (block_percentile / reduce_factor))):
+        text_blocks.append(current_message)
+    result_dict = {
+        "blocks_overall": len(text_blocks),
+        "text_blocks": text_blocks,
+        "full_text": full_text
+    }
+    return result_dict
+
+
+def process_ocr_yandex_loop(ocr_text, block_percentile, reduce_factor=1.5) -> Tuple[str, dict]:
+    """ Прежняя реализация process_ocr_yandex: цикл по блокам со словарем текущего предложения """
+    timestamp_pattern = re.compile(r'^([0-9]|1[0-9]|2[0-3]):([0-5][0-9])$')
+    full_text = ""
+    result_dict = {
+        "sentences": []  # обработанные предложения
+    }
+    # если нет ожидаемой структуры - выходим
+    if 'result' not in ocr_text or 'textAnnotation' not in ocr_text['result']:
+        return full_text, result_dict
+    text_annotation = ocr_text['result']['textAnnotation']
+    full_text = text_annotation['fullText'] if 'fullText' in text_annotation else ""
+    # нет текста - выходим
+    if full_text == "":
+        full_text = "There is no conversation on image"
+        return full_text, result_dict
+    image_width = int(text_annotation["width"])
+    image_height = int(text_annotation["height"])
+    result_dict["blocks_overall"] = len(text_annotation['blocks'])
+    inc("ocr_blocks", len(text_annotation['blocks']))
+    inc("ocr_words", sum(len(line.get('words', [])) for block in text_annotation['blocks'] for line in block['lines']))
+    # храним данные предыдущего сообщения
+    current_sentence = {
+        "text": "",
+        "coords": [0, 0, 0, 0],  # x1, y1, x2, y2
+        "side": "middle",  # "response", "user" or "middle"
+    }
+    for block in text_annotation['blocks']:
+        # если в блоке одна строка со временем, считаем её за временную отметку сообщения (надо?)
+        is_time_block = len(block['lines']) == 1 and timestamp_pattern.match(block['lines'][0]['text']) is not None
+        # смотрим насколько далеко был предыдущий блок (сравниваем нижнюю y-координату предыдущего
+        # блока с верхней y-координатой текущего)
+        # если блок расположен слишком близко, он может относиться
+        # к предыдущей строке (или быть временной отметкой)
+        current_y = int(block['boundingBox']['vertices'][0]['y'])  # текущая верхняя y-координата
+        previous_block_too_close = current_y < current_sentence["coords"][3] + image_height * 0.02
+        # если сообщение со временем и слишком близко - скорее всего это время сообщения, игнорируем
+        if is_time_block and previous_block_too_close:
+            continue
+        # если левая координата блока находится в левой части картинки, то предполагаем что это ответ на сообщение
+        if int(block['boundingBox']['vertices'][0]['x']) < image_width * block_percentile:
+            # если текущее предложение отсутствует
+            if current_sentence["text"] == "":
+                current_sentence["coords"] = get_coords_yandex(block)
+                current_sentence['side'] = "response"
+            else:
+                # если блок расположен близко к предыдущему, считаем что он ему принадлежит
+                if previous_block_too_close:
+                    current_sentence["coords"][2] = max(int(block['boundingBox']['vertices'][2]['x']),
+                                                        current_sentence["coords"][2])
+                    current_sentence["coords"][3] = max(int(block['boundingBox']['vertices'][2]['y']),
+                                                        current_sentence["coords"][3])
+                # если это новый блок, добавляем предыдущее сообщение и создаем новое
+                else:
+                    if (current_sentence['side'] != "middle" and
+                        not (current_sentence["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
+                             current_sentence["coords"][0] <= image_width * (block_percentile / reduce_factor))):
+                        result_dict["sentences"].append(current_sentence.copy())
+                    current_sentence["text"] = ""
+                    current_sentence["coords"] = get_coords_yandex(block)
+                    current_sentence['side'] = "response"
+            for line in block["lines"]:
+                current_sentence["text"] += f"{line['text']} "
+        # или если верхний правый угол блока находится справа, то предполагаем что это сообщение пользователя
+        elif int(block['boundingBox']['vertices'][3]['x']) > image_width * (1 - block_percentile):
+            # если текущее предложение отсутствует
+            if current_sentence["text"] == "":
+                current_sentence["coords"] = get_coords_yandex(block)
+                current_sentence['side'] = "user"
+            else:
+                # если блок расположен близко к предыдущему, считаем что он ему принадлежит
+                if previous_block_too_close:
+                    # расширяем х- и y-координаты влево, вправо и вниз
+                    current_sentence["coords"][0] = min(int(block['boundingBox']['vertices'][0]['x']),
+                                                        current_sentence["coords"][0])
+                    current_sentence["coords"][1] = min(int(block['boundingBox']['vertices'][0]['y']),
+                                                        current_sentence["coords"][1])
+                    current_sentence["coords"][2] = max(int(block['boundingBox']['vertices'][2]['x']),
+                                                        current_sentence["coords"][2])
+                    current_sentence["coords"][3] = max(int(block['boundingBox']['vertices'][2]['y']),
+                                                        current_sentence["coords"][3])
+                    # проверяем на сторону, возможно предыдущий блок был слишком близко расположен к процентилю
+                    # границы и неправильно записан в response. проверяем по block_percentile / 2
+                    # если ближе к правой границе чем к левой то меняем сторону
+                    if (current_sentence["coords"][2] >= image_width * (1 - block_percentile) and
+                            current_sentence["coords"][0] >= image_width * (block_percentile / reduce_factor)):
+                        current_sentence['side'] = "user"
+                else:
+                    result_dict["sentences"].append(current_sentence.copy())
+                    current_sentence["text"] = ""
+                    current_sentence["coords"] = get_coords_yandex(block)
+                    current_sentence['side'] = "user"
+            for line in block["lines"]:
+                current_sentence["text"] += f"{line['text']} "
+        # если блок не входит в процентную зону краев картинки
+        else:
+            # если блок расположен близко к предыдущему, считаем что он ему принадлежит
+            if previous_block_too_close:
+                # расширяем границы текущего блока влево, вправо и вниз
+                current_sentence["coords"][0] = min(int(block['boundingBox']['vertices'][0]['x']),
+                                                    current_sentence["coords"][0])
+                current_sentence["coords"][2] = max(int(block['boundingBox']['vertices'][2]['x']),
+                                                    current_sentence["coords"][2])
+                current_sentence["coords"][3] = max(int(block['boundingBox']['vertices'][2]['y']),
+                                                    current_sentence["coords"][3])
+            else:
+                # если предыдущий блок не центральный, а относится к какой-то части, то добавляем его
+                if (current_sentence['side'] != "middle" and
+                        not (current_sentence["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
+                             current_sentence["coords"][0] <= image_width * (block_percentile / reduce_factor))):
+                    result_dict["sentences"].append(current_sentence.copy())
+                current_sentence["text"] = ""
+                current_sentence["coords"] = get_coords_yandex(block)
+                current_sentence['side'] = "middle"
+            for line in block["lines"]:
+                current_sentence["text"] += f"{line['text']} "
+    if (current_sentence['side'] != "middle" and
+            not (current_sentence["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
+                 current_sentence["coords"][0] <= image_width * (block_percentile / reduce_factor))):
+        result_dict["sentences"].append(current_sentence)
+    return full_text, result_dict
+
+
+def timeit(func, repeats):
+    latencies = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start_time)
+    return float(np.median(latencies)) * 1000
+
+
+def run_benchmark(sizes=(2000, 5000, 20000), repeats=5):
+    rows = []
+    for size in sizes:
+        details, width, height = make_tesseract_details(size)
+        response = make_yandex_response(size // 4)
+        assert process_image_tesseract(details, width, height, 0.18) == \
+            process_image_tesseract_loop(details, width, height, 0.18)
+        assert process_ocr_yandex(response, 0.18) == process_ocr_yandex_loop(response, 0.18)
+        rows.append(("tesseract", size,
+                     timeit(lambda: process_image_tesseract_loop(details, width, height, 0.18), repeats),
+                     timeit(lambda: process_image_tesseract(details, width, height, 0.18), repeats)))
+        rows.append(("yandex", size // 4,
+                     timeit(lambda: process_ocr_yandex_loop(response, 0.18), repeats),
+                     timeit(lambda: process_ocr_yandex(response, 0.18), repeats)))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Объединение блоков OCR: векторный движок против циклов")
+    parser.add_argument("--words", type=int, nargs="+", default=[2000, 5000, 20000],
+                        help="слов в ответе Tesseract (блоков YandexOCR - в 4 раза меньше)")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    print(f"{'engine':<10}{'blocks':>8}{'loop':>10}{'numpy':>10}   (ms)")
+    for engine, size, loop_ms, numpy_ms in run_benchmark(args.words, args.repeats):
+        print(f"{engine:<10}{size:>8}{loop_ms:>10.2f}{numpy_ms:>10.2f}")
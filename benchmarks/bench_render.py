@@ -0,0 +1,127 @@
+"""
+Время построения визуализаций по движкам: рисование прямо на массиве uint8 (src.render) с кодированием
+в PNG и без него, и прежний способ через фигуру matplotlib (300 dpi, imshow, Rectangle, savefig), если
+matplotlib установлен. Для сравнения выводится время самого решения.
+
+OCR не вызывается: для tesseract и yandex используются блоки из локальной замены YandexOCR, поэтому время
+решения для них - только обработка ответа OCR и изображения.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_render --repeats 3
+"""
+import argparse
+import time
+from io import BytesIO
+import numpy as np
+from benchmarks.corpus import load_corpus
+from benchmarks.yandex_stub import make_response
+from src.image_processing import plot_results, process_image
+from src.render import encode_png, load_rgb, mask_to_rgb
+from src.tesseract import process_image_tesseract
+from src.utils import color_zone_edges, color_zone_regions, draw_color_zones, draw_rectangles_tesseract, \
+    draw_rectangles_yandex, filter_color_zones
+from src.yandex import get_coords_yandex, process_ocr_yandex
+
+
+def matplotlib_overlay(image, boxes) -> BytesIO:
+    """ Прежняя отрисовка: фигура matplotlib размером с изображение, прямоугольники и savefig в PNG """
+    from matplotlib import pyplot as plt, patches
+    dpi = 300
+    height, width = image.shape[:2]
+    fig, ax = plt.subplots(figsize=(width / float(dpi), height / float(dpi)), dpi=dpi)
+    ax.imshow(image)
+    for x1, y1, x2, y2 in boxes:
+        ax.add_patch(patches.Rectangle((x1, y1), x2 - x1, y2 - y1, linewidth=0.8, edgecolor='r', facecolor='none'))
+    ax.axis('off')
+    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+    buf = BytesIO()
+    plt.savefig(buf, format='png')
+    plt.close(fig)
+    return buf
+
+
+def tesseract_details(response):
+    """ Словарь в формате image_to_data из слов ответа YandexOCR """
+    details = {'text': [], 'left': [], 'top': [], 'width': [], 'height': []}
+    for block in response['result']['textAnnotation']['blocks']:
+        for line in block['lines']:
+            for word in line['words']:
+                x1, y1, x2, y2 = get_coords_yandex(word)
+                for key, value in zip(details, (word['text'], x1, y1, x2 - x1, y2 - y1)):
+                    details[key].append(value)
+    return details
+
+
+def timeit(func, repeats):
+    latencies = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start_time)
+    return float(np.median(latencies)) * 1000
+
+
+def run_benchmark(directory="imgs", repeats=3, with_synthetic=True):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+    except ImportError:
+        matplotlib = None
+    rows = {"no_ocr": [], "tesseract": [], "yandex": []}
+    for name, data, _ in load_corpus(directory, with_synthetic):
+        start_time = time.perf_counter()
+        _, bounding_boxes, fill_im = process_image(BytesIO(data))
+        decision_ms = (time.perf_counter() - start_time) * 1000
+        if fill_im is not None:
+            boxes = [(x, y, x + w, y + h) for (x, y, w, h), _ in bounding_boxes]
+            rows["no_ocr"].append((decision_ms,
+                                   timeit(lambda: plot_results(fill_im, bounding_boxes, encode=False), repeats),
+                                   timeit(lambda: plot_results(fill_im, bounding_boxes), repeats),
+                                   timeit(lambda: matplotlib_overlay(mask_to_rgb(fill_im), boxes), repeats)
+                                   if matplotlib else np.nan))
+        response = make_response(data)
+        blocks = response['result']['textAnnotation']['blocks']
+        if not blocks:
+            continue
+        _, result_dict = process_ocr_yandex(response, 0.18)
+        details = tesseract_details(response)
+        text_blocks = result_dict['sentences']
+        coords = [sent["coords"] for sent in text_blocks]
+        start_time = time.perf_counter()
+        edges = color_zone_edges(BytesIO(data))
+        zones_im, regions = color_zone_regions(edges, response)
+        zones = filter_color_zones(regions, edges.shape[1], 0.18)
+        decision_ms = (time.perf_counter() - start_time) * 1000
+        height, width = edges.shape
+        start_time = time.perf_counter()
+        process_image_tesseract(details, width, height, 0.18)
+        rows["tesseract"].append(((time.perf_counter() - start_time) * 1000,
+                                  timeit(lambda: draw_rectangles_tesseract(BytesIO(data), details, text_blocks,
+                                                                           encode=False), repeats),
+                                  timeit(lambda: draw_rectangles_tesseract(BytesIO(data), details, text_blocks),
+                                         repeats),
+                                  timeit(lambda: matplotlib_overlay(load_rgb(BytesIO(data)), coords), repeats)
+                                  if matplotlib else np.nan))
+        rows["yandex"].append((decision_ms,
+                               timeit(lambda: (draw_rectangles_yandex(BytesIO(data), blocks, text_blocks, encode=False),
+                                               draw_color_zones(zones_im, zones)), repeats),
+                               timeit(lambda: (draw_rectangles_yandex(BytesIO(data), blocks, text_blocks),
+                                               encode_png(draw_color_zones(zones_im, zones))), repeats),
+                               timeit(lambda: (matplotlib_overlay(load_rgb(BytesIO(data)), coords),
+                                               matplotlib_overlay(mask_to_rgb(zones_im), zones)), repeats)
+                               if matplotlib else np.nan))
+    return {engine: np.nanmean(np.array(values, dtype=float), axis=0) if values else None
+            for engine, values in rows.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Время построения визуализаций по движкам")
+    parser.add_argument("--images", default="imgs", help="директория корпуса")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--no-synthetic", action="store_true", help="не добавлять синтетические изображения")
+    args = parser.parse_args()
+    result = run_benchmark(args.images, args.repeats, not args.no_synthetic)
+    print(f"{'engine':<10}{'decision':>10}{'array':>10}{'png':>10}{'matplotlib':>12}   (ms)")
+    for engine, values in result.items():
+        if values is not None:
+            print(f"{engine:<10}" + "".join(f"{value:>10.1f}" for value in values[:3]) + f"{values[3]:>12.1f}")
@@ -0,0 +1,199 @@
+"""
+Замер времени и пиковой памяти каждого этапа get_bounding_boxes.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_stages --save benchmarks/baseline_stages.json
+    python -m benchmarks.bench_stages --compare benchmarks/baseline_stages.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from io import BytesIO
+import numpy as np
+import scipy.ndimage as nd
+from PIL import Image
+from skimage.measure import label, regionprops
+from benchmarks.corpus import load_corpus
+from src.image_processing import (BOXES_MAX_SIZE, MAX_LABELS, STRIP_WIDTH, box_confidence, count_side_switches,
+                                  decode_gray, detect_edges, filter_boxes, is_tall, remove_noise, strip_layout,
+                                  strip_owns)
+
+PERCENTILES = (50, 95, 99)
+SIZE_BUCKETS = ((1.0, "<1MP"), (3.0, "1-3MP"), (8.0, "3-8MP"), (float("inf"), ">8MP"))
+
+
+def size_bucket(width, height) -> str:
+    megapixels = width * height / 1e6
+    for limit, name in SIZE_BUCKETS:
+        if megapixels < limit:
+            return name
+
+
+def gray_stages(gray: np.ndarray, page_height=None):
+    """
+    Прогоняет массив uint8 по этапам get_bounding_boxes после декодирования, по очереди отдавая (этап, результат).
+    Возвращает найденные блоки (пустой список, если областей больше MAX_LABELS).
+    """
+    image_height, image_width = gray.shape
+    gray_image = gray / 255.0
+    yield "to_float", gray_image
+    gray_image = remove_noise(gray_image)
+    yield "morphology", gray_image
+    edges = detect_edges(gray_image)
+    yield "canny", edges
+    fill_im = nd.binary_fill_holes(edges)
+    yield "fill_holes", fill_im
+    labeled_image, num_labels = label(fill_im, return_num=True)
+    yield "label", labeled_image
+    if num_labels > MAX_LABELS:
+        return []
+    props = regionprops(labeled_image)
+    boxes = filter_boxes(props, image_width, page_height or image_height)
+    yield "regionprops", boxes
+    return boxes
+
+
+def run_stages(data: bytes):
+    """
+    Прогоняет изображение по этапам get_bounding_boxes, по очереди отдавая (этап, результат). Высокие
+    скриншоты, как и в process_image, обрабатываются полосами (iter_strip_boxes): этапы повторяются для
+    каждой полосы, а после уверенности 1.0 оставшиеся полосы пропускаются.
+    """
+    if not is_tall(BytesIO(data)):
+        image = decode_gray(BytesIO(data), max_size=BOXES_MAX_SIZE)
+        yield "decode", image
+        yield from gray_stages(np.asarray(image))
+        return
+    image = decode_gray(BytesIO(data), max_width=STRIP_WIDTH)
+    yield "decode", image
+    gray = np.asarray(image)
+    tops, strip_height, step = strip_layout(*gray.shape)
+    messages, side_switches, last_side = 0, 0, None
+    for top in tops:
+        boxes = yield from gray_stages(gray[top:top + strip_height], strip_height)
+        boxes = [(box, side) for box, side in boxes if strip_owns(box[1], top == 0, top == tops[-1], step)]
+        switches, last_side = count_side_switches(boxes, last_side)
+        side_switches += switches
+        messages += len(boxes)
+        if box_confidence(messages, side_switches) >= 1.0:
+            return
+
+
+def time_stages(data: bytes):
+    """ Время каждого этапа в секундах """
+    timings = {}
+    stages = run_stages(data)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            stage, _ = next(stages)
+        except StopIteration:
+            break
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - start_time  # у полос этапы суммируются
+    timings["total"] = sum(timings.values())
+    return timings
+
+
+def memory_stages(data: bytes):
+    """ Пиковая память (в МБ), выделенная на каждом этапе (numpy-массивы учитываются tracemalloc) """
+    peaks = {}
+    stages = run_stages(data)
+    tracemalloc.start()
+    try:
+        while True:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            try:
+                stage, _ = next(stages)
+            except StopIteration:
+                break
+            _, peak = tracemalloc.get_traced_memory()
+            peaks[stage] = max(peaks.get(stage, 0), (peak - before) / 2 ** 20)
+    finally:
+        tracemalloc.stop()
+    peaks["total"] = max(peaks.values())
+    return peaks
+
+
+def summarize(values):
+    return {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+
+
+def run_benchmark(directory="imgs", repeats=5, with_synthetic=True):
+    corpus = load_corpus(directory, with_synthetic)
+    timings = defaultdict(lambda: defaultdict(list))  # группа -> этап -> список значений
+    memory = defaultdict(lambda: defaultdict(list))
+    for name, data, _ in corpus:
+        width, height = Image.open(BytesIO(data)).size
+        groups = ("all", size_bucket(width, height))
+        time_stages(data)  # прогревочный прогон
+        for _ in range(repeats):
+            for stage, value in time_stages(data).items():
+                for group in groups:
+                    timings[group][stage].append(value)
+        for stage, value in memory_stages(data).items():
+            for group in groups:
+                memory[group][stage].append(value)
+    report = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(),
+                 "images": len(corpus), "repeats": repeats},
+        "latency_ms": {}, "peak_memory_mb": {},
+    }
+    for group, stages in timings.items():
+        report["latency_ms"][group] = {stage: {k: v * 1000 for k, v in summarize(values).items()}
+                                       for stage, values in stages.items()}
+    for group, stages in memory.items():
+        report["peak_memory_mb"][group] = {stage: max(values) for stage, values in stages.items()}
+    return report
+
+
+def print_report(report) -> None:
+    for group, stages in sorted(report["latency_ms"].items()):
+        print(f"\n[{group}]")
+        print(f"{'stage':<14}" + "".join(f"{'p' + str(p) + ' ms':>12}" for p in PERCENTILES) + f"{'peak MB':>12}")
+        for stage, values in stages.items():
+            peak = report["peak_memory_mb"][group].get(stage, 0)
+            print(f"{stage:<14}" + "".join(f"{values['p' + str(p)]:>12.2f}" for p in PERCENTILES) + f"{peak:>12.1f}")
+
+
+def compare_reports(report, baseline, tolerance=0.2):
+    """ Возвращает список регрессий: этапы, у которых p50 или пиковая память выросли больше чем на tolerance """
+    regressions = []
+    for group, stages in report["latency_ms"].items():
+        for stage, values in stages.items():
+            old = baseline["latency_ms"].get(group, {}).get(stage)
+            if old and values["p50"] > old["p50"] * (1 + tolerance):
+                regressions.append(f"{group}/{stage}: p50 {old['p50']:.2f} -> {values['p50']:.2f} ms")
+    for group, stages in report["peak_memory_mb"].items():
+        for stage, value in stages.items():
+            old = baseline["peak_memory_mb"].get(group, {}).get(stage)
+            if old and value > old * (1 + tolerance):
+                regressions.append(f"{group}/{stage}: peak {old:.1f} -> {value:.1f} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замер латентности и памяти этапов пайплайна без OCR")
+    parser.add_argument("--images", default="imgs", help="директория корпуса")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--no-synthetic", action="store_true", help="не добавлять синтетические изображения")
+    parser.add_argument("--save", help="сохранить отчет в json (базовая линия)")
+    parser.add_argument("--compare", help="сравнить с сохраненной базовой линией")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимый относительный рост метрик")
+    args = parser.parse_args()
+    result = run_benchmark(args.images, args.repeats, not args.no_synthetic)
+    print_report(result)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            found = compare_reports(result, json.load(f), args.tolerance)
+        if found:
+            print("\nРегрессии:\n" + "\n".join(found))
+            sys.exit(1)
+        print("\nРегрессий не найдено")
@@ -0,0 +1,120 @@
+"""
+Холодный старт воркера: время импорта src.pipeline, прогрева (warm_up) и первого и второго запроса classify
+для каждого движка. Каждый замер выполняется в новом процессе python, поэтому учитываются импорты модулей,
+которые загружаются при первом запросе. Для yandex поднимается локальная замена сервиса (benchmarks.yandex_stub).
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_startup --save startup.json
+    python -m benchmarks.bench_startup --compare startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ("cv2", "PIL", "skimage", "scipy", "pytesseract", "tesserocr", "requests")
+STAGES = ("import", "warm_up", "first", "second")
+
+
+def child(path, engine, detector, warm) -> None:
+    """ Замер в дочернем процессе: печатает json со временем этапов (мс) и загруженными тяжелыми модулями """
+    start_time = time.perf_counter()
+    from src.pipeline import classify, warm_up
+    timings = {"import": (time.perf_counter() - start_time) * 1000}
+    modules = {"import": sorted(name for name in HEAVY_MODULES if name in sys.modules)}
+    if warm:
+        start_time = time.perf_counter()
+        warm_up((engine,), detector)
+        timings["warm_up"] = (time.perf_counter() - start_time) * 1000
+    with open(path, "rb") as f:
+        data = f.read()
+    kwargs = {"folder_id": "stub", "api_key": "stub"} if engine == "yandex" else {}
+    for stage in ("first", "second"):
+        start_time = time.perf_counter()
+        classify(data, engine=engine, detector=detector, **kwargs)
+        timings[stage] = (time.perf_counter() - start_time) * 1000
+    modules["first"] = sorted(name for name in HEAVY_MODULES if name in sys.modules)
+    print(json.dumps({"timings": timings, "modules": modules}))
+
+
+def measure(path, engine, detector, warm, url, repeats) -> dict:
+    """ Медиана времени этапов по repeats новым процессам """
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.bench_startup", "--child", path, engine, detector,
+                                 "1" if warm else "0"], check=True, capture_output=True, text=True,
+                                env=dict(os.environ, YANDEX_OCR_URL=url or "")).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    timings = {stage: sorted(run["timings"][stage] for run in runs)[len(runs) // 2]
+               for stage in STAGES if stage in runs[0]["timings"]}
+    return {"timings": timings, "modules": runs[0]["modules"]}
+
+
+def run_benchmark(engines, detectors, repeats=3):
+    from benchmarks.corpus import make_chat_screenshot
+    from benchmarks.yandex_stub import start_stub
+    server, url = start_stub() if "yandex" in engines else (None, None)
+    report = {}
+    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
+        f.write(make_chat_screenshot(1080, 2400, seed=1))
+    try:
+        for engine in engines:
+            for detector in detectors:
+                for warm in (False, True):
+                    name = f"{engine}/{detector}/{'warm' if warm else 'cold'}"
+                    report[name] = measure(f.name, engine, detector, warm, url, repeats)
+    finally:
+        os.unlink(f.name)
+        if server is not None:
+            server.shutdown()
+    return report
+
+
+def print_report(report) -> None:
+    print(f"{'run':<28}" + "".join(f"{stage + ' ms':>14}" for stage in STAGES) + "   modules after import")
+    for name, values in report.items():
+        timings = values["timings"]
+        print(f"{name:<28}" + "".join(f"{timings[stage]:>14.1f}" if stage in timings else f"{'-':>14}"
+                                      for stage in STAGES) + "   " + ",".join(values["modules"]["import"]))
+
+
+def compare_reports(report, baseline, tolerance=0.3):
+    """ Регрессии: время импорта или первого запроса выросло больше чем на tolerance """
+    regressions = []
+    for name, values in report.items():
+        old = baseline.get(name)
+        for stage in ("import", "first"):
+            if old and values["timings"][stage] > old["timings"][stage] * (1 + tolerance):
+                regressions.append(f"{name}/{stage}: {old['timings'][stage]:.1f} -> {values['timings'][stage]:.1f} ms")
+    return regressions
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        path, engine, detector, warm = sys.argv[2:6]
+        child(path, engine, detector, warm == "1")
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description="Время импорта, прогрева и первого запроса в новом процессе")
+    parser.add_argument("--engines", nargs="+", default=["no_ocr", "yandex"],
+                        choices=("no_ocr", "tesseract", "yandex"))
+    parser.add_argument("--detectors", nargs="+", default=["skimage", "opencv"])
+    parser.add_argument("--repeats", type=int, default=3, help="новых процессов на замер (берется медиана)")
+    parser.add_argument("--save", help="сохранить отчет в json (базовая линия)")
+    parser.add_argument("--compare", help="сравнить с сохраненной базовой линией")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="допустимый относительный рост времени")
+    args = parser.parse_args()
+    result = run_benchmark(args.engines, args.detectors, args.repeats)
+    print_report(result)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            found = compare_reports(result, json.load(f), args.tolerance)
+        if found:
+            print("\nРегрессии:\n" + "\n".join(found))
+            sys.exit(1)
+        print("\nРегрессий не найдено")
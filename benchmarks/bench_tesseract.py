@@ -0,0 +1,79 @@
+"""
+Сравнение движков Tesseract: в процессе (tesserocr, долгоживущий TessBaseAPI) и запуск tesseract на каждый
+запрос (pytesseract), по всей странице и только по найденным блокам сообщений (roi). Выводятся задержка,
+доля пикселей, отправленных в OCR, и совпадение распознанных слов с распознаванием всей страницы.
+
+Запуск из корня репозитория (нужны tesseract и модели eng+rus; без них считается только доля пикселей roi):
+    python -m benchmarks.bench_tesseract --repeats 3
+"""
+import argparse
+import time
+from io import BytesIO
+import numpy as np
+import pytesseract
+from benchmarks.corpus import load_corpus
+from src.image_context import ImageContext
+from src.tesseract import TESSERACT_ENGINES, bubble_regions, parse_image_tesseract, parse_image_tesseract_roi, \
+    tesserocr
+
+
+def words(details):
+    return [(text, left, top) for text, left, top in zip(details['text'], details['left'], details['top'])
+            if text.strip() != '']
+
+
+def roi_pixel_share(corpus) -> float:
+    """ Доля пикселей, которые уходят в OCR в режиме roi (без запуска OCR) """
+    sent, total = 0, 0
+    for _, data, _ in corpus:
+        context = ImageContext(data)
+        sent += sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in bubble_regions(context))
+        width, height = context.size
+        total += width * height
+    return sent / total
+
+
+def run_benchmark(directory="imgs", repeats=3, with_synthetic=True):
+    corpus = load_corpus(directory, with_synthetic)
+    engines = TESSERACT_ENGINES if tesserocr is not None else ("cli",)
+    reference = {name: set(text for text, _, _ in words(parse_image_tesseract(BytesIO(data), engine="cli")[0]))
+                 for name, data, _ in corpus}
+    report = {}
+    for engine in engines:
+        for roi in (False, True):
+            parse = parse_image_tesseract_roi if roi else parse_image_tesseract
+            parse(BytesIO(corpus[0][1]), engine=engine)  # прогрев: загрузка моделей
+            latencies, recall = [], []
+            for name, data, _ in corpus:
+                for _ in range(repeats):
+                    start_time = time.perf_counter()
+                    details, _, _ = parse(BytesIO(data), engine=engine)
+                    latencies.append(time.perf_counter() - start_time)
+                found = set(text for text, _, _ in words(details))
+                recall.append(len(found & reference[name]) / len(reference[name]) if reference[name] else 1.0)
+            report[f"{engine}{'+roi' if roi else ''}"] = {
+                "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+                "p95_ms": float(np.percentile(latencies, 95)) * 1000,
+                "words_recall": float(np.mean(recall)),
+            }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сравнение движков Tesseract")
+    parser.add_argument("--images", default="imgs", help="директория корпуса")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--no-synthetic", action="store_true", help="не добавлять синтетические изображения")
+    args = parser.parse_args()
+    print(f"roi pixel share: {roi_pixel_share(load_corpus(args.images, not args.no_synthetic)):.3f}")
+    try:
+        pytesseract.get_tesseract_version()
+    except pytesseract.TesseractNotFoundError:
+        print("tesseract не найден, задержка не измеряется")
+        raise SystemExit(0)
+    if tesserocr is None:
+        print("tesserocr не установлен, измеряется только запуск tesseract на каждый запрос")
+    result = run_benchmark(args.images, args.repeats, not args.no_synthetic)
+    print(f"{'engine':<10}{'p50 ms':>10}{'p95 ms':>10}{'recall':>10}")
+    for name, values in result.items():
+        print(f"{name:<10}{values['p50_ms']:>10.1f}{values['p95_ms']:>10.1f}{values['words_recall']:>10.2f}")
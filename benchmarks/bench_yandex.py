@@ -0,0 +1,116 @@
+"""
+Сравнение способов отправки запросов в YandexOCR на локальной замене сервиса (benchmarks.yandex_stub):
+отдельный requests.post на каждый запрос с исходным файлом, клиент с пулом соединений и уменьшением
+изображения, асинхронный клиент с ограничением одновременных запросов. Отдельно сравнивается весь движок
+yandex: последовательный и с поиском краев во время запроса (pipelined).
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_yandex --latency 0.1 --concurrency 8
+"""
+import argparse
+import asyncio
+import base64
+import os
+import time
+from io import BytesIO
+import numpy as np
+import requests
+from benchmarks.corpus import load_corpus
+from benchmarks.yandex_stub import start_stub
+from src.pipeline import run_yandex
+from src.yandex_client import AsyncYandexOCRClient, YandexOCRClient, mime_type_yandex
+
+
+def bare_request(url, data: bytes):
+    """ Прежний способ: новое соединение на каждый запрос, исходный файл без уменьшения """
+    body = {"mimeType": mime_type_yandex(data), "languageCodes": ["*"], "model": "page",
+            "content": base64.b64encode(data).decode('utf-8')}
+    return requests.post(url, headers={"Authorization": "Api-Key stub", "x-folder-id": "stub"}, json=body).json()
+
+
+def measure(images, call):
+    latencies = []
+    start_time = time.perf_counter()
+    for data in images:
+        request_start = time.perf_counter()
+        call(data)
+        latencies.append(time.perf_counter() - request_start)
+    return time.perf_counter() - start_time, latencies
+
+
+def measure_async(images, async_client):
+    latencies = []
+
+    async def call(data):
+        request_start = time.perf_counter()
+        await async_client.recognize(data)
+        latencies.append(time.perf_counter() - request_start)
+
+    async def call_all():
+        await asyncio.gather(*(call(data) for data in images))
+
+    start_time = time.perf_counter()
+    asyncio.run(call_all())
+    return time.perf_counter() - start_time, latencies
+
+
+def run_benchmark(directory="imgs", with_synthetic=True, latency=0.05, concurrency=8, rounds=3):
+    images = [data for _, data, _ in load_corpus(directory, with_synthetic)] * rounds
+    report = {}
+    for mode in ("bare", "pooled", "async"):
+        server, url = start_stub(latency=latency)
+        client = YandexOCRClient("stub", "stub", url=url, pool_size=concurrency)
+        if mode == "bare":
+            elapsed, latencies = measure(images, lambda data: bare_request(url, data))
+        elif mode == "pooled":
+            elapsed, latencies = measure(images, client.recognize)
+        else:
+            elapsed, latencies = measure_async(images, AsyncYandexOCRClient(client, concurrency))
+        report[mode] = {
+            "total_s": elapsed,
+            "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+            "payload_kb": server.RequestHandlerClass.payload_bytes / len(images) / 1024,
+        }
+        client.close()
+        server.shutdown()
+        server.server_close()
+    return report
+
+
+def run_pipeline_benchmark(directory="imgs", with_synthetic=True, latency=0.3, rounds=3, detector="opencv"):
+    """ Задержка всего движка yandex без перекрытия и с перекрытием запроса и локальной обработки """
+    images = [data for _, data, _ in load_corpus(directory, with_synthetic)]
+    server, url = start_stub(latency=latency)
+    os.environ["YANDEX_OCR_URL"] = url
+    report = {}
+    for data in images:
+        run_yandex(BytesIO(data), "stub", "stub", detector=detector)  # прогрев: ответы сервиса кэшируются
+    for pipelined in (False, True):
+        _, latencies = measure(images * rounds,
+                               lambda data: run_yandex(BytesIO(data), "stub", "stub", detector=detector,
+                                                       pipelined=pipelined))
+        report["pipelined" if pipelined else "sequential"] = {
+            "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+            "p95_ms": float(np.percentile(latencies, 95)) * 1000,
+        }
+    server.shutdown()
+    server.server_close()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сравнение клиентов YandexOCR на локальной замене сервиса")
+    parser.add_argument("--images", default="imgs", help="директория корпуса")
+    parser.add_argument("--no-synthetic", action="store_true", help="не добавлять синтетические изображения")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа сервиса, секунды")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=3, help="сколько раз отправить корпус")
+    args = parser.parse_args()
+    result = run_benchmark(args.images, not args.no_synthetic, args.latency, args.concurrency, args.rounds)
+    print(f"{'mode':<8}{'total s':>10}{'p50 ms':>10}{'payload KB':>12}")
+    for name, values in result.items():
+        print(f"{name:<8}{values['total_s']:>10.2f}{values['p50_ms']:>10.1f}{values['payload_kb']:>12.1f}")
+    result = run_pipeline_benchmark(args.images, not args.no_synthetic, args.latency, args.rounds)
+    print(f"\n{'engine':<12}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, values in result.items():
+        print(f"{name:<12}{values['p50_ms']:>10.1f}{values['p95_ms']:>10.1f}")
@@ -0,0 +1,73 @@
+import os
+import random
+from io import BytesIO
+import numpy as np
+from PIL import Image, ImageDraw
+from src.utils import get_image_files
+
+
+def make_chat_screenshot(width=1080, height=2400, seed=0, image_format="PNG") -> bytes:
+    """ Рисует синтетический скриншот переписки: чередующиеся пузыри сообщений слева и справа """
+    rnd = random.Random(seed)
+    image = Image.new("RGB", (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    message_height = int(width * rnd.uniform(0.12, 0.2))
+    y = int(width * 0.1)
+    side = 0
+    while y + message_height < height - width * 0.1:
+        bubble_width = int(width * rnd.uniform(0.35, 0.65))
+        if side == 0:
+            x, color = int(width * 0.04), (232, 232, 237)
+        else:
+            x, color = width - int(width * 0.04) - bubble_width, (80, 140, 250)
+        draw.rounded_rectangle([x, y, x + bubble_width, y + message_height], radius=message_height // 3, fill=color)
+        for line in range(2):
+            draw.text((x + width * 0.02, y + message_height * (0.2 + 0.35 * line)), "message text", fill=(0, 0, 0))
+        y += message_height + int(width * rnd.uniform(0.03, 0.06))
+        # иногда несколько сообщений подряд с одной стороны
+        if rnd.random() > 0.3:
+            side = 1 - side
+    return encode_image(image, image_format)
+
+
+def make_photo(width=1200, height=900, seed=0, image_format="JPEG") -> bytes:
+    """ Синтетическая "фотография": плавный цветной шум """
+    rng = np.random.default_rng(seed)
+    small = (rng.random((max(height // 16, 1), max(width // 16, 1), 3)) * 255).astype(np.uint8)
+    image = Image.fromarray(small).resize((width, height), Image.BICUBIC)
+    return encode_image(image, image_format)
+
+
+def encode_image(image, image_format) -> bytes:
+    buf = BytesIO()
+    image.save(buf, format=image_format)
+    return buf.getvalue()
+
+
+def synthetic_corpus():
+    """ Набор синтетических изображений разных размеров: (имя, байты, ожидаемая метка) """
+    return [
+        ("synthetic/chat_1080x2400.png", make_chat_screenshot(1080, 2400, seed=1), 1),
+        ("synthetic/chat_1080x2400.jpg", make_chat_screenshot(1080, 2400, seed=2, image_format="JPEG"), 1),
+        ("synthetic/chat_tall_1080x8000.png", make_chat_screenshot(1080, 8000, seed=3), 1),
+        ("synthetic/chat_large_2160x4800.png", make_chat_screenshot(2160, 4800, seed=4), 1),
+        ("synthetic/photo_1200x900.jpg", make_photo(1200, 900, seed=5), 0),
+        ("synthetic/photo_4000x3000.jpg", make_photo(4000, 3000, seed=6), 0),
+    ]
+
+
+def get_label(path) -> int:
+    """ Метка изображения корпуса: 0 - лежит в директории 0 (не переписка), иначе 1 """
+    return 0 if "0" in os.path.normpath(path).split(os.sep)[:-1] else 1
+
+
+def load_corpus(directory="imgs", with_synthetic=True):
+    """ Загружает изображения корпуса в память: список (имя, байты, метка) """
+    corpus = []
+    if os.path.isdir(directory):
+        for path in get_image_files(directory):
+            with open(path, "rb") as f:
+                corpus.append((path, f.read(), get_label(path)))
+    if with_synthetic:
+        corpus.extend(synthetic_corpus())
+    return corpus
@@ -0,0 +1,97 @@
+"""
+Отчет по движку hybrid: как часто уверенность без OCR попадает в полосу неуверенности и вызывается OCR,
+задержка (без OCR всегда, OCR - только при вызове) и точность по разметке корпуса для сетки полос
+в сравнении с no_ocr и OCR на каждом изображении. Движки прогоняются по корпусу один раз, полосы
+считаются по их уверенностям и времени (декодирование в hybrid общее, поэтому его задержка немного ниже).
+
+Без --folder-id / --api-key yandex отвечает локальная замена сервиса (benchmarks.yandex_stub) с задержкой
+--latency: задержка показательна, точность - нет (ответы замены строятся по найденным без OCR блокам).
+
+Запуск из корня репозитория:
+    python -m benchmarks.hybrid_report --images imgs --ocr tesseract
+    python -m benchmarks.hybrid_report --ocr yandex --latency 0.4 --lows 0 0.1 0.2 0.3 --highs 0.8 0.9 1 1.1
+"""
+import argparse
+import os
+import time
+from io import BytesIO
+import numpy as np
+from benchmarks.corpus import load_corpus
+from src.pipeline import HYBRID_BAND, combine_confidence, in_band, run_no_ocr, run_tesseract, run_yandex
+
+
+def measure_engines(corpus, ocr="tesseract", folder_id=None, api_key=None, detector="skimage"):
+    """ Уверенность и время (с) без OCR и OCR для каждого изображения корпуса """
+    rows = []
+    for name, data, label in corpus:
+        start_time = time.perf_counter()
+        pixel = run_no_ocr(BytesIO(data), detector=detector)
+        pixel_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        if ocr == "tesseract":
+            result = run_tesseract(BytesIO(data), detector=detector)
+        else:
+            result = run_yandex(BytesIO(data), folder_id, api_key, detector=detector)
+        rows.append({"name": name, "label": label, "pixel": pixel["confidence"], "pixel_time": pixel_time,
+                     "ocr": result["confidence"], "ocr_time": time.perf_counter() - start_time})
+    return rows
+
+
+def summarize(name, rows, confidences, latencies, escalated, temp=0.7):
+    labels = np.array([row["label"] for row in rows], dtype=bool)
+    latencies = np.array(latencies) * 1000
+    return {"mode": name, "escalation_rate": float(np.mean(escalated)),
+            "accuracy": float(np.mean((np.array(confidences) >= temp) == labels)),
+            "mean_ms": float(latencies.mean()), "p95_ms": float(np.percentile(latencies, 95))}
+
+
+def run_report(rows, lows, highs, temp=0.7):
+    """ Строки отчета: no_ocr, OCR на каждом изображении и hybrid для каждой полосы [low, high) """
+    report = [summarize("no_ocr", rows, [row["pixel"] for row in rows], [row["pixel_time"] for row in rows],
+                        [False] * len(rows), temp),
+              summarize("ocr", rows, [row["ocr"] for row in rows], [row["ocr_time"] for row in rows],
+                        [True] * len(rows), temp)]
+    for low in lows:
+        for high in highs:
+            if high <= low:
+                continue
+            escalated = [in_band(row["pixel"], (low, high)) for row in rows]
+            confidences = [combine_confidence(row["pixel"], row["ocr"]) if flag else row["pixel"]
+                           for row, flag in zip(rows, escalated)]
+            latencies = [row["pixel_time"] + (row["ocr_time"] if flag else 0) for row, flag in zip(rows, escalated)]
+            report.append(summarize(f"hybrid [{low:g}, {high:g})", rows, confidences, latencies, escalated, temp))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Доля вызовов OCR, задержка и точность движка hybrid")
+    parser.add_argument("--images", default="imgs", help="директория корпуса")
+    parser.add_argument("--no-synthetic", action="store_true", help="не добавлять синтетические изображения")
+    parser.add_argument("--ocr", default="tesseract", choices=("tesseract", "yandex"))
+    parser.add_argument("--folder-id", default=os.environ.get("YANDEX_FOLDER_ID"))
+    parser.add_argument("--api-key", default=os.environ.get("YANDEX_API_KEY"))
+    parser.add_argument("--latency", type=float, default=0.3, help="задержка локальной замены YandexOCR, секунды")
+    parser.add_argument("--detector", default="skimage")
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--lows", type=float, nargs="+", default=[0.0, 0.1, HYBRID_BAND[0], 0.3])
+    parser.add_argument("--highs", type=float, nargs="+", default=[0.8, 0.9, HYBRID_BAND[1], 1.1],
+                        help="верхняя граница больше 1 - OCR вызывается и при уверенности 1.0")
+    args = parser.parse_args()
+    server = None
+    if args.ocr == "yandex" and not (args.folder_id and args.api_key):
+        from benchmarks.yandex_stub import start_stub
+        server, url = start_stub(latency=args.latency)
+        os.environ["YANDEX_OCR_URL"] = url
+        args.folder_id, args.api_key = "stub", "stub"
+    try:
+        engine_rows = measure_engines(load_corpus(args.images, not args.no_synthetic), args.ocr, args.folder_id,
+                                      args.api_key, args.detector)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    print(f"images: {len(engine_rows)}, ocr: {args.ocr}, threshold: {args.threshold}")
+    print(f"{'mode':<20}{'escalated':>10}{'accuracy':>10}{'mean ms':>10}{'p95 ms':>10}")
+    for row in run_report(engine_rows, args.lows, args.highs, args.threshold):
+        print(f"{row['mode']:<20}{row['escalation_rate']:>10.2f}{row['accuracy']:>10.2f}{row['mean_ms']:>10.1f}"
+              f"{row['p95_ms']:>10.1f}")
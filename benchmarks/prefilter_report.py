@@ -0,0 +1,55 @@
+"""
+Отчет по предварительному фильтру: как часто он отсекает изображения, сколько времени экономит
+и как часто расходится с полным пайплайном и с разметкой корпуса.
+
+Запуск из корня репозитория:
+    python -m benchmarks.prefilter_report --images imgs
+"""
+import argparse
+import time
+from io import BytesIO
+from benchmarks.corpus import load_corpus
+from src.image_processing import process_image
+from src.prefilter import make_thumbnail, prefilter
+
+
+def run_report(directory="imgs", with_synthetic=True, temp=0.7, verbose=False):
+    corpus = load_corpus(directory, with_synthetic)
+    rows = []
+    for name, data, label in corpus:
+        start_time = time.perf_counter()
+        thumbnail, _ = make_thumbnail(BytesIO(data))
+        is_candidate, rejection_confidence, features = prefilter(thumbnail)
+        prefilter_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        confidence, _, _ = process_image(BytesIO(data))
+        full_time = time.perf_counter() - start_time
+        rows.append({"name": name, "label": label, "rejected": not is_candidate, "full_verdict": confidence >= temp,
+                     "prefilter_time": prefilter_time, "full_time": full_time, "features": features})
+        if verbose:
+            print(name, "rejected" if not is_candidate else "passed", features)
+    rejected = [row for row in rows if row["rejected"]]
+    # время каскада: фильтр всегда, полный пайплайн - только для прошедших фильтр
+    cascade_time = sum(row["prefilter_time"] + (0 if row["rejected"] else row["full_time"]) for row in rows)
+    return {
+        "images": len(rows),
+        "short_circuit_rate": len(rejected) / len(rows) if rows else 0,
+        # фильтр отсек изображение, которое полный пайплайн считает перепиской
+        "disagreements_with_full": [row["name"] for row in rejected if row["full_verdict"]],
+        # фильтр отсек изображение, размеченное как переписка
+        "false_rejections": [row["name"] for row in rejected if row["label"] == 1],
+        "mean_prefilter_ms": 1000 * sum(row["prefilter_time"] for row in rows) / max(len(rows), 1),
+        "mean_full_ms": 1000 * sum(row["full_time"] for row in rows) / max(len(rows), 1),
+        "mean_cascade_ms": 1000 * cascade_time / max(len(rows), 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отчет по предварительному фильтру")
+    parser.add_argument("--images", default="imgs", help="директория корпуса")
+    parser.add_argument("--no-synthetic", action="store_true", help="не добавлять синтетические изображения")
+    parser.add_argument("--verbose", action="store_true", help="печатать признаки каждого изображения")
+    args = parser.parse_args()
+    report = run_report(args.images, not args.no_synthetic, verbose=args.verbose)
+    for key, value in report.items():
+        print(f"{key}: {value}")
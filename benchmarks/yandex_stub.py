@@ -0,0 +1,100 @@
+"""
+Локальная замена YandexOCR для тестов и бенчмарков клиента без сети и платных запросов.
+
+Принимает тот же запрос, что и recognizeText, находит блоки сообщений без OCR и возвращает их в формате
+ответа YandexOCR (координаты - в пикселях присланного изображения). Можно задать задержку ответа
+и количество первых запросов, на которые сервер отвечает 503.
+
+Запуск из корня репозитория:
+    python -m benchmarks.yandex_stub --port 8081 --latency 0.3
+    YandexOCRClient(api_key, folder_id, url="http://127.0.0.1:8081/ocr/v1/recognizeText")
+"""
+import argparse
+import base64
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Dict
+from PIL import Image
+from src.image_processing import BOX_DETECTORS, BOXES_MAX_SIZE, scaled_size
+
+
+def make_response(data: bytes) -> Dict:
+    """ Ответ в формате recognizeText: по блоку с одной строкой и словом на каждый найденный блок сообщения """
+    width, height = Image.open(BytesIO(data)).size
+    scale = width / scaled_size(width, height, BOXES_MAX_SIZE)[0]
+    bounding_boxes, _ = BOX_DETECTORS["opencv"](BytesIO(data))
+    blocks = []
+    for (x, y, box_width, box_height), _ in bounding_boxes:
+        x1, y1 = round(x * scale), round(y * scale)
+        x2, y2 = round((x + box_width) * scale), round((y + box_height) * scale)
+        bounding_box = {"vertices": [{"x": str(x1), "y": str(y1)}, {"x": str(x1), "y": str(y2)},
+                                     {"x": str(x2), "y": str(y2)}, {"x": str(x2), "y": str(y1)}]}
+        word = {"boundingBox": bounding_box, "text": "сообщение"}
+        blocks.append({"boundingBox": bounding_box,
+                       "lines": [{"boundingBox": bounding_box, "text": "сообщение", "words": [word]}]})
+    return {"result": {"textAnnotation": {"width": str(width), "height": str(height), "blocks": blocks,
+                                          "fullText": "\n".join("сообщение" for _ in blocks)}}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0  # задержка ответа, секунды
+    fail_first = 0  # количество первых запросов, на которые отвечаем 503
+    requests_count = 0
+    payload_bytes = 0
+    lock = threading.Lock()
+    responses = {}  # хэш изображения -> ответ, чтобы повторные запросы не тратили процессор бенчмарка
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        cls = type(self)
+        with cls.lock:
+            cls.requests_count += 1
+            cls.payload_bytes += len(body.get("content", ""))
+            failing = cls.requests_count <= cls.fail_first
+        time.sleep(self.latency)
+        if not self.headers.get("Authorization"):
+            return self.send_json(401, {"error": "no api key", "code": 16})
+        if failing:
+            return self.send_json(503, {"error": "unavailable", "code": 14})
+        key = hashlib.sha1(body["content"].encode('ascii')).hexdigest()
+        if key not in cls.responses:
+            cls.responses[key] = make_response(base64.b64decode(body["content"]))
+        self.send_json(200, cls.responses[key])
+
+    def send_json(self, status, value) -> None:
+        body = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port=0, latency=0.0, fail_first=0, host="127.0.0.1"):
+    """ Запускает сервер в фоновом потоке; возвращает сервер и url для YandexOCRClient """
+    handler = type("Handler", (StubHandler,), {"latency": latency, "fail_first": fail_first, "requests_count": 0,
+                                               "payload_bytes": 0, "lock": threading.Lock(), "responses": {}})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/ocr/v1/recognizeText"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная замена YandexOCR")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, секунды")
+    parser.add_argument("--fail-first", type=int, default=0, help="сколько первых запросов завершить ошибкой 503")
+    args = parser.parse_args()
+    stub, url = start_stub(args.port, args.latency, args.fail_first, host="0.0.0.0")
+    print(f"serving {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub.shutdown()
@@ -0,0 +1,92 @@
+import argparse
+import json
+import sys
+import time
+from typing import Dict, List
+import numpy as np
+from benchmarks.corpus import load_corpus
+from src.calibration import RULE_PARAMS, WEIGHT_PARAMS, collect_regions, sweep
+from src.image_processing import BOX_DETECTORS, BOXES_MAX_SIZE
+from src.ocr_store import OCRStore, image_hash
+
+
+def load_regions(corpus, detector, max_size, store=None) -> List[Dict]:
+    """ Статистики областей каждого изображения корпуса; с store они считаются только один раз """
+    config = {"detector": detector, "max_size": max_size}
+    records = []
+    for name, data, _ in corpus:
+        record = store.get(image_hash(data), "regions", config) if store is not None else None
+        if record is None:
+            record = collect_regions(data, detector, max_size)
+            if store is not None:
+                store.put(image_hash(data), "regions", config, record)
+        records.append(record)
+    return records
+
+
+def report(result: Dict, index, threshold_index, thresholds, names) -> Dict:
+    """ Строка отчета для сочетания параметров index и порога threshold_index """
+    row = {name: round(float(result[name][index]), 4) for name in names}
+    row["threshold"] = round(float(thresholds[threshold_index]), 4)
+    for metric in ("accuracy", "tpr", "fpr"):
+        row[metric] = round(float(result[metric][index, threshold_index]), 4)
+    row["auc"] = round(float(result["auc"][index]), 4)
+    return row
+
+
+def calibrate(records, labels, rule_axes, weight_axes, thresholds, top=5, roc=False) -> List[Dict]:
+    """ Лучшие по точности сочетания параметров и значения при текущих параметрах кода """
+    start_time = time.perf_counter()
+    result = sweep(records, labels, rule_axes, weight_axes, thresholds)
+    elapsed = time.perf_counter() - start_time
+    names = list(rule_axes) + list(weight_axes)
+    latencies = np.array([record["seconds"] for record in records]) * 1000
+    summary = {"settings": len(result["auc"]) * len(thresholds), "sweep_seconds": round(elapsed, 3),
+               "latency_p50_ms": round(float(np.percentile(latencies, 50)), 1),
+               "latency_p95_ms": round(float(np.percentile(latencies, 95)), 1)}
+    rows = []
+    # при равной точности выше AUC, затем больший запас (меньший FPR)
+    accuracy = result["accuracy"]
+    auc = np.nan_to_num(result["auc"])[:, None].repeat(len(thresholds), axis=1)
+    order = np.lexsort((result["fpr"].ravel(), -auc.ravel(), -accuracy.ravel()))
+    for rank, flat_index in enumerate(order[:top]):
+        index, threshold_index = np.unravel_index(flat_index, accuracy.shape)
+        row = {"setting": f"top{rank + 1}", **summary, **report(result, index, threshold_index, thresholds, names)}
+        if roc and rank == 0:
+            row["roc"] = [[round(float(t), 4), round(float(tpr), 4), round(float(fpr), 4)]
+                          for t, tpr, fpr in zip(thresholds, result["tpr"][index], result["fpr"][index])]
+        rows.append(row)
+    current = sweep(records, labels, {name: [value] for name, value in RULE_PARAMS.items()},
+                    {name: [value] for name, value in WEIGHT_PARAMS.items()}, thresholds)
+    for threshold_index in range(len(thresholds)):
+        rows.append({"setting": "current", **summary, **report(current, 0, threshold_index, thresholds, names)})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Подбор параметров process_image по корпусу с разметкой: "
+                                                 "области изображений считаются один раз, сетка - массивами")
+    parser.add_argument("--images", default="imgs", help="директория корпуса (изображения в 0 - не переписка)")
+    parser.add_argument("--no-synthetic", action="store_true", help="не добавлять синтетические изображения")
+    parser.add_argument("--store", default=None, help="файл sqlite для кэша статистик областей (OCRStore)")
+    parser.add_argument("--detector", nargs="+", default=["skimage"], choices=BOX_DETECTORS)
+    parser.add_argument("--max-size", type=int, nargs="+", default=[BOXES_MAX_SIZE],
+                        help="наибольшая сторона изображения при поиске блоков (скорость / точность)")
+    for name, value in {**RULE_PARAMS, **WEIGHT_PARAMS}.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=float, nargs="+", default=[value])
+    parser.add_argument("--threshold", type=float, nargs="+", default=[0.7])
+    parser.add_argument("--top", type=int, default=5, help="сколько лучших сочетаний выводить для каждой конфигурации")
+    parser.add_argument("--roc", action="store_true", help="добавить ROC (порог, TPR, FPR) лучшего сочетания")
+    args = parser.parse_args()
+    corpus = load_corpus(args.images, not args.no_synthetic)
+    if not corpus:
+        sys.exit(f"В {args.images} нет изображений")
+    labels = [label for _, _, label in corpus]
+    store = OCRStore(args.store) if args.store else None
+    rule_axes = {name: getattr(args, name) for name in RULE_PARAMS}
+    weight_axes = {name: getattr(args, name) for name in WEIGHT_PARAMS}
+    for detector in args.detector:
+        for max_size in args.max_size:
+            records = load_regions(corpus, detector, max_size, store)
+            for row in calibrate(records, labels, rule_axes, weight_axes, args.threshold, args.top, args.roc):
+                print(json.dumps({"detector": detector, "max_size": max_size, **row}))
@@ -0,0 +1,76 @@
+import argparse
+import itertools
+import json
+import sys
+import time
+from typing import Dict, List
+from benchmarks.corpus import get_label
+from src.ocr_store import OCRStore, image_hash
+from src.pipeline import score_tesseract, score_yandex
+from src.utils import get_image_files
+
+
+def load_labels(directory) -> Dict[str, int]:
+    """ Метки корпуса по хэшу изображения (0 - изображение лежит в директории 0) """
+    labels = {}
+    for path in get_image_files(directory):
+        with open(path, "rb") as f:
+            labels[image_hash(f.read())] = get_label(path)
+    return labels
+
+
+def load_records(store: OCRStore, engine, detector="skimage", roi=False) -> Dict[str, Dict]:
+    """ Сохраненные ответы OCR по хэшу изображения; для yandex к ответу добавляются области get_color_zones """
+    if engine == "tesseract":
+        return {data_hash: value for data_hash, config, value in store.records("tesseract")
+                if config.get("roi", False) == roi}
+    zones = {data_hash: value for data_hash, _, value in store.records("color_zones", {"detector": detector})}
+    return {data_hash: {"response": value, "zones": zones[data_hash]}
+            for data_hash, _, value in store.records("yandex") if data_hash in zones}
+
+
+def rescore(records: Dict[str, Dict], engine, block_percentiles, reduce_factors, thresholds,
+            labels=None) -> List[Dict]:
+    """ Пересчитывает уверенность для каждой комбинации параметров без OCR и обработки изображений """
+    rows = []
+    for block_percentile, reduce_factor in itertools.product(block_percentiles, reduce_factors):
+        start_time = time.perf_counter()
+        confidences = {}
+        for data_hash, record in records.items():
+            if engine == "tesseract":
+                result = score_tesseract(record, block_percentile, reduce_factor)
+            else:
+                result = score_yandex(record["response"], record["zones"], block_percentile, reduce_factor)
+            confidences[data_hash] = result["confidence"]
+        elapsed = time.perf_counter() - start_time
+        for temp in thresholds:
+            row = {"block_percentile": block_percentile, "reduce_factor": reduce_factor, "threshold": temp,
+                   "images": len(confidences), "conversations": int(sum(c >= temp for c in confidences.values())),
+                   "seconds": round(elapsed, 3)}
+            labeled = [(c, labels[h]) for h, c in confidences.items() if labels and h in labels]
+            if labeled:
+                correct = int(sum((c >= temp) == bool(label) for c, label in labeled))
+                row["accuracy"] = round(correct / len(labeled), 4)
+            rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пересчет уверенности по сохраненным ответам OCR (без сети и OCR)")
+    parser.add_argument("store", help="файл OCRStore (batch.py --ocr-store)")
+    parser.add_argument("--engine", default="yandex", choices=("tesseract", "yandex"))
+    parser.add_argument("--images", default=None, help="директория корпуса для подсчета точности")
+    parser.add_argument("--block-percentile", type=float, nargs="+", default=[0.18])
+    parser.add_argument("--reduce-factor", type=float, nargs="+", default=None,
+                        help="по умолчанию 1.37 для tesseract и 1.5 для yandex")
+    parser.add_argument("--threshold", type=float, nargs="+", default=[0.7])
+    parser.add_argument("--detector", default="skimage", help="реализация поиска блоков, с которой записаны области")
+    parser.add_argument("--roi", action="store_true", help="tesseract: использовать записи режима roi")
+    args = parser.parse_args()
+    reduce_factors = args.reduce_factor or [1.37 if args.engine == "tesseract" else 1.5]
+    records = load_records(OCRStore(args.store, mode="replay"), args.engine, args.detector, args.roi)
+    if not records:
+        sys.exit(f"В {args.store} нет записей {args.engine}")
+    labels = load_labels(args.images) if args.images else None
+    for row in rescore(records, args.engine, args.block_percentile, reduce_factors, args.threshold, labels):
+        print(json.dumps(row))
@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from src import metrics
+from src.cache import VerdictCache
+from src.image_context import ImageContext, InvalidImage
+from src.image_processing import BOX_DETECTORS
+from src.pipeline import ENGINES, OCR_ENGINES, SCORERS, classify_bytes, hybrid_ocr_engine, warm_up, get_cached, \
+    put_cached
+from src.scheduler import DeadlineExceeded, Overloaded, Scheduler
+from src.scorer import get_model
+
+MAX_BODY_SIZE = 20 * 1024 * 1024  # максимальный размер загружаемого изображения
+REQUEST_TIMEOUT = 30  # сколько секунд ждем ответа воркера
+DEADLINE = None  # срок ответа по умолчанию (None - без срока), после него OCR заменяется вердиктом без OCR
+FALLBACK_DETECTOR = "opencv"  # запасной вердикт считается быстрой реализацией
+QUEUE_PER_WORKER = 4  # принятых запросов на воркер, сверх этого запросы отклоняются (503)
+
+
+class ClassifyHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик HTTP-запросов.
+
+    POST /classify?engine=no_ocr&threshold=0.7&detector=skimage&prefilter=0&roi=0 - в теле запроса байты изображения,
+    для YandexOCR folder_id и api_key передаются в заголовках X-Folder-Id и X-Api-Key. deadline - срок ответа
+    в секундах для движков с OCR: если OCR не успел, отдается вердикт без OCR с "degraded": true; no_ocr срок
+    не ограничивает. При заполненной очереди - 503, если тело не изображение - 400.
+    engine=hybrid&ocr=tesseract - OCR только при неуверенном решении без OCR (по умолчанию yandex при наличии ключей).
+    scorer=model - уверенность без OCR по признакам изображения обученной моделью (src.scorer).
+    GET /health - проверка доступности сервиса.
+    GET /metrics - метрики в текстовом формате Prometheus.
+    """
+    scheduler = None  # Scheduler над пулом прогретых процессов, задается в serve()
+    deadline = DEADLINE
+    cache = None  # кэш результатов по содержимому изображения, задается в serve()
+
+    def send_body(self, status, body: bytes, content_type, headers=None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload, headers=None) -> None:
+        self.send_body(status, json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+                       "application/json; charset=utf-8", headers)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif path == "/metrics":
+            self.send_body(200, metrics.render_prometheus().encode('utf-8'), "text/plain; version=0.0.4")
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/classify":
+            self.send_json(404, {"error": "not found"})
+            return
+        query = parse_qs(url.query)
+        engine = query.get("engine", ["no_ocr"])[0]
+        if engine not in ENGINES:
+            self.send_json(400, {"error": f"unknown engine {engine}, expected one of {', '.join(ENGINES)}"})
+            return
+        detector = query.get("detector", ["skimage"])[0]
+        if detector not in BOX_DETECTORS:
+            self.send_json(400, {"error": f"unknown detector {detector}, expected one of {', '.join(BOX_DETECTORS)}"})
+            return
+        prefilter = query.get("prefilter", ["0"])[0] in ("1", "true")
+        roi = query.get("roi", ["0"])[0] in ("1", "true")
+        try:
+            temp = float(query.get("threshold", ["0.7"])[0])
+            block_percentile = float(query.get("block_percentile", ["0.18"])[0])
+            deadline = float(query.get("deadline", [self.deadline or 0])[0])
+        except ValueError:
+            self.send_json(400, {"error": "threshold, block_percentile and deadline must be float"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length <= 0:
+            self.send_json(400, {"error": "empty body, image bytes expected"})
+            return
+        if length > MAX_BODY_SIZE:
+            self.send_json(413, {"error": "image is too large"})
+            return
+        data = self.rfile.read(length)
+        try:
+            ImageContext(data)  # читается только заголовок: не изображение - ошибка запроса, а не сервиса
+        except InvalidImage as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        scorer = query.get("scorer", ["rules"])[0]
+        if scorer not in SCORERS:
+            self.send_json(400, {"error": f"unknown scorer {scorer}, expected one of {', '.join(SCORERS)}"})
+            return
+        if scorer == "model":
+            try:
+                get_model()  # версия модели входит в ключ кэша, без файла модели запрос не выполнить
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+                return
+        params = {"block_percentile": block_percentile, "detector": detector, "prefilter": prefilter, "roi": roi,
+                  "scorer": scorer}
+        if engine == "hybrid":
+            params["ocr_engine"] = hybrid_ocr_engine(self.headers.get("X-Folder-Id"), self.headers.get("X-Api-Key"),
+                                                     query.get("ocr", [None])[0])
+            if params["ocr_engine"] not in OCR_ENGINES:
+                self.send_json(400, {"error": f"unknown ocr {params['ocr_engine']}, expected one of "
+                                              f"{', '.join(OCR_ENGINES)}"})
+                return
+        if (engine == "yandex" or params.get("ocr_engine") == "yandex") and \
+                not (self.headers.get("X-Folder-Id") and self.headers.get("X-Api-Key")):
+            self.send_json(400, {"error": "X-Folder-Id and X-Api-Key headers are required for yandex"})
+            return
+        if self.cache is not None:
+            result = get_cached(self.cache, data, engine, temp, **params)
+            if result is not None:
+                metrics.inc("cache_hits", engine=engine)
+                metrics.inc("requests", engine=engine, verdict="yes" if result["is_conversation"] else "no")
+                self.send_json(200, result)
+                return
+            metrics.inc("cache_misses", engine=engine)
+        call = partial(classify_bytes, data, engine=engine, temp=temp, **params,
+                       folder_id=self.headers.get("X-Folder-Id"), api_key=self.headers.get("X-Api-Key"))
+        fallback = None
+        if engine != "no_ocr":
+            fallback = partial(classify_bytes, data, engine="no_ocr", temp=temp, block_percentile=block_percentile,
+                               detector=FALLBACK_DETECTOR)
+        # без запасного варианта (no_ocr) и без срока ждем воркер до REQUEST_TIMEOUT
+        deadline = min(deadline, REQUEST_TIMEOUT) if deadline > 0 and fallback is not None else REQUEST_TIMEOUT
+        try:
+            result = self.scheduler.run(call, deadline, fallback, engine)
+        except Overloaded as e:
+            self.send_json(503, {"error": str(e)}, {"Retry-After": "1"})
+            return
+        except DeadlineExceeded as e:
+            self.send_json(504, {"error": str(e)})
+            return
+        except InvalidImage as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            metrics.inc("errors", engine=engine)
+            self.send_json(500, {"error": str(e)})
+            return
+        # этапы (и запасного варианта) выполнялись в дочернем процессе, переносим их метрики в процесс сервиса
+        metrics.record(result["engine"], result["timings"], result["counters"])
+        if not result["degraded"] and self.cache is not None:
+            put_cached(self.cache, data, result, **params)
+        metrics.inc("requests", engine=engine, verdict="yes" if result["is_conversation"] else "no")
+        self.send_json(200, result)
+
+
+def warm_worker(engines) -> None:
+    """ Прогрев воркера: выбранные движки и запасной вариант, который выполняется в тех же воркерах """
+    warm_up(engines)
+    warm_up(("no_ocr",), FALLBACK_DETECTOR)
+
+
+def serve(host="0.0.0.0", port=8000, workers=None, warm_engines=("no_ocr",), cache=None, deadline=DEADLINE,
+          max_queue=None) -> None:
+    """
+    Поднимает HTTP-сервис с пулом заранее прогретых процессов.
+    deadline - срок ответа движков с OCR по умолчанию (None или 0 - ждать до REQUEST_TIMEOUT), max_queue - сколько
+    задач принимается одновременно (по умолчанию QUEUE_PER_WORKER на воркер).
+    """
+    workers = workers or os.cpu_count() or 1
+    ClassifyHandler.cache = cache
+    ClassifyHandler.deadline = deadline
+    with ProcessPoolExecutor(max_workers=workers, initializer=partial(warm_worker, warm_engines)) as pool:
+        # заставляем все процессы стартовать и прогреться до первого запроса
+        list(pool.map(int, range(workers)))
+        ClassifyHandler.scheduler = Scheduler(pool, max_queue or workers * QUEUE_PER_WORKER)
+        server = ThreadingHTTPServer((host, port), ClassifyHandler)
+        print(f"Сервис запущен на http://{host}:{port}, воркеров: {workers}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP-сервис определения переписки на скриншотах")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None, help="количество процессов (по умолчанию - число ядер)")
+    parser.add_argument("--warm", nargs="*", default=["no_ocr"], choices=ENGINES,
+                        help="движки, которые прогреваются при старте воркера")
+    parser.add_argument("--cache-size", type=int, default=512, help="размер LRU-кэша в памяти (0 - без кэша)")
+    parser.add_argument("--cache-dir", default=None, help="директория дискового кэша")
+    parser.add_argument("--cache-max-mb", type=int, default=256, help="предельный размер дискового кэша")
+    parser.add_argument("--deadline", type=float, default=DEADLINE,
+                        help="срок ответа движков с OCR в секундах (по умолчанию без срока), после него OCR "
+                             "заменяется вердиктом без OCR")
+    parser.add_argument("--max-queue", type=int, default=None,
+                        help="сколько запросов принимается одновременно, остальные получают 503")
+    args = parser.parse_args()
+    verdict_cache = None
+    if args.cache_size > 0:
+        verdict_cache = VerdictCache(args.cache_size, args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    serve(args.host, args.port, args.workers, tuple(args.warm), verdict_cache, args.deadline, args.max_queue)
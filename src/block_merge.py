@@ -0,0 +1,127 @@
+from typing import Dict, List, Optional
+import numpy as np
+
+# класс блока по положению и сторона сообщения (индекс в SIDE_NAMES)
+MIDDLE, LEFT, RIGHT, NO_SIDE = 0, 1, 2, 3
+SIDE_NAMES = ("middle", "response", "user", "")
+LINE_GAP = 0.02  # блоки ближе этой доли высоты изображения к предыдущему относятся к тому же сообщению
+
+# Правила объединения, повторяющие прежние циклы process_image_tesseract и process_ocr_yandex:
+# seed - координаты и сторона пустого сообщения до первого блока,
+# expand_x1 / expand_y1 - классы блоков, расширяющие сообщение влево / вверх (вправо и вниз расширяют все),
+# side_flips - (класс блока, делить ли block_percentile на reduce_factor): блок LEFT / RIGHT переводит
+# расширенное им сообщение на свою сторону, если сообщение целиком у левого / правого края,
+# emit_middle - сообщения посередине попадают в результат,
+# emit_before_user - сообщение перед новым сообщением справа попадает в результат без проверок.
+TESSERACT_RULES = {"seed": (0, 0, 0, -100), "seed_side": NO_SIDE, "expand_x1": (LEFT, RIGHT, MIDDLE),
+                   "expand_y1": (RIGHT,), "side_flips": ((LEFT, False), (RIGHT, False)), "emit_middle": True,
+                   "emit_before_user": False}
+YANDEX_RULES = {"seed": (0, 0, 0, 0), "seed_side": MIDDLE, "expand_x1": (RIGHT, MIDDLE), "expand_y1": (RIGHT,),
+                "side_flips": ((RIGHT, True),), "emit_middle": False, "emit_before_user": True}
+
+
+def classify_sides(left, right, image_width, block_percentile) -> np.ndarray:
+    """ LEFT - левая граница в левой зоне, RIGHT - правая граница в правой зоне, иначе MIDDLE """
+    return np.where(left < image_width * block_percentile, LEFT,
+                    np.where(right > image_width * (1 - block_percentile), RIGHT, MIDDLE))
+
+
+def keep_blocks(top, bottom, skip, gap, seed_bottom) -> np.ndarray:
+    """
+    Маска блоков, которые не пропускаются: блок из skip (отметка времени) пропускается, если он близко к
+    предыдущему. Нижняя граница предыдущего сообщения - максимум нижних границ оставленных блоков,
+    поэтому цикл идет только по блокам из skip.
+    """
+    keep = np.ones(len(top), dtype=bool)
+    before = np.maximum.accumulate(np.concatenate(([seed_bottom], np.where(skip, seed_bottom, bottom))))[:-1]
+    indexes = np.flatnonzero(skip)
+    kept_bottom = int(seed_bottom)
+    for i, block_top, block_bottom, previous in zip(indexes.tolist(), top[indexes].tolist(),
+                                                   bottom[indexes].tolist(), before[indexes].tolist()):
+        if block_top < max(previous, kept_bottom) + gap:
+            keep[i] = False
+        else:
+            kept_bottom = max(kept_bottom, block_bottom)
+    return keep
+
+
+def segment_accumulate(values, group, ufunc) -> np.ndarray:
+    """ Накопленный максимум (ufunc=np.maximum) или минимум (np.minimum) отдельно внутри каждой группы """
+    sign = 1 if ufunc is np.maximum else -1
+    values = sign * values
+    low = values.min()
+    span = values.max() - low + 1
+    # сдвиг на номер группы: значения следующей группы всегда больше значений предыдущих
+    shifted = values - low + group * span
+    return sign * (np.maximum.accumulate(shifted) - group * span + low)
+
+
+def merge_blocks(boxes, classes, texts: List[str], image_width, image_height, block_percentile, reduce_factor,
+                 rules: Dict, skip: Optional[np.ndarray] = None) -> List[Dict]:
+    """
+    Объединяет блоки OCR в сообщения операциями над массивами.
+
+    :param boxes: массив (n, 4) координат x1, y1, x2, y2 блоков в порядке чтения (координаты неотрицательные).
+    :param classes: результат classify_sides для блоков.
+    :param texts: текст каждого блока (с пробелом в конце, как он добавляется к сообщению).
+    :param rules: TESSERACT_RULES или YANDEX_RULES.
+    :param skip: блоки, пропускаемые, если они близко к предыдущему (отметки времени YandexOCR).
+    :return: список сообщений {"text", "coords", "side"} - как у прежних циклов по блокам.
+    """
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    classes = np.asarray(classes)
+    seed = np.array(rules["seed"], dtype=np.int64)
+    gap = image_height * LINE_GAP
+    if skip is not None and skip.any():
+        keep = keep_blocks(boxes[:, 1], boxes[:, 3], skip, gap, seed[3])
+        boxes, classes = boxes[keep], classes[keep]
+        texts = [text for text, kept in zip(texts, keep.tolist()) if kept]
+    if len(boxes) == 0:
+        return []
+    # новое сообщение начинается с блока, который не близко к нижней границе текущего; она - накопленный максимум
+    # нижних границ, так как начинающий сообщение блок всегда ниже всех предыдущих
+    before = np.maximum.accumulate(np.concatenate(([seed[3]], boxes[:, 3])))[:-1]
+    start = boxes[:, 1] >= before + gap
+    # первый блок у края начинает сообщение всегда, а близкий к началу блок посередине дополняет пустое
+    # начальное сообщение - его добавляем отдельной строкой с координатами seed
+    start[0] |= classes[0] != MIDDLE
+    if not start[0]:
+        boxes = np.vstack((seed, boxes))
+        classes = np.concatenate(([rules["seed_side"]], classes))
+        texts = [""] + list(texts)
+        start = np.concatenate(([True], start))
+    group = np.cumsum(start) - 1
+    starts = np.flatnonzero(start)
+    ends = np.append(starts[1:], len(boxes)) - 1
+    x1, y1, x2, y2 = boxes.T
+    # блоки, не расширяющие сообщение влево / вверх, заменяются первым блоком сообщения
+    x1 = np.where(start | np.isin(classes, rules["expand_x1"]), x1, x1[starts][group])
+    y1 = np.where(start | np.isin(classes, rules["expand_y1"]), y1, y1[starts][group])
+    left = segment_accumulate(x1, group, np.minimum)
+    right = segment_accumulate(x2, group, np.maximum)
+    # сторона: у первого блока - по его классу, дальше ее может поменять блок с краю после расширения сообщения
+    sides = np.where(start, classes, -1)
+    for flip_class, reduced in rules["side_flips"]:
+        right_limit = image_width * (1 - block_percentile)
+        left_limit = image_width * (block_percentile / reduce_factor) if reduced else image_width * block_percentile
+        if flip_class == LEFT:
+            at_side = (right <= right_limit) & (left <= left_limit)
+        else:
+            at_side = (right >= right_limit) & (left >= left_limit)
+        sides[~start & (classes == flip_class) & at_side] = flip_class
+    last_side = np.maximum.reduceat(np.where(sides >= 0, np.arange(len(sides)), -1), starts)
+    side = sides[last_side]
+    coords = np.stack((left[ends], np.minimum.reduceat(y1, starts), right[ends], np.maximum.reduceat(y2, starts)),
+                      axis=1)
+    # широкие блоки (от левого до правого края) - не сообщения
+    wide = ((coords[:, 2] >= image_width * (1 - block_percentile / reduce_factor)) &
+            (coords[:, 0] <= image_width * (block_percentile / reduce_factor)))
+    emit = ~wide if rules["emit_middle"] else ~wide & (side != MIDDLE)
+    if rules["emit_before_user"]:
+        emit[:-1] |= classes[starts[1:]] == RIGHT
+    messages = []
+    for index in np.flatnonzero(emit).tolist():
+        messages.append({"text": "".join(texts[starts[index]:ends[index] + 1]),
+                         "coords": coords[index].tolist(),
+                         "side": SIDE_NAMES[side[index]]})
+    return messages
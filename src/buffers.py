@@ -0,0 +1,72 @@
+import threading
+from typing import Dict
+import numpy as np
+from src.metrics import inc
+
+MIN_BUFFER_BYTES = 1 << 16  # меньшие буферы округляются до этого размера
+BUCKETS_PER_OCTAVE = 4  # размеры буферов между соседними степенями двойки (запас не больше 25%)
+MAX_BUFFER_BYTES = 1 << 25  # больший массив (редкое огромное изображение) выделяется на запрос и не хранится
+
+_local = threading.local()
+
+
+def bucket_size(nbytes) -> int:
+    """ Размер буфера для nbytes: ближайшая сверху из BUCKETS_PER_OCTAVE ступеней между степенями двойки """
+    if nbytes <= MIN_BUFFER_BYTES:
+        return MIN_BUFFER_BYTES
+    step = (1 << (int(nbytes).bit_length() - 1)) // BUCKETS_PER_OCTAVE
+    return -(-int(nbytes) // step) * step
+
+
+class BufferPool:
+    """
+    Переиспользуемые буферы промежуточных массивов по имени.
+
+    Буфер - байты, массив любого типа и формы - непрерывное представление его начала, поэтому массивы разных
+    этапов с непересекающимся временем жизни делят один буфер (имена - слоты, см. label_components_cv).
+    Размер округляется вверх до ступени bucket_size, поэтому изображения близких размеров попадают в один
+    буфер, а новый выделяется, только когда изображение больше всех предыдущих. Массив действителен до
+    следующего запроса буфера с тем же именем: результаты, которые живут дольше запроса, копируются.
+    """
+
+    def __init__(self):
+        self._buffers: Dict[str, np.ndarray] = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if nbytes > MAX_BUFFER_BYTES:
+            inc("buffer_oversize")
+            return np.empty(shape, dtype=dtype)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.nbytes < nbytes:
+            buffer = self._buffers[name] = np.empty(bucket_size(nbytes), dtype=np.uint8)
+            self.allocations += 1
+            inc("buffer_allocations")
+        return buffer[:nbytes].view(dtype).reshape(shape)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+def get_buffers() -> BufferPool:
+    """ Буферы текущего потока (в пуле процессов - воркера): потоки не делят промежуточные массивы """
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = _local.pool = BufferPool()
+    return pool
+
+
+def take(buffers, name, shape, dtype):
+    """ Буфер из buffers или None - тогда функция OpenCV выделит результат сама """
+    return buffers.get(name, shape, dtype) if buffers is not None else None
+
+
+def cast(array, dtype, out=None) -> np.ndarray:
+    """ array.astype(dtype), но в out, если он задан """
+    if out is None:
+        return array.astype(dtype)
+    np.copyto(out, array, casting='unsafe')
+    return out
@@ -0,0 +1,157 @@
+import itertools
+import time
+from typing import Dict, List, Optional
+import numpy as np
+import scipy.ndimage as nd
+from scipy.stats import rankdata
+from src.buffers import get_buffers
+from src.image_context import ImageContext
+from src.image_processing import BOX_DETECTORS, BOXES_MAX_SIZE, MAX_LABELS, PAGE_ASPECT, MIN_BOX_WIDTH, \
+    MIN_BOX_HEIGHT, SWITCH_BONUS, SWITCH_WEIGHT, MESSAGE_WEIGHT, decode_gray, first_pixel_columns, is_tall, \
+    label_components, label_components_cv, strip_layout, strip_owns
+
+# Параметры process_image, от которых не зависят края, заливка и маркировка областей:
+# правила отбора блоков filter_boxes и веса box_confidence. Значения по умолчанию - текущие в коде.
+RULE_PARAMS = {"block_percentile": 0.18, "reduce_factor": 1.7, "min_width": MIN_BOX_WIDTH,
+               "min_height": MIN_BOX_HEIGHT}
+WEIGHT_PARAMS = {"switch_bonus": SWITCH_BONUS, "switch_weight": SWITCH_WEIGHT, "message_weight": MESSAGE_WEIGHT}
+LEFT, RIGHT = 1, 2
+
+
+def region_boxes(gray_image, detector="skimage") -> Optional[np.ndarray]:
+    """
+    Прямоугольники (x, y, ширина, высота) всех маркированных областей в порядке skimage regionprops
+    (по первому пикселю при построчном обходе) или None, если областей больше MAX_LABELS.
+    detector - как в process_image (BOX_DETECTORS): lowmem - маркировка OpenCV в буферах потока.
+    """
+    if detector not in BOX_DETECTORS:
+        raise ValueError(f"Неизвестный детектор: {detector}")
+    if detector in ("opencv", "lowmem"):
+        _, labels, stats, num_labels = label_components_cv(gray_image, get_buffers() if detector == "lowmem" else None)
+        if num_labels > MAX_LABELS:
+            return None
+        indexes = np.arange(1, num_labels + 1)
+        order = np.lexsort((first_pixel_columns(labels, stats, indexes), stats[indexes, 1]))
+        return stats[indexes[order], :4].astype(np.int64)
+    _, labeled_image, num_labels = label_components(gray_image)
+    if num_labels > MAX_LABELS:
+        return None
+    return np.array([(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+                     for rows, cols in nd.find_objects(labeled_image)], dtype=np.int64).reshape(-1, 4)
+
+
+def collect_regions(data: bytes, detector="skimage", max_size=BOXES_MAX_SIZE) -> Dict:
+    """
+    Статистики областей изображения для calibrate.py: все прямоугольники областей, ширина и высота страницы,
+    от которых считаются пороги filter_boxes, и время их получения. Высокие скриншоты разбиваются на полосы
+    так же, как в process_image_strips (блоки перекрытия отдаются одной полосе). overflow - областей больше
+    MAX_LABELS, process_image вернет 0 при любых параметрах.
+    """
+    start_time = time.perf_counter()
+    context = ImageContext(data)
+    if not is_tall(context):
+        gray_image = np.asarray(decode_gray(context, max_size=max_size))
+        boxes = region_boxes(gray_image, detector)
+        height, width = gray_image.shape
+        page_height, overflow = height, boxes is None
+    else:
+        gray_image = np.asarray(decode_gray(context, max_width=int(max_size / PAGE_ASPECT)))
+        tops, page_height, step = strip_layout(*gray_image.shape)
+        width, overflow, parts = gray_image.shape[1], False, []
+        for top in tops:
+            strip = region_boxes(gray_image[top:top + page_height], detector)
+            if strip is None:
+                continue
+            keep = strip_owns(strip[:, 1], top == 0, top == tops[-1], step)
+            parts.append(strip[keep] + np.array([0, top, 0, 0]))
+        boxes = np.concatenate(parts) if parts else None
+    return {"width": int(width), "height": int(page_height), "overflow": bool(overflow),
+            "boxes": boxes.tolist() if boxes is not None else [],
+            "seconds": time.perf_counter() - start_time}
+
+
+def make_grid(axes: Dict[str, List[float]]) -> Dict[str, np.ndarray]:
+    """ Все сочетания значений параметров: для каждого параметра массив длины числа сочетаний """
+    names = list(axes)
+    combinations = np.array(list(itertools.product(*(axes[name] for name in names))), dtype=float)
+    return {name: combinations[:, i] for i, name in enumerate(names)}
+
+
+def count_messages(record: Dict, rules: Dict[str, np.ndarray]):
+    """
+    Количество блоков и смен стороны между соседними блоками изображения для каждого набора правил
+    (векторный аналог filter_boxes + count_side_switches): два массива длины числа наборов.
+    """
+    count = len(rules["block_percentile"])
+    boxes = np.asarray(record["boxes"], dtype=np.int64).reshape(-1, 4)
+    width, height = record["width"], record["height"]
+    # области, которые не подходят по размеру ни при одном наборе, не влияют на результат
+    boxes = boxes[(boxes[:, 2] > width * rules["min_width"].min()) & (boxes[:, 3] > height * rules["min_height"].min())]
+    if record["overflow"] or len(boxes) == 0:
+        return np.zeros(count, dtype=np.int64), np.zeros(count, dtype=np.int64)
+    x, y, box_width, box_height = boxes.T
+    block_percentile = rules["block_percentile"][:, None]
+    reduce_factor = rules["reduce_factor"][:, None]
+    is_proper_size = (box_width > width * rules["min_width"][:, None]) & (
+            box_height > height * rules["min_height"][:, None])
+    is_left_side = (x <= width * block_percentile) & (x + box_width < width * (1 - block_percentile / reduce_factor))
+    is_right_side = (x + box_width >= width * (1 - block_percentile)) & (x > width * (block_percentile / reduce_factor))
+    sides = np.where(is_proper_size & is_left_side, LEFT, np.where(is_proper_size & is_right_side, RIGHT, 0))
+    kept = sides > 0
+    # сторона предыдущего оставленного блока: индекс последнего оставленного блока слева от текущего
+    last_kept = np.maximum.accumulate(np.where(kept, np.arange(len(boxes)), -1), axis=1)[:, :-1]
+    previous_sides = np.take_along_axis(sides, np.maximum(last_kept, 0), axis=1)
+    switches = kept[:, 1:] & (last_kept >= 0) & (sides[:, 1:] != previous_sides)
+    return kept.sum(axis=1), switches.sum(axis=1)
+
+
+def confidences(messages, side_switches, weights: Dict[str, np.ndarray]) -> np.ndarray:
+    """ box_confidence для массивов (..., изображения) и каждого набора весов: (наборы весов, ..., изображения) """
+    def weight(name):
+        return weights[name].reshape((-1,) + (1,) * messages.ndim)
+    return np.minimum((side_switches > 0) * weight("switch_bonus") + side_switches * weight("switch_weight") +
+                      messages * weight("message_weight"), 1.0)
+
+
+def roc_auc(scores, labels) -> np.ndarray:
+    """ Площадь под ROC-кривой для каждой строки scores (статистика Манна-Уитни, ничьи - половина) """
+    positives = labels.sum()
+    negatives = len(labels) - positives
+    if positives == 0 or negatives == 0:
+        return np.full(scores.shape[0], np.nan)
+    ranks = rankdata(scores, axis=1)
+    return (ranks[:, labels].sum(axis=1) - positives * (positives + 1) / 2) / (positives * negatives)
+
+
+def sweep(records: List[Dict], labels, rule_axes: Dict[str, List[float]], weight_axes: Dict[str, List[float]],
+          thresholds) -> Dict[str, np.ndarray]:
+    """
+    Точность, TPR, FPR (для каждого порога) и ROC AUC каждого сочетания параметров на корпусе.
+
+    Количества блоков и смен стороны считаются один раз на набор правил отбора, веса уверенности и пороги
+    применяются к ним массивами, поэтому тысячи сочетаний считаются за доли секунды.
+    :return: столбцы параметров (по одному значению на сочетание) и метрики: accuracy, tpr, fpr -
+        (сочетания, пороги), auc - (сочетания,).
+    """
+    rules = make_grid(rule_axes)
+    weights = make_grid(weight_axes)
+    labels = np.asarray(labels, dtype=bool)
+    thresholds = np.asarray(thresholds, dtype=float)
+    counts = [count_messages(record, rules) for record in records]
+    messages = np.stack([messages for messages, _ in counts], axis=1)  # (наборы правил, изображения)
+    side_switches = np.stack([switches for _, switches in counts], axis=1)
+    scores = confidences(messages, side_switches, weights).reshape(-1, len(records))
+    result = {name: np.repeat(values, len(rules["block_percentile"])) for name, values in weights.items()}
+    result.update({name: np.tile(values, len(weights["switch_bonus"])) for name, values in rules.items()})
+    positives, negatives = labels.sum(), (~labels).sum()
+    accuracy, tpr, fpr = [], [], []
+    for threshold in thresholds:
+        predicted = scores >= threshold
+        true_positives = (predicted & labels).sum(axis=1)
+        false_positives = (predicted & ~labels).sum(axis=1)
+        accuracy.append((true_positives + negatives - false_positives) / max(len(labels), 1))
+        tpr.append(true_positives / max(positives, 1))
+        fpr.append(false_positives / max(negatives, 1))
+    result.update({"accuracy": np.stack(accuracy, axis=1), "tpr": np.stack(tpr, axis=1),
+                   "fpr": np.stack(fpr, axis=1), "auc": roc_auc(scores, labels), "scores": scores})
+    return result
@@ -0,0 +1,68 @@
+from typing import Dict, List
+import numpy as np
+from src.image_context import ImageContext
+from src.image_processing import count_side_switches, process_image
+from src.metrics import span
+from src.prefilter import make_thumbnail, prefilter_features
+
+FEATURES_VERSION = 1  # меняется при изменении состава или расчета признаков (старые модели и записи не подходят)
+# признаки блоков сообщений (размеры и промежутки - в долях ширины и высоты страницы) и цвета миниатюры
+LAYOUT_FEATURES = ("messages", "left_messages", "right_messages", "side_switches", "switch_rate",
+                   "box_width_mean", "box_width_std", "box_height_mean", "box_height_std", "gap_mean", "gap_std",
+                   "box_coverage", "left_margin_rows", "right_margin_rows")
+COLOR_FEATURES = ("color_entropy", "background_share", "edge_density", "left_only_rows", "right_only_rows")
+FEATURE_NAMES = LAYOUT_FEATURES + COLOR_FEATURES
+
+
+def side_rows(boxes: np.ndarray, height) -> float:
+    """ Доля строк страницы, занятых блоками (вертикальная заполненность края) """
+    rows = np.zeros(height + 1, dtype=np.int32)
+    np.add.at(rows, np.clip(boxes[:, 1], 0, height), 1)
+    np.add.at(rows, np.clip(boxes[:, 1] + boxes[:, 3], 0, height), -1)
+    return float((np.cumsum(rows[:-1]) > 0).mean())
+
+
+def layout_features(bounding_boxes: List, width, height) -> np.ndarray:
+    """
+    Признаки расположения блоков (bounding_boxes - ((x, y, ширина, высота), сторона) в порядке
+    process_image) на странице width x height: LAYOUT_FEATURES.
+    """
+    features = np.zeros(len(LAYOUT_FEATURES))
+    if not bounding_boxes:
+        return features
+    boxes = np.array([box for box, _ in bounding_boxes], dtype=np.int64).reshape(-1, 4)
+    is_left = np.array([side == "left" for _, side in bounding_boxes])
+    side_switches, _ = count_side_switches(bounding_boxes)
+    ordered = boxes[np.argsort(boxes[:, 1], kind="stable")]
+    # промежуток до следующего блока; перекрывающиеся блоки (разные стороны на одной высоте) - ноль
+    gaps = np.maximum(ordered[1:, 1] - (ordered[:-1, 1] + ordered[:-1, 3]), 0) / height if len(boxes) > 1 else \
+        np.zeros(1)
+    widths, heights = boxes[:, 2] / width, boxes[:, 3] / height
+    features[:] = (len(boxes), is_left.sum(), (~is_left).sum(), side_switches, side_switches / max(len(boxes) - 1, 1),
+                   widths.mean(), widths.std(), heights.mean(), heights.std(), gaps.mean(), gaps.std(),
+                   min((widths * heights).sum(), 1.0), side_rows(boxes[is_left], height),
+                   side_rows(boxes[~is_left], height))
+    return features
+
+
+def color_features(file_path, block_percentile=0.18) -> np.ndarray:
+    """ Статистики цвета миниатюры (те же, что у предварительного фильтра): COLOR_FEATURES """
+    thumbnail, _ = make_thumbnail(file_path)
+    features = prefilter_features(thumbnail, block_percentile)
+    return np.array([features[name] for name in COLOR_FEATURES])
+
+
+def extract_features(file_path, block_percentile=0.18, reduce_factor=1.7, detector="skimage") -> Dict:
+    """
+    Вектор признаков изображения (FEATURE_NAMES) для обученной оценки (src.scorer) и уверенность, блоки и
+    заполненное изображение process_image, по которым он посчитан. Изображение декодируется один раз (ImageContext).
+    У высоких скриншотов признаки считаются по полосам, обработанным до достижения уверенности 1.0.
+    Этап features - только расчет признаков: process_image записывает свои этапы сам.
+    """
+    context = ImageContext.from_file(file_path)
+    confidence, bounding_boxes, fill_im = process_image(context, block_percentile, reduce_factor, detector)
+    height, width = fill_im.shape if fill_im is not None else (1, 1)
+    with span("features"):
+        vector = np.concatenate([layout_features(bounding_boxes, width, height),
+                                 color_features(context, block_percentile)])
+    return {"features": vector, "confidence": confidence, "bounding_boxes": bounding_boxes, "fill_im": fill_im}
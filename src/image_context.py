@@ -0,0 +1,94 @@
+import threading
+from io import BytesIO
+from typing import Callable
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+
+class InvalidImage(ValueError):
+    """ Байты запроса не читаются как изображение (неизвестный формат или поврежденный файл) """
+
+
+class ImageContext:
+    """
+    Изображение одного запроса: исходные байты и лениво вычисляемые представления (изображение PIL,
+    массив RGB, оттенки серого нужного размера), общие для всех этапов.
+
+    Каждое представление вычисляется не больше одного раза, в том числе при обращении из нескольких потоков
+    (например, запрос к OCR и поиск краев в режиме pipelined). Возвращаемые массивы общие - их нельзя изменять,
+    функции отрисовки рисуют на копии.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        try:
+            header = Image.open(BytesIO(data))  # читается только заголовок
+        except (UnidentifiedImageError, OSError) as e:
+            raise InvalidImage("файл не является изображением поддерживаемого формата") from e
+        self.format = header.format
+        self.size = header.size
+        self._cache = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, file) -> "ImageContext":
+        """ Создает контекст из пути, байт, файлового объекта или загруженного файла streamlit """
+        if isinstance(file, cls):
+            return file
+        if isinstance(file, bytes):
+            return cls(file)
+        if hasattr(file, 'getvalue'):
+            return cls(file.getvalue())
+        if hasattr(file, 'read'):
+            return cls(file.read())
+        with open(file, 'rb') as f:
+            return cls(f.read())
+
+    def file(self) -> BytesIO:
+        """ Новый файловый объект с исходными байтами (для кода, которому нужен файл) """
+        return BytesIO(self.data)
+
+    def cached(self, key, factory: Callable):
+        """ Значение представления key; factory вызывается только при первом обращении """
+        if key in self._cache:
+            return self._cache[key]
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._cache:
+                self._cache[key] = factory()
+        return self._cache[key]
+
+    def is_decoded(self) -> bool:
+        return "pil" in self._cache
+
+    def pil(self) -> Image.Image:
+        """ Полностью декодированное изображение PIL """
+        def decode():
+            image = Image.open(BytesIO(self.data))
+            try:
+                image.load()
+            except OSError as e:
+                raise InvalidImage(f"не удалось декодировать изображение: {e}") from e
+            return image
+        return self.cached("pil", decode)
+
+    def rgb(self) -> np.ndarray:
+        """ Массив RGB uint8 (только для чтения) """
+        def convert():
+            image = self.pil()
+            if image.mode == 'P':
+                image = image.convert('RGBA')
+            array = np.asarray(image.convert('RGB'))
+            array.flags.writeable = False
+            return array
+        return self.cached("rgb", convert)
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
@@ -1,13 +1,12 @@
-from io import BytesIO
-from typing import Tuple
+from typing import Iterator, List, Tuple
 import cv2
 import numpy as np
 from PIL import Image
-from matplotlib import pyplot as plt, patches
-from skimage.color import rgb2gray
-from skimage.feature import canny
-from skimage.measure import label, regionprops
-import scipy.ndimage as nd
+from src.buffers import cast, get_buffers, take
+from src.image_context import ImageContext
+from src.metrics import span, inc, timed
+from src.prefilter import make_thumbnail, prefilter
+from src.render import RED, draw_boxes, encode_png, mask_to_rgb
 
 
 def resize_image(image, max_size=300):
@@ -29,19 +28,82 @@ def resize_image(image, max_size=300):
     return resized
 
 
-def get_bounding_boxes(file_path, block_percentile=0.18, reduce_factor=1.7):
-    image = Image.open(file_path)
-    # Приводим изображение в формат RGB
-    if image.mode == 'RGBA':
-        image = image.convert('RGB')
+BOXES_MAX_SIZE = 1300  # наибольшая сторона изображения, на котором ищутся блоки
+MAX_LABELS = 1499  # при большем числе областей изображение - не переписка (фотография, шум)
+MIN_BOX_WIDTH = 0.10  # минимальная ширина блока сообщения в долях ширины изображения
+MIN_BOX_HEIGHT = 0.039  # минимальная высота блока в долях высоты изображения (страницы)
+# веса уверенности box_confidence: за наличие смен стороны, за каждую смену и за каждое сообщение
+SWITCH_BONUS, SWITCH_WEIGHT, MESSAGE_WEIGHT = 0.3, 0.10, 0.1
+GRAY_MATRIX = (0.2125, 0.7154, 0.0721, 0)  # те же коэффициенты, что у skimage rgb2gray
+
+
+def scaled_size(width, height, max_size) -> Tuple[int, int]:
+    """ Размер, к которому resize_image приводит изображение с наибольшей стороной max_size """
+    if width <= max_size and height <= max_size:
+        return width, height
+    scaling_factor = max_size / float(max(width, height))
+    return int(width * scaling_factor), int(height * scaling_factor)
+
+
+def target_size(width, height, max_size=None, max_width=None) -> Tuple[int, int]:
+    """ Размер для decode_gray: по ширине (max_width), по наибольшей стороне (max_size) или исходный """
+    if max_width:
+        return (max_width, max(1, int(height * max_width / width))) if width > max_width else (width, height)
+    return scaled_size(width, height, max_size) if max_size else (width, height)
+
+
+def decode_gray(file_path, max_size=None, max_width=None):
+    """
+    Декодирует изображение сразу в оттенки серого (PIL, режим 'L').
+
+    Если задан max_size, JPEG декодируется в режиме draft (масштабирование на этапе DCT) до ближайшего
+    размера не меньше целевого, а оставшееся уменьшение делается дешевым reduce + билинейной интерполяцией.
+    Итоговый размер совпадает с resize_image(image, max_size). max_width - уменьшить по ширине, а не по
+    наибольшей стороне (для высоких скриншотов, см. get_bounding_boxes_strips).
+    Вместо пути можно передать уже открытое изображение PIL или ImageContext (результат кэшируется в нем).
+    """
+    if isinstance(file_path, ImageContext):
+        return decode_gray_context(file_path, max_size, max_width)
+    image = file_path if isinstance(file_path, Image.Image) else Image.open(file_path)
+    size = target_size(image.width, image.height, max_size, max_width)
+    if image.format == 'JPEG' and size != image.size:
+        image.draft('RGB', size)
     if image.mode == 'P':
-        image = image.convert('RGBA').convert('RGB')
-    image = resize_image(image, max_size=1300)
-    gray_image = rgb2gray(image)
-    # noise removal
+        image = image.convert('RGBA')
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    if image.mode == 'RGB':
+        image = image.convert('L', GRAY_MATRIX)
+    if image.size != size:
+        image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    return image
+
+
+def decode_gray_context(context: ImageContext, max_size=None, max_width=None):
+    """ decode_gray для ImageContext: каждый размер декодируется один раз за запрос """
+    size = target_size(context.width, context.height, max_size, max_width)
+
+    def decode():
+        # JPEG, который еще не декодирован целиком, дешевле уменьшить при декодировании (draft)
+        if context.format == 'JPEG' and size != context.size and not context.is_decoded():
+            return decode_gray(context.file(), max_size, max_width)
+        return decode_gray(context.pil(), max_size, max_width)
+    return context.cached(("gray", size), decode)
+
+
+def remove_noise(gray_image, buffers=None):
+    """ Убирает шум морфологическими операциями (buffers - BufferPool для результатов, см. src.buffers) """
     kernel = np.ones((2, 2), np.uint8)
-    gray_image = cv2.morphologyEx(gray_image, cv2.MORPH_CLOSE, kernel, iterations=2)
-    gray_image = cv2.morphologyEx(gray_image, cv2.MORPH_DILATE, kernel, iterations=1)
+    closed = cv2.morphologyEx(gray_image, cv2.MORPH_CLOSE, kernel, iterations=2,
+                              dst=take(buffers, "slot0", gray_image.shape, gray_image.dtype))
+    return cv2.morphologyEx(closed, cv2.MORPH_DILATE, kernel, iterations=1,
+                            dst=take(buffers, "slot1", gray_image.shape, gray_image.dtype))
+
+
+def detect_edges(gray_image):
+    """ Выделяет края, подбирая sigma по яркости изображения """
+    # skimage и scipy импортируются при первом вызове: движкам на OpenCV и OCR они не нужны (см. warm_up)
+    from skimage.feature import canny
     # Если изображение слишком светлое, повышаем контрастность изображения
     if np.mean(gray_image) > 0.96:
         sigma = 0.45
@@ -49,19 +111,14 @@ def get_bounding_boxes(file_path, block_percentile=0.18, reduce_factor=1.7):
         sigma = 0.8
     else:
         sigma = 1.1
-    # Выделяем края
-    edges = canny(gray_image, sigma=sigma, low_threshold=0, high_threshold=0.2)
-    # Заполняем дыры - для уменьшения шума при нахождении границ
-    fill_im = nd.binary_fill_holes(edges)
-    # Маркировка компонентов
-    labeled_image, num_labels = label(fill_im, return_num=True)
-    if num_labels > 1499:
-        return [], None
-    # Получение свойств каждой маркированной области
-    props = regionprops(labeled_image)
+    return canny(gray_image, sigma=sigma, low_threshold=0, high_threshold=0.2)
+
+
+def filter_boxes(props, image_width, image_height, block_percentile=0.18, reduce_factor=1.7) -> List:
+    """ Оставляет области подходящего размера, прилегающие к левому или правому краю """
     bounding_boxes = []
-    min_box_width = image.width * 0.10
-    min_box_height = image.height * 0.039
+    min_box_width = image_width * MIN_BOX_WIDTH
+    min_box_height = image_height * MIN_BOX_HEIGHT
     for prop in props:
         y, x, max_row, max_col = prop.bbox
         # Рассчитываем width и height
@@ -70,55 +127,371 @@ def get_bounding_boxes(file_path, block_percentile=0.18, reduce_factor=1.7):
         # не пропускаем мелкие блоки, а также смотрим на координаты блока,
         # принадлежит ли блок левой или правой стороне (но не обеим сторонам сразу с понижающим фактором)
         is_proper_size = (width > min_box_width and height > min_box_height)
-        if is_proper_size:
-            pass
-        is_left_side = x <= image.width * block_percentile and (
-                    x + width < image.width * (1 - block_percentile / reduce_factor))
-        is_right_side = x + width >= image.width * (1 - block_percentile) and (x > image.width * (block_percentile / reduce_factor))
+        is_left_side = x <= image_width * block_percentile and (
+                    x + width < image_width * (1 - block_percentile / reduce_factor))
+        is_right_side = x + width >= image_width * (1 - block_percentile) and (x > image_width * (block_percentile / reduce_factor))
         if is_proper_size and is_left_side:
             bounding_boxes.append(((x, y, width, height), "left"))  # добавляем в список
         elif is_proper_size and is_right_side:
             bounding_boxes.append(((x, y, width, height), "right"))  # добавляем в список
+    return bounding_boxes
+
+
+def get_bounding_boxes(file_path, block_percentile=0.18, reduce_factor=1.7):
+    with span("decode"):
+        image = decode_gray(file_path, max_size=BOXES_MAX_SIZE)
+    return find_boxes(np.asarray(image), block_percentile, reduce_factor)
+
+
+def label_components(gray_image) -> Tuple:
+    """ Этапы find_boxes, не зависящие от параметров блоков: маска областей, маркировка и число областей """
+    import scipy.ndimage as nd
+    from skimage.measure import label
+    with span("to_float"):
+        gray_image = gray_image / 255.0
+    # noise removal
+    with span("morphology"):
+        gray_image = remove_noise(gray_image)
+    # Выделяем края
+    with span("canny"):
+        edges = detect_edges(gray_image)
+    # Заполняем дыры - для уменьшения шума при нахождении границ
+    with span("fill_holes"):
+        fill_im = nd.binary_fill_holes(edges)
+    # Маркировка компонентов
+    with span("label"):
+        labeled_image, num_labels = label(fill_im, return_num=True)
+    inc("labels", num_labels)
+    return fill_im, labeled_image, num_labels
 
+
+def find_boxes(gray_image, block_percentile=0.18, reduce_factor=1.7, page_height=None):
+    """
+    Поиск блоков get_bounding_boxes на уже декодированном массиве uint8.
+    page_height - высота, от которой считается минимальная высота блока (по умолчанию высота массива).
+    """
+    from skimage.measure import regionprops
+    image_height, image_width = gray_image.shape
+    fill_im, labeled_image, num_labels = label_components(gray_image)
+    if num_labels > MAX_LABELS:
+        return [], None
+    # Получение свойств каждой маркированной области
+    with span("regionprops"):
+        props = regionprops(labeled_image)
+        bounding_boxes = filter_boxes(props, image_width, page_height or image_height, block_percentile,
+                                      reduce_factor)
+    inc("boxes", len(bounding_boxes))
     return bounding_boxes, fill_im
 
 
-def process_image(file_path, block_percentile=0.18, reduce_factor=1.7) -> Tuple:
-    bounding_boxes, fill_im = get_bounding_boxes(file_path, block_percentile, reduce_factor)
-    if len(bounding_boxes) == 0:
-        return 0, [], None
-    messages = len(bounding_boxes)
+GRADIENT_SCALE = 8  # масштаб производных при переводе в int16, чтобы не терять точность сглаживания
+
+
+def choose_sigma(mean_brightness) -> float:
+    """ sigma сглаживания для canny в зависимости от средней яркости (0..1), как в detect_edges """
+    if mean_brightness > 0.96:
+        return 0.45
+    if mean_brightness > 0.93:
+        return 0.8
+    return 1.1
+
+
+def canny_cv(gray_image, sigma, high_threshold=0.2, buffers=None) -> np.ndarray:
+    """
+    Аналог skimage canny(low_threshold=0) на uint8-изображении средствами OpenCV.
+
+    Сглаживание выполняется во float32 с тем же радиусом ядра, что у skimage (4 sigma),
+    производные передаются в cv2.Canny в int16 с масштабом GRADIENT_SCALE.
+    buffers - BufferPool: промежуточные массивы и результат пишутся в его буферы.
+    """
+    shape = gray_image.shape
+    radius = int(np.ceil(4 * sigma))
+    smoothed = cv2.GaussianBlur(cast(gray_image, np.float32, take(buffers, "slot0", shape, np.float32)),
+                                (2 * radius + 1, 2 * radius + 1), sigma, borderType=cv2.BORDER_REPLICATE,
+                                dst=take(buffers, "slot1", shape, np.float32))
+    dx = cv2.Sobel(smoothed, cv2.CV_32F, 1, 0, ksize=3, scale=GRADIENT_SCALE, borderType=cv2.BORDER_REPLICATE,
+                   dst=take(buffers, "slot0", shape, np.float32))
+    dy = cv2.Sobel(smoothed, cv2.CV_32F, 0, 1, ksize=3, scale=GRADIENT_SCALE, borderType=cv2.BORDER_REPLICATE,
+                   dst=take(buffers, "slot2", shape, np.float32))
+    high = high_threshold * 255 * GRADIENT_SCALE
+    edges = cv2.Canny(cast(dx, np.int16, take(buffers, "slot1", shape, np.int16)),
+                      cast(dy, np.int16, take(buffers, "slot0", shape, np.int16)), 0, high,
+                      edges=take(buffers, "slot2", shape, np.uint8), L2gradient=True)
+    # skimage не выделяет края в крайних пикселях изображения
+    edges[[0, -1], :] = 0
+    edges[:, [0, -1]] = 0
+    return edges
+
+
+def fill_holes_cv(edges, buffers=None) -> np.ndarray:
+    """ Аналог nd.binary_fill_holes: заливаем фон от рамки, все незалитое - объекты и их дыры """
+    height, width = edges.shape
+    if buffers is None:
+        background = np.zeros((height + 2, width + 2), np.uint8)
+        mask = np.zeros((height + 4, width + 4), np.uint8)
+    else:
+        background = buffers.get("slot0", (height + 2, width + 2), np.uint8)
+        background[[0, -1], :] = 0
+        background[:, [0, -1]] = 0
+        mask = buffers.get("slot1", (height + 4, width + 4), np.uint8)
+        mask.fill(0)
+    background[1:-1, 1:-1] = edges
+    cv2.floodFill(background, mask, (0, 0), 255, flags=4)
+    holes = cv2.bitwise_not(background[1:-1, 1:-1], dst=take(buffers, "slot1", edges.shape, np.uint8))
+    return cv2.bitwise_or(edges, holes, dst=take(buffers, "slot0", edges.shape, np.uint8))
+
+
+def first_pixel_columns(labels, stats, indexes) -> np.ndarray:
+    """ Колонка первого (в порядке обхода строк) пикселя компонент - для порядка как у skimage label """
+    columns = np.empty(len(indexes), dtype=np.int64)
+    for i, index in enumerate(indexes):
+        x, y, width = stats[index, cv2.CC_STAT_LEFT], stats[index, cv2.CC_STAT_TOP], stats[index, cv2.CC_STAT_WIDTH]
+        columns[i] = x + np.argmax(labels[y, x:x + width] == index)
+    return columns
+
+
+def filter_boxes_cv(labels, stats, image_width, image_height, block_percentile=0.18, reduce_factor=1.7) -> List:
+    """ Векторный аналог filter_boxes по массиву статистик cv2.connectedComponentsWithStats """
+    x = stats[1:, cv2.CC_STAT_LEFT]
+    y = stats[1:, cv2.CC_STAT_TOP]
+    width = stats[1:, cv2.CC_STAT_WIDTH]
+    height = stats[1:, cv2.CC_STAT_HEIGHT]
+    is_proper_size = (width > image_width * MIN_BOX_WIDTH) & (height > image_height * MIN_BOX_HEIGHT)
+    is_left_side = (x <= image_width * block_percentile) & (
+            x + width < image_width * (1 - block_percentile / reduce_factor))
+    is_right_side = (x + width >= image_width * (1 - block_percentile)) & (
+            x > image_width * (block_percentile / reduce_factor))
+    keep = np.flatnonzero(is_proper_size & (is_left_side | is_right_side))
+    # упорядочиваем как skimage: по первому пикселю компоненты при построчном обходе
+    order = np.lexsort((first_pixel_columns(labels, stats, keep + 1), y[keep]))
+    return [((int(x[i]), int(y[i]), int(width[i]), int(height[i])), "left" if is_left_side[i] else "right")
+            for i in keep[order]]
+
+
+def get_bounding_boxes_cv(file_path, block_percentile=0.18, reduce_factor=1.7):
+    """ Тот же алгоритм, что get_bounding_boxes, на uint8-примитивах OpenCV """
+    with span("decode"):
+        image = decode_gray(file_path, max_size=BOXES_MAX_SIZE)
+    return find_boxes_cv(np.asarray(image), block_percentile, reduce_factor)
+
+
+def label_components_cv(gray_image, buffers=None) -> Tuple:
+    """
+    label_components на примитивах OpenCV: маска (uint8), метки, статистики областей и число областей.
+    buffers - BufferPool: все полноразмерные массивы, включая маску и метки, пишутся в его буферы.
+    Массивы с непересекающимся временем жизни делят три буфера (slot0-2, до 4 байт на пиксель каждый):
+    морфология 0 -> 1, float32 0, сглаживание 1, dx 0, dy 2, int16 dx 1, dy 0, края 2, фон и маска заливки 0 и 1,
+    дыры 1, заполненная маска 0, метки 1.
+    """
+    with span("morphology"):
+        gray_image = remove_noise(gray_image, buffers)
+    with span("canny"):
+        edges = canny_cv(gray_image, choose_sigma(np.mean(gray_image) / 255), buffers=buffers)
+    with span("fill_holes"):
+        fill_im = fill_holes_cv(edges, buffers)
+    with span("label"):
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+            fill_im, labels=take(buffers, "slot1", fill_im.shape, np.int32), connectivity=8, ltype=cv2.CV_32S)
+    inc("labels", num_labels - 1)
+    return fill_im, labels, stats, num_labels - 1
+
+
+def find_boxes_cv(gray_image, block_percentile=0.18, reduce_factor=1.7, page_height=None, buffers=None):
+    """
+    Поиск блоков get_bounding_boxes_cv на уже декодированном массиве uint8 (page_height - как в find_boxes).
+    С buffers промежуточные массивы берутся из буферов, новым остается только возвращаемая маска (bool).
+    """
+    image_height, image_width = gray_image.shape
+    fill_im, labels, stats, num_labels = label_components_cv(gray_image, buffers)
+    if num_labels > MAX_LABELS:
+        return [], None
+    with span("regionprops"):
+        bounding_boxes = filter_boxes_cv(labels, stats, image_width, page_height or image_height, block_percentile,
+                                         reduce_factor)
+    inc("boxes", len(bounding_boxes))
+    return bounding_boxes, fill_im > 0
+
+
+def find_boxes_lowmem(gray_image, block_percentile=0.18, reduce_factor=1.7, page_height=None):
+    """ find_boxes_cv с промежуточными массивами в переиспользуемых буферах потока (src.buffers) """
+    return find_boxes_cv(gray_image, block_percentile, reduce_factor, page_height, buffers=get_buffers())
+
+
+def get_bounding_boxes_lowmem(file_path, block_percentile=0.18, reduce_factor=1.7):
+    """
+    get_bounding_boxes_cv без выделения полноразмерных массивов на запрос: uint8 / float32 / int16 / int32
+    промежуточные результаты пишутся в буферы воркера, растущие только при изображении больше предыдущих.
+    Результат совпадает с get_bounding_boxes_cv.
+    """
+    with span("decode"):
+        image = decode_gray(file_path, max_size=BOXES_MAX_SIZE)
+    return find_boxes_lowmem(np.asarray(image), block_percentile, reduce_factor)
+
+
+BOX_DETECTORS = {
+    "skimage": get_bounding_boxes,
+    "opencv": get_bounding_boxes_cv,
+    "lowmem": get_bounding_boxes_lowmem,
+}
+# те же реализации на уже декодированном массиве uint8 (для поиска по полосам)
+GRAY_BOX_DETECTORS = {
+    "skimage": find_boxes,
+    "opencv": find_boxes_cv,
+    "lowmem": find_boxes_lowmem,
+}
+
+# Высокие скриншоты (прокрутка) обрабатываются полосами: при уменьшении по наибольшей стороне ширина
+# становится слишком маленькой, а целиком в исходной ширине не хватает памяти.
+TALL_ASPECT = 3.0  # отношение высоты к ширине, начиная с которого изображение обрабатывается полосами
+PAGE_ASPECT = 20 / 9  # полоса - как обычный скриншот телефона
+STRIP_WIDTH = int(BOXES_MAX_SIZE / PAGE_ASPECT)  # ширина обычного скриншота после уменьшения до BOXES_MAX_SIZE
+STRIP_OVERLAP = 0.25  # доля высоты полосы, общая со следующей (блоки ниже перекрытия целиком есть в следующей)
+# блок, начинающийся так близко к верху полосы, - продолжение блока из предыдущей полосы; края пузыря находятся
+# на несколько пикселей ниже его границы, поэтому запас больше этого сдвига (пузырь на самой границе полосы
+# в ней не находится, его учитывает предыдущая полоса - strip_owns)
+STRIP_MARGIN = 8
+
+
+def image_size(file_path) -> Tuple[int, int]:
+    """ Размер изображения (путь, файловый объект, PIL Image или ImageContext) без декодирования """
+    if isinstance(file_path, (ImageContext, Image.Image)):
+        return file_path.size
+    size = Image.open(file_path).size  # читается только заголовок
+    if hasattr(file_path, 'seek'):
+        file_path.seek(0)
+    return size
+
+
+def is_tall(file_path) -> bool:
+    width, height = image_size(file_path)
+    return height > width * TALL_ASPECT
+
+
+def strip_layout(image_height, image_width) -> Tuple[List[int], int, int]:
+    """ Первые строки полос iter_strip_boxes, высота полосы и шаг между полосами """
+    strip_height = int(image_width * PAGE_ASPECT)
+    step = strip_height - int(strip_height * STRIP_OVERLAP)
+    tops = [0]
+    while tops[-1] + strip_height < image_height:
+        tops.append(tops[-1] + step)
+    return tops, strip_height, step
+
+
+def strip_owns(y, is_first, is_last, step):
+    """
+    Учитывается ли в полосе блок, начинающийся в ее строке y (число или массив NumPy). Блок у верхнего края
+    (y < STRIP_MARGIN) - продолжение блока предыдущей полосы, поэтому предыдущая полоса учитывает блоки,
+    начинающиеся до step + STRIP_MARGIN: условия соседних полос совпадают, и блок не теряется на границе.
+    """
+    return (is_first | (y >= STRIP_MARGIN)) & (is_last | (y < step + STRIP_MARGIN))
+
+
+def iter_strip_boxes(file_path, block_percentile=0.18, reduce_factor=1.7, detector="skimage") -> Iterator:
+    """
+    Ищет блоки на высоком изображении перекрывающимися горизонтальными полосами.
+
+    Изображение уменьшается по ширине до STRIP_WIDTH, полоса - как обычный скриншот этой ширины, поэтому
+    пороги filter_boxes те же, что у обычных скриншотов, а память ограничена размером полосы.
+    Для каждой полосы выдает (первая строка полосы, ее блоки в координатах уменьшенного изображения,
+    заполненная маска полосы или None, высота и ширина уменьшенного изображения). Блок, начинающийся в
+    перекрытии, отдается следующей полосе, где он целиком (кроме самого верха перекрытия - strip_owns);
+    блок длиннее перекрытия учитывается один раз (обрезанным). Генератор ленивый: следующая полоса
+    обрабатывается, только когда она нужна.
+    """
+    with span("decode"):
+        gray_image = np.asarray(decode_gray(file_path, max_width=STRIP_WIDTH))
+    tops, strip_height, step = strip_layout(*gray_image.shape)
+    for top in tops:
+        is_last = top == tops[-1]
+        inc("strips")
+        bounding_boxes, fill_im = GRAY_BOX_DETECTORS[detector](gray_image[top:top + strip_height], block_percentile,
+                                                               reduce_factor, page_height=strip_height)
+        strip_boxes = [((x, y + top, width, height), side) for (x, y, width, height), side in bounding_boxes
+                       if strip_owns(y, top == 0, is_last, step)]
+        yield top, strip_boxes, fill_im, gray_image.shape
+
+
+def count_side_switches(bounding_boxes, last_side=None) -> Tuple[int, object]:
+    """ Количество смен стороны между соседними блоками (last_side - сторона блока перед первым) """
     side_switches = 0
-    _, last_side = bounding_boxes[0]
-    for box, side in bounding_boxes[1:]:
-        if last_side != side:
+    for box, side in bounding_boxes:
+        if last_side is not None and last_side != side:
             side_switches += 1
-            last_side = side
+        last_side = side
+    return side_switches, last_side
 
-    return min((side_switches > 0) * 0.3 + side_switches * 0.10 + messages * 0.1, 1.0), bounding_boxes, fill_im
 
+def box_confidence(messages, side_switches) -> float:
+    return min((side_switches > 0) * SWITCH_BONUS + side_switches * SWITCH_WEIGHT + messages * MESSAGE_WEIGHT, 1.0)
 
-def plot_results(image, bounding_boxes):
-    dpi = 300  # Разрешение в точках на дюйм, можно адаптировать
-    height, width = image.shape
-    figsize = width / float(dpi), height / float(dpi)  # Размер фигуры в дюймах
-    # Создание фигуры и осей
-    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
-    ax.imshow(image)
-    for box, side in bounding_boxes:
-        x, y, width, height = box
-        # Отрисовываем все найденные блоки
-        rect = patches.Rectangle((x, y), width, height, linewidth=0.8, edgecolor='r', facecolor='none')
-        ax.add_patch(rect)
-
-    # Убираем оси и белые поля
-    ax.axis('off')
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    # Сохраняем фигуру в объект BytesIO для последующего использования в Streamlit
-    buf = BytesIO()
-    plt.savefig(buf, format='png')
-    plt.close(fig)
-    buf.seek(0)
-
-    return buf
+
+def process_image_strips(file_path, block_percentile=0.18, reduce_factor=1.7, detector="skimage") -> Tuple:
+    """
+    process_image для высоких скриншотов: блоки ищутся полосами (iter_strip_boxes), количество сообщений и
+    смен стороны переносится между полосами. Уверенность не больше 1.0 и не убывает, поэтому как только она
+    достигла 1.0, оставшиеся полосы не обрабатываются.
+    """
+    bounding_boxes, fill_im = [], None
+    side_switches, last_side = 0, None
+    confidence = 0
+    for top, strip_boxes, strip_fill, shape in iter_strip_boxes(file_path, block_percentile, reduce_factor, detector):
+        if fill_im is None:
+            fill_im = np.zeros(shape, dtype=bool)
+        if strip_fill is not None:
+            fill_im[top:top + strip_fill.shape[0]] |= strip_fill
+        switches, last_side = count_side_switches(strip_boxes, last_side)
+        side_switches += switches
+        bounding_boxes.extend(strip_boxes)
+        confidence = box_confidence(len(bounding_boxes), side_switches)
+        if confidence >= 1.0:
+            inc("strips_early_stop")
+            break
+    if len(bounding_boxes) == 0:
+        return 0, [], None
+    return confidence, bounding_boxes, fill_im
+
+
+def passes_prefilter(file_path, block_percentile=0.18) -> Tuple[bool, object]:
+    """
+    Проверка миниатюры (src.prefilter): может ли изображение быть перепиской и источник для дальнейшей
+    обработки (make_thumbnail).
+    """
+    with span("prefilter"):
+        thumbnail, file_path = make_thumbnail(file_path)
+        is_candidate, _, features = prefilter(thumbnail, block_percentile)
+    if not is_candidate:
+        inc("prefilter_rejects", reason=features["reason"])
+    return is_candidate, file_path
+
+
+def process_image(file_path, block_percentile=0.18, reduce_factor=1.7, detector="skimage",
+                  use_prefilter=False, strips=None) -> Tuple:
+    """
+    detector - реализация поиска блоков из BOX_DETECTORS.
+    use_prefilter - сначала проверить миниатюру (src.prefilter) и сразу вернуть 0 для очевидно не переписок.
+    strips - искать блоки полосами (process_image_strips); None - только для высоких скриншотов (TALL_ASPECT).
+    """
+    if strips is None:
+        strips = is_tall(file_path)
+    if strips:
+        return process_image_strips(file_path, block_percentile, reduce_factor, detector)
+    if use_prefilter:
+        is_candidate, file_path = passes_prefilter(file_path, block_percentile)
+        if not is_candidate:
+            return 0, [], None
+    bounding_boxes, fill_im = BOX_DETECTORS[detector](file_path, block_percentile, reduce_factor)
+    if len(bounding_boxes) == 0:
+        return 0, [], None
+    side_switches, _ = count_side_switches(bounding_boxes)
+    return box_confidence(len(bounding_boxes), side_switches), bounding_boxes, fill_im
+
+
+@timed("render")
+def plot_results(image, bounding_boxes, encode=True):
+    """
+    Рисует найденные блоки поверх заполненного изображения.
+    encode=False - вернуть массив RGB uint8 без кодирования в PNG (например, для st.image).
+    """
+    boxes = [(x, y, x + width, y + height) for (x, y, width, height), _ in bounding_boxes]
+    overlay = draw_boxes(mask_to_rgb(image), boxes, RED)
+    return encode_png(overlay) if encode else overlay
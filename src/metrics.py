@@ -0,0 +1,216 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+PREFIX = "convdetect_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_histograms = {}  # (имя, метки) -> [счетчики по корзинам, сумма, количество]
+_counters = {}  # (имя, метки) -> значение
+_gauges = {}  # (имя, метки) -> текущее значение
+_local = threading.local()
+_servers = {}  # порт -> запущенный сервер метрик
+
+
+class Trace:
+    """ Время этапов и счетчики одного запроса (этапы могут выполняться в нескольких потоках, см. bind_trace) """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_timing(self, stage, value) -> None:
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0) + value
+
+    def add_counter(self, name, value) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+def _key(name, labels) -> Tuple:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe(name, value, **labels) -> None:
+    """ Добавляет значение в гистограмму """
+    key = _key(name, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+        histogram = _histograms[key]
+        histogram[0][bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def inc(name, value=1, **labels) -> None:
+    """ Увеличивает счетчик (и счетчик текущего запроса, если он отслеживается) """
+    current = current_trace()
+    if current is not None:
+        current.add_counter(name, value)
+        labels.setdefault("engine", current.engine)
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels) -> None:
+    """ Задает текущее значение (глубина очереди и т.п.) """
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def trace(engine):
+    """ Отслеживает все этапы, выполненные внутри блока, как один запрос движка engine """
+    previous = current_trace()
+    _local.trace = Trace(engine)
+    start_time = time.perf_counter()
+    try:
+        yield _local.trace
+    finally:
+        _local.trace.timings["total"] = time.perf_counter() - start_time
+        observe("request_seconds", _local.trace.timings["total"], engine=engine)
+        _local.trace = previous
+
+
+def bind_trace(func):
+    """ Оборачивает func так, чтобы ее этапы и счетчики попадали в текущий запрос и при вызове в другом потоке """
+    bound = current_trace()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = current_trace()
+        _local.trace = bound
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.trace = previous
+    return wrapper
+
+
+@contextmanager
+def span(stage):
+    """ Замеряет время этапа и пишет его в гистограмму stage_seconds """
+    current = current_trace()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        engine = current.engine if current is not None else "none"
+        if current is not None:
+            current.add_timing(stage, elapsed)
+        observe("stage_seconds", elapsed, stage=stage, engine=engine)
+
+
+def timed(stage):
+    """ Декоратор: оборачивает всю функцию в span(stage) """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(engine, timings: Dict, counters: Dict) -> None:
+    """ Переносит тайминги и счетчики запроса, выполненного в другом процессе, в метрики текущего """
+    for stage, value in timings.items():
+        if stage == "total":
+            observe("request_seconds", value, engine=engine)
+        else:
+            observe("stage_seconds", value, stage=stage, engine=engine)
+    for name, value in counters.items():
+        inc(name, value, engine=engine)
+
+
+def _escape(value) -> str:
+    """ Значение метки в формате Prometheus: экранируются обратная косая черта, кавычки и переводы строк """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def render_prometheus() -> str:
+    """ Возвращает все метрики в текстовом формате Prometheus """
+    lines = []
+    with _lock:
+        histograms = sorted((k, ([*v[0]], v[1], v[2])) for k, v in _histograms.items())
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+    seen = set()
+    for (name, labels), (buckets, total, count) in histograms:
+        if name not in seen:
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            seen.add(name)
+        cumulative = 0
+        for bound, value in zip(LATENCY_BUCKETS, buckets):
+            cumulative += value
+            lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {count}")
+    for (name, labels), value in counters:
+        if name not in seen:
+            lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            seen.add(name)
+        lines.append(f"{PREFIX}{name}_total{_format_labels(labels)} {value}")
+    for (name, labels), value in gauges:
+        if name not in seen:
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            seen.add(name)
+        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    """ Очищает все метрики (для тестов и бенчмарков) """
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host="0.0.0.0"):
+    """
+    Поднимает в фоновом потоке HTTP-сервер, отдающий метрики (для процессов без своего сервера).
+    Повторный вызов с тем же портом (например, при перезапуске скрипта streamlit) возвращает уже запущенный сервер.
+    """
+    with _lock:
+        if port not in _servers:
+            server = ThreadingHTTPServer((host, port), MetricsHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            _servers[port] = server
+        return _servers[port]
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, Optional, Tuple
+from src.metrics import inc
+
+OCR_STORE_MODES = ("record", "replay")
+
+
+def image_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class OCRStore:
+    """
+    Хранилище ответов OCR (ответы YandexOCR, словари image_to_data Tesseract, области get_color_zones)
+    в одном файле sqlite, значения - JSON, сжатый zlib.
+
+    Запись определяется хэшем изображения, видом записи (kind) и конфигурацией, от которой зависит ответ.
+    mode="record" - отсутствующие записи получаются вызовом OCR и сохраняются,
+    mode="replay" - используются только сохраненные записи, OCR не вызывается (отсутствие записи - ошибка).
+    """
+
+    def __init__(self, path, mode="record"):
+        if mode not in OCR_STORE_MODES:
+            raise ValueError(f"Неизвестный режим хранилища OCR: {mode}")
+        self.path = path
+        self.mode = mode
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS ocr (image_hash TEXT, kind TEXT, config TEXT, "
+                               "created REAL, data BLOB, PRIMARY KEY (image_hash, kind, config))")
+            connection.execute("CREATE INDEX IF NOT EXISTS ocr_kind ON ocr (kind, config)")
+
+    def __getstate__(self):
+        # соединения sqlite не передаются между процессами, в дочернем процессе открывается свое
+        return {"path": self.path, "mode": self.mode}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.mode = state["mode"]
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Соединение текущего потока (sqlite3 не разрешает использовать соединение из разных потоков) """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")  # параллельная запись из процессов пакетной обработки
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _config(config: Dict) -> str:
+        return json.dumps(config, sort_keys=True)
+
+    def get(self, data_hash, kind, config: Dict) -> Optional[Dict]:
+        row = self._connection().execute("SELECT data FROM ocr WHERE image_hash = ? AND kind = ? AND config = ?",
+                                         (data_hash, kind, self._config(config))).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row is not None else None
+
+    def put(self, data_hash, kind, config: Dict, value) -> None:
+        blob = zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'), 6)
+        with self._connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO ocr VALUES (?, ?, ?, ?, ?)",
+                               (data_hash, kind, self._config(config), time.time(), blob))
+
+    def lookup(self, data: bytes, kind, config: Dict) -> Optional[Dict]:
+        """ Сохраненная запись для изображения или None (в режиме replay отсутствие записи - ошибка) """
+        value = self.get(image_hash(data), kind, config)
+        if value is not None:
+            inc("ocr_store_hits", kind=kind)
+        elif self.mode == "replay":
+            raise LookupError(f"Нет сохраненной записи {kind} {self._config(config)} для изображения")
+        return value
+
+    def record(self, data: bytes, kind, config: Dict, value) -> None:
+        """ Сохраняет запись, если она не является ответом с ошибкой """
+        if isinstance(value, dict) and 'error' in value:
+            return
+        self.put(image_hash(data), kind, config, value)
+        inc("ocr_store_writes", kind=kind)
+
+    def records(self, kind, config: Optional[Dict] = None) -> Iterator[Tuple[str, Dict, Dict]]:
+        """ Перебирает (хэш изображения, конфигурация, значение) записей вида kind """
+        query, args = "SELECT image_hash, config, data FROM ocr WHERE kind = ?", (kind,)
+        if config is not None:
+            query, args = query + " AND config = ?", (kind, self._config(config))
+        for data_hash, config_json, blob in self._connection().execute(query, args):
+            yield data_hash, json.loads(config_json), json.loads(zlib.decompress(blob))
+
+    def close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
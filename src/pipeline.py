@@ -0,0 +1,358 @@
+import logging
+import os
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+from src.image_context import ImageContext
+from src.image_processing import count_side_switches, is_tall, passes_prefilter, process_image
+from src.cache import make_cache_key
+from src.metrics import trace, inc
+
+# Модули OCR-движков (pytesseract / tesserocr, requests, skimage и scipy для областей YandexOCR) импортируются
+# внутри функций движка: воркер no_ocr их не загружает, а воркер OCR загружает при прогреве (warm_up).
+
+ENGINES = ("no_ocr", "tesseract", "yandex", "hybrid")
+OCR_ENGINES = ("tesseract", "yandex")
+# hybrid: OCR вызывается, только если уверенность без OCR попала в полуинтервал [нижняя, верхняя) -
+# ниже почти нет блоков сообщений, 1.0 - много блоков и смен стороны, OCR решение не изменит.
+# Полоса для формулы rules; у обученной модели своя полоса, она хранится в файле модели (ScorerModel.band)
+HYBRID_BAND = (0.2, 1.0)
+HYBRID_OCR_WEIGHT = 0.6  # вес уверенности OCR в итоговой уверенности при вызове OCR
+# уверенность без OCR: формула по количеству блоков и смен стороны или обученная модель (src.scorer)
+SCORERS = ("rules", "model")
+DECISION_YES = "Переписка"
+DECISION_NO = "Не переписка"
+NON_CACHED_FIELDS = ("threshold", "is_conversation", "verdict", "timings", "counters")
+
+logger = logging.getLogger(__name__)
+
+
+def run_no_ocr(file, block_percentile=0.18, reduce_factor=1.7, detector="skimage", prefilter=False,
+               scorer="rules") -> Dict:
+    """
+    Определяет переписку без OCR и возвращает уверенность и найденные блоки.
+    scorer="model" - уверенность по вектору признаков изображения (src.features) обученной моделью процесса;
+    prefilter, как и для формулы, сразу дает 0 для очевидно не переписок (кроме высоких скриншотов).
+    """
+    if scorer == "model":
+        from src.features import extract_features
+        from src.scorer import get_model
+        context = ImageContext.from_file(file)
+        if prefilter and not is_tall(context) and not passes_prefilter(context, block_percentile)[0]:
+            return {"confidence": 0, "boxes": []}
+        extracted = extract_features(context, block_percentile, reduce_factor, detector)
+        confidence, bounding_boxes = float(get_model().predict(extracted["features"])), extracted["bounding_boxes"]
+    else:
+        confidence, bounding_boxes, _ = process_image(file, block_percentile, reduce_factor, detector, prefilter)
+    boxes = [{"coords": [x, y, x + width, y + height], "side": side}
+             for (x, y, width, height), side in bounding_boxes]
+    return {"confidence": confidence, "boxes": boxes}
+
+
+def tesseract_store_config(block_percentile=0.18, detector="skimage", roi=False) -> Dict:
+    """ Конфигурация, от которой зависит результат Tesseract (ключ записи в OCRStore) """
+    from src.tesseract import ROI_PSM, TESSERACT_LANG
+    if roi:
+        return {"lang": TESSERACT_LANG, "psm": ROI_PSM, "roi": True, "detector": detector,
+                "block_percentile": block_percentile}
+    return {"lang": TESSERACT_LANG, "psm": 4}
+
+
+def score_tesseract(ocr: Dict, block_percentile=0.18, reduce_factor=1.37) -> Dict:
+    """ Уверенность и блоки по результату Tesseract ({"details", "width", "height"}) """
+    from src.tesseract import process_image_tesseract, confidence_tesseract
+    processed_result = process_image_tesseract(ocr["details"], ocr["width"], ocr["height"], block_percentile,
+                                               reduce_factor)
+    confidence = confidence_tesseract(processed_result)
+    boxes = [{"coords": list(block["coords"]), "side": block["side"]} for block in processed_result["text_blocks"]]
+    return {"confidence": confidence, "boxes": boxes}
+
+
+def run_tesseract(file, block_percentile=0.18, reduce_factor=1.37, detector="skimage", roi=False,
+                  ocr_store=None) -> Dict:
+    """
+    Определяет переписку через Tesseract OCR; roi - распознавать только найденные блоки сообщений.
+    ocr_store - OCRStore, из которого берется (или в который записывается) результат распознавания.
+    """
+    from src.tesseract import parse_image_tesseract, parse_image_tesseract_roi
+    context = ImageContext.from_file(file)
+    ocr = None
+    if ocr_store is not None:
+        ocr = ocr_store.lookup(context.data, "tesseract", tesseract_store_config(block_percentile, detector, roi))
+    if ocr is None:
+        if roi:
+            details, image_width, image_height = parse_image_tesseract_roi(context, block_percentile=block_percentile,
+                                                                           detector=detector)
+        else:
+            details, image_width, image_height = parse_image_tesseract(context)
+        ocr = {"details": details, "width": image_width, "height": image_height}
+        if ocr_store is not None:
+            ocr_store.record(context.data, "tesseract", tesseract_store_config(block_percentile, detector, roi), ocr)
+    return score_tesseract(ocr, block_percentile, reduce_factor)
+
+
+def score_yandex(ocr_response: Dict, zones: Dict, block_percentile=0.18, reduce_factor=1.5) -> Dict:
+    """ Уверенность и блоки по ответу YandexOCR и областям get_color_zones ({"regions", "width"}) """
+    from src.utils import filter_color_zones
+    from src.yandex import process_ocr_yandex, process_dict_yandex
+    _, result_dict = process_ocr_yandex(ocr_response, block_percentile, reduce_factor)
+    bounding_boxes = filter_color_zones(zones["regions"], zones["width"], block_percentile)
+    confidence = process_dict_yandex(result_dict, bounding_boxes)
+    boxes = [{"coords": list(sent["coords"]), "side": sent["side"]} for sent in result_dict["sentences"]]
+    return {"confidence": confidence, "boxes": boxes}
+
+
+def run_yandex(file, folder_id, api_key, block_percentile=0.18, reduce_factor=1.5, detector="skimage",
+               pipelined=True, ocr_store=None) -> Dict:
+    """
+    Определяет переписку через YandexOCR.
+
+    pipelined - пока выполняется запрос к OCR, декодировать изображение и искать края, так что задержка
+    ближе к max(сеть, локальная обработка), чем к их сумме; результат не меняется.
+    ocr_store - OCRStore с ответами OCR и областями изображения; при воспроизведении сеть не используется.
+    """
+    from src.utils import color_zone_edges, color_zone_regions
+    from src.yandex_client import get_yandex_client
+    context = ImageContext.from_file(file)
+    data = context.data
+    client = get_yandex_client(folder_id, api_key)
+    config = {"model": "page", "max_width": client.max_width}
+    zones_config = {"detector": detector}
+    ocr_response, zones, edges = None, None, None
+    if ocr_store is not None:
+        ocr_response = ocr_store.lookup(data, "yandex", config)
+        zones = ocr_store.lookup(data, "color_zones", zones_config) if ocr_response is not None else None
+    if ocr_response is None:
+        if pipelined:
+            request = client.submit(context)
+            edges = color_zone_edges(context, detector)
+            ocr_response = request.result()
+        else:
+            ocr_response = client.recognize(context)
+        if 'error' in ocr_response:
+            raise Exception(ocr_response['error'])
+        if ocr_store is not None:
+            ocr_store.record(data, "yandex", config, ocr_response)
+    if zones is None:
+        if edges is None:
+            edges = color_zone_edges(context, detector)
+        _, regions = color_zone_regions(edges, ocr_response, detector)
+        zones = {"regions": regions, "width": edges.shape[1]}
+        if ocr_store is not None:
+            ocr_store.record(data, "color_zones", zones_config, zones)
+    return score_yandex(ocr_response, zones, block_percentile, reduce_factor)
+
+
+def hybrid_ocr_engine(folder_id=None, api_key=None, ocr_engine=None) -> str:
+    """ OCR для движка hybrid: заданный явно, иначе YandexOCR при наличии ключей, иначе Tesseract """
+    if ocr_engine is not None:
+        return ocr_engine
+    return "yandex" if folder_id and api_key else "tesseract"
+
+
+def hybrid_band(scorer="rules") -> Tuple[float, float]:
+    """ Полоса неуверенности hybrid по умолчанию: HYBRID_BAND для формулы, полоса из файла для обученной модели """
+    if scorer == "model":
+        from src.scorer import get_model
+        return get_model().band
+    return HYBRID_BAND
+
+
+def in_band(confidence, band=HYBRID_BAND) -> bool:
+    """ Уверенность без OCR недостаточна для решения: нужно вызвать OCR """
+    return band[0] <= confidence < band[1]
+
+
+def combine_confidence(pixel_confidence, ocr_confidence, ocr_weight=HYBRID_OCR_WEIGHT) -> float:
+    """ Итоговая уверенность hybrid: взвешенное среднее уверенностей без OCR и OCR """
+    return ocr_weight * ocr_confidence + (1 - ocr_weight) * pixel_confidence
+
+
+def run_hybrid(file, folder_id=None, api_key=None, block_percentile=0.18, reduce_factor=None, detector="skimage",
+               roi=False, ocr_engine="tesseract", band=None, pipelined=True, ocr_store=None,
+               scorer="rules") -> Dict:
+    """
+    Определяет переписку без OCR и вызывает OCR (ocr_engine), только если уверенность попала в band (None -
+    hybrid_band оценки scorer); тогда уверенность - combine_confidence, блоки - найденные OCR. Изображение
+    декодируется один раз (общий ImageContext). В результате также pixel_confidence, ocr_engine и ocr_confidence
+    (None без OCR).
+    """
+    context = ImageContext.from_file(file)
+    kwargs = {"reduce_factor": reduce_factor} if reduce_factor is not None else {}
+    result = run_no_ocr(context, block_percentile, detector=detector, scorer=scorer, **kwargs)
+    result.update({"pixel_confidence": result["confidence"], "ocr_engine": None, "ocr_confidence": None})
+    if not in_band(result["confidence"], band if band is not None else hybrid_band(scorer)):
+        return result
+    inc("escalations", ocr=ocr_engine)
+    if ocr_engine == "tesseract":
+        ocr = run_tesseract(context, block_percentile, detector=detector, roi=roi, ocr_store=ocr_store, **kwargs)
+    else:
+        ocr = run_yandex(context, folder_id, api_key, block_percentile, detector=detector, pipelined=pipelined,
+                         ocr_store=ocr_store, **kwargs)
+    result.update({"confidence": combine_confidence(result["confidence"], ocr["confidence"]), "boxes": ocr["boxes"],
+                   "ocr_engine": ocr_engine, "ocr_confidence": ocr["confidence"]})
+    return result
+
+
+def apply_threshold(result: Dict, temp) -> Dict:
+    """ Принимает решение по уже посчитанной уверенности - единственный шаг, зависящий от порога """
+    is_conversation = bool(result["confidence"] >= temp)
+    result.update({
+        "threshold": temp,
+        "is_conversation": is_conversation,
+        "verdict": DECISION_YES if is_conversation else DECISION_NO,
+    })
+    return result
+
+
+def engine_params(engine, block_percentile=0.18, reduce_factor=None, detector="skimage", prefilter=False,
+                  roi=False, ocr_engine=None, band=None, scorer="rules") -> Dict:
+    """
+    Параметры движка, влияющие на результат (и на ключ кэша); значения по умолчанию в ключ не попадают.
+    Для hybrid ocr_engine должен быть уже выбран (hybrid_ocr_engine); band None - hybrid_band(scorer)
+    (полоса модели входит в ключ через версию модели).
+    """
+    params = {"block_percentile": block_percentile}
+    if reduce_factor is not None:
+        params["reduce_factor"] = reduce_factor
+    if detector != "skimage" and (engine != "tesseract" or roi):
+        params["detector"] = detector
+    if prefilter and engine == "no_ocr":
+        params["prefilter"] = True
+    if roi and (engine == "tesseract" or engine == "hybrid" and ocr_engine == "tesseract"):
+        params["roi"] = True
+    if engine == "hybrid":
+        params["ocr_engine"] = ocr_engine
+        if band is not None and tuple(band) != hybrid_band(scorer):
+            params["band"] = list(band)
+    if scorer != "rules" and engine in ("no_ocr", "hybrid"):
+        params["scorer"] = scorer
+    return params
+
+
+def cache_key(data: bytes, engine, params: Dict) -> str:
+    """ Ключ кэша результата движка с параметрами engine_params; для обученной оценки в него входит версия модели """
+    if params.get("scorer") == "model":
+        from src.scorer import get_model
+        return make_cache_key(data, engine, model_version=get_model().version, **params)
+    return make_cache_key(data, engine, **params)
+
+
+def get_cached(cache, data: bytes, engine, temp=0.7, **params) -> Optional[Dict]:
+    """ Ищет результат в кэше без запуска движка и применяет к нему порог """
+    result = cache.get(cache_key(data, engine, engine_params(engine, **params)))
+    if result is None:
+        return None
+    return apply_threshold(dict(result, cached=True, timings={}, counters={}), temp)
+
+
+def put_cached(cache, data: bytes, result: Dict, **params) -> None:
+    """ Кладет в кэш результат classify, посчитанный в другом процессе (без полей, зависящих от порога) """
+    value = {key: result[key] for key in result if key not in NON_CACHED_FIELDS}
+    cache.put(cache_key(data, result["engine"], engine_params(result["engine"], **params)), value)
+
+
+def classify(file, engine="no_ocr", temp=0.7, block_percentile=0.18, folder_id=None, api_key=None,
+             reduce_factor=None, detector="skimage", prefilter=False, roi=False, pipelined=True, cache=None,
+             ocr_store=None, ocr_engine=None, band=None, scorer="rules") -> Dict:
+    """
+    Запускает выбранный движок и возвращает результат в виде словаря, пригодного для JSON.
+
+    :param file: путь к изображению, файловый объект или ImageContext; файл читается и декодируется один раз,
+        все этапы (кэш, OCR, поиск блоков) работают с общим ImageContext.
+    :param engine: один из ENGINES.
+    :param temp: порог уверенности, начиная с которого изображение считается перепиской.
+    :param reduce_factor: понижающий коэффициент границ; None - значение по умолчанию для движка.
+    :param detector: реализация поиска блоков на изображении (image_processing.BOX_DETECTORS).
+    :param prefilter: для no_ocr - отсекать очевидные не переписки по миниатюре (src.prefilter).
+    :param roi: для tesseract - распознавать только блоки сообщений, найденные без OCR.
+    :param pipelined: для yandex - искать края изображения, пока выполняется запрос к OCR.
+    :param ocr_engine: для hybrid - OCR_ENGINES; None - hybrid_ocr_engine по наличию ключей YandexOCR.
+    :param band: для hybrid - полуинтервал уверенности без OCR, в котором вызывается OCR; None - HYBRID_BAND
+        для формулы, полоса из файла для обученной модели (hybrid_band).
+    :param scorer: для no_ocr и hybrid - SCORERS: формула или обученная модель (src.scorer, файл SCORER_MODEL).
+    :param cache: VerdictCache; при попадании движок не запускается.
+    :param ocr_store: OCRStore для записи или воспроизведения ответов OCR (движки tesseract и yandex).
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Неизвестный движок: {engine}")
+    if scorer not in SCORERS:
+        raise ValueError(f"Неизвестная оценка: {scorer}")
+    if engine == "hybrid":
+        ocr_engine = hybrid_ocr_engine(folder_id, api_key, ocr_engine)
+        if ocr_engine not in OCR_ENGINES:
+            raise ValueError(f"Неизвестный OCR: {ocr_engine}")
+    if (engine == "yandex" or engine == "hybrid" and ocr_engine == "yandex") and (not folder_id or not api_key):
+        raise ValueError("Для YandexOCR необходимо указать folder_id и api_key")
+    params = engine_params(engine, block_percentile, reduce_factor, detector, prefilter, roi, ocr_engine, band,
+                           scorer)
+    with trace(engine) as current:
+        context = ImageContext.from_file(file)
+        result = None
+        if cache is not None:
+            key = cache_key(context.data, engine, params)
+            result = cache.get(key)
+            if result is not None:
+                inc("cache_hits")
+                result = dict(result, cached=True)
+            else:
+                inc("cache_misses")
+        if result is None:
+            if engine == "no_ocr":
+                result = run_no_ocr(context, **params)
+            elif engine == "tesseract":
+                result = run_tesseract(context, ocr_store=ocr_store, **params)
+            elif engine == "hybrid":
+                result = run_hybrid(context, folder_id, api_key, pipelined=pipelined, ocr_store=ocr_store, **params)
+            else:
+                result = run_yandex(context, folder_id, api_key, pipelined=pipelined, ocr_store=ocr_store, **params)
+            result.update({
+                "engine": engine,
+                "messages": len(result["boxes"]),
+                "side_switches": count_side_switches([(box["coords"], box["side"]) for box in result["boxes"]])[0],
+                "cached": False,
+            })
+            if cache is not None:
+                cache.put(key, result)
+                result = dict(result)
+    apply_threshold(result, temp)
+    result["timings"] = current.timings
+    result["counters"] = current.counters
+    return result
+
+
+def classify_bytes(data: bytes, **kwargs) -> Dict:
+    """ Обертка над classify для вызова в дочерних процессах (аргументы должны сериализоваться pickle) """
+    return classify(BytesIO(data), **kwargs)
+
+
+def warm_up(engines=("no_ocr",), detector="skimage") -> None:
+    """
+    Прогревает воркер: импортирует модули движков и прогоняет маленькое изображение через выбранные движки,
+    чтобы первый запрос не платил за импорт (skimage и scipy загружаются при первом поиске блоков) и
+    инициализацию (для tesseract создается и загружает модели долгоживущий TessBaseAPI воркера).
+    Обученная оценка (src.scorer), если ее файл есть, загружается здесь же, один раз на воркер.
+    """
+    from PIL import Image
+    buf = BytesIO()
+    Image.new("RGB", (64, 128), (255, 255, 255)).save(buf, format="PNG")
+    # hybrid на пустом изображении не вызывает OCR, поэтому прогреваются движки, из которых он состоит
+    engines = dict.fromkeys(name for engine in engines for name in (("no_ocr",) + OCR_ENGINES
+                                                                    if engine == "hybrid" else (engine,)))
+    if "no_ocr" in engines:
+        from src.scorer import MODEL_PATH, get_model
+        if os.path.exists(MODEL_PATH):
+            get_model()
+    for engine in engines:
+        try:
+            if engine == "yandex":
+                # сетевой запрос не отправляем, чтобы не тратить платные запросы: прогреваем локальную часть
+                from src.utils import color_zone_edges, color_zone_regions
+                from src.yandex import process_ocr_yandex
+                empty_response = {"result": {"textAnnotation": {"blocks": []}}}
+                color_zone_regions(color_zone_edges(BytesIO(buf.getvalue()), detector), empty_response, detector)
+                process_ocr_yandex(empty_response, 0.18)
+            else:
+                classify(BytesIO(buf.getvalue()), engine=engine, detector=detector)
+        except Exception as e:
+            # воркер остается рабочим: движок догрузится на первом запросе, а его ошибка вернется клиенту
+            logger.warning("warm_up %s: %s", engine, e)
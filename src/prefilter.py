@@ -0,0 +1,87 @@
+from typing import Dict, Tuple
+import numpy as np
+from PIL import Image
+from src.image_context import ImageContext
+
+THUMBNAIL_SIZE = 256  # сторона миниатюры, на которой считаются признаки
+CONTENT_THRESHOLD = 12  # насколько цвет пикселя должен отличаться от фона, чтобы считаться содержимым
+EDGE_THRESHOLD = 20  # перепад яркости между соседними пикселями, который считается краем
+PHOTO_ENTROPY = 9.0  # энтропия цветовой гистограммы (бит из 12 возможных), выше которой изображение похоже на фото
+PHOTO_BACKGROUND_SHARE = 0.1  # у фото нет доминирующего цвета фона
+MIN_SIDE_ROWS = 0.01  # минимальная доля строк, где содержимое прилегает только к одному краю
+
+
+def make_thumbnail(file_path) -> Tuple[Image.Image, object]:
+    """
+    Делает RGB-миниатюру для предварительного фильтра.
+
+    Возвращает миниатюру и источник для основного пайплайна: JPEG декодируется в режиме draft сразу в малом
+    размере, поэтому основной пайплайн декодирует файл заново (со своим draft); остальные форматы декодируются
+    один раз, и полное изображение передается дальше, чтобы не декодировать его повторно.
+    ImageContext возвращается как источник без изменений: полное изображение кэшируется в нем.
+    """
+    if isinstance(file_path, ImageContext):
+        # JPEG, который еще не декодирован целиком, по-прежнему уменьшается при декодировании (draft)
+        is_draft = file_path.format == 'JPEG' and not file_path.is_decoded()
+        image = Image.open(file_path.file()) if is_draft else file_path.pil()
+        source = file_path
+    else:
+        image = Image.open(file_path)
+        is_draft = image.format == 'JPEG'
+        source = file_path if is_draft else image
+        if is_draft and hasattr(file_path, 'seek'):
+            file_path.seek(0)
+    if is_draft:
+        image.draft('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    else:
+        image.load()
+    thumbnail = image.convert('RGBA').convert('RGB') if image.mode == 'P' else image.convert('RGB')
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BILINEAR, reducing_gap=2.0)
+    return thumbnail, source
+
+
+def prefilter_features(thumbnail, block_percentile=0.18) -> Dict:
+    """ Дешевые признаки миниатюры: энтропия цветов, доля фона, плотность краев, заполненность краев по строкам """
+    pixels = np.asarray(thumbnail).astype(np.int16)
+    # гистограмма цветов по 4 бита на канал
+    quantized = pixels >> 4
+    indexes = (quantized[..., 0] << 8) | (quantized[..., 1] << 4) | quantized[..., 2]
+    counts = np.bincount(indexes.ravel(), minlength=4096)
+    probabilities = counts[counts > 0] / indexes.size
+    background_index = int(np.argmax(counts))
+    background = np.array([(background_index >> 8) & 15, (background_index >> 4) & 15, background_index & 15]) * 16 + 8
+    # содержимое - пиксели, заметно отличающиеся от цвета фона
+    content = np.abs(pixels - background).max(axis=2) > CONTENT_THRESHOLD
+    height, width = content.shape
+    band = max(1, int(width * block_percentile))
+    left = content[:, :band].any(axis=1)
+    right = content[:, width - band:].any(axis=1)
+    gray = pixels.mean(axis=2)
+    edges = ((np.abs(np.diff(gray, axis=1))[:-1] > EDGE_THRESHOLD) |
+             (np.abs(np.diff(gray, axis=0))[:, :-1] > EDGE_THRESHOLD))
+    # у изображения в одну строку или столбец соседних пикселей для краев нет
+    edge_density = float(edges.mean()) if edges.size else 0.0
+    return {
+        "color_entropy": float(-(probabilities * np.log2(probabilities)).sum()),
+        "background_share": float(counts[background_index] / indexes.size),
+        "edge_density": edge_density,
+        "left_only_rows": float((left & ~right).mean()),
+        "right_only_rows": float((right & ~left).mean()),
+    }
+
+
+def prefilter(thumbnail, block_percentile=0.18) -> Tuple[bool, float, Dict]:
+    """
+    Быстрая проверка по миниатюре.
+
+    :return: (нужна ли полная обработка, уверенность что это не переписка, признаки).
+    Отсекаются только очевидные случаи: фотографии и изображения без содержимого у левого или правого края.
+    """
+    features = prefilter_features(thumbnail, block_percentile)
+    if features["color_entropy"] > PHOTO_ENTROPY and features["background_share"] < PHOTO_BACKGROUND_SHARE:
+        features["reason"] = "photo"
+        return False, 0.9 if features["edge_density"] > 0.15 else 0.75, features
+    if features["left_only_rows"] + features["right_only_rows"] < MIN_SIDE_ROWS:
+        features["reason"] = "no_side_content"
+        return False, 0.8, features
+    return True, 0.0, features
@@ -0,0 +1,41 @@
+from io import BytesIO
+from typing import Iterable
+import cv2
+import numpy as np
+from PIL import Image
+from src.image_context import ImageContext
+
+RED = (255, 0, 0)
+GREEN = (0, 160, 0)
+# цвета заполненной маски как у imshow с палитрой viridis по умолчанию: фон и области
+MASK_BACKGROUND = (68, 1, 84)
+MASK_FOREGROUND = (253, 231, 37)
+
+
+def load_rgb(file) -> np.ndarray:
+    """ Декодирует изображение (путь, файловый объект, PIL Image или ImageContext) в массив RGB uint8 """
+    if isinstance(file, ImageContext):
+        return file.rgb().copy()  # рисуем на копии, массив контекста общий
+    image = file if isinstance(file, Image.Image) else Image.open(file)
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    return np.asarray(image.convert('RGB')).copy()
+
+
+def mask_to_rgb(mask) -> np.ndarray:
+    """ Раскрашивает бинарную маску (результат заполнения дыр) в RGB uint8 """
+    palette = np.array([MASK_BACKGROUND, MASK_FOREGROUND], dtype=np.uint8)
+    return palette[np.asarray(mask, dtype=bool).view(np.uint8)]
+
+
+def draw_boxes(image, boxes: Iterable, color, thickness=3) -> np.ndarray:
+    """ Рисует прямоугольники (x1, y1, x2, y2) прямо на массиве RGB uint8 и возвращает его """
+    for x1, y1, x2, y2 in boxes:
+        cv2.rectangle(image, (int(x1), int(y1)), (int(x2), int(y2)), color, thickness)
+    return image
+
+
+def encode_png(image) -> BytesIO:
+    """ Кодирует массив RGB uint8 в PNG (только когда изображение действительно нужно в виде файла) """
+    _, encoded = cv2.imencode('.png', cv2.cvtColor(image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    return BytesIO(encoded.tobytes())
@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from concurrent.futures import Executor, Future, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, Optional
+from src.image_context import InvalidImage
+from src.metrics import inc, observe, set_gauge
+
+FALLBACK_RESERVE = 0.3  # сколько секунд срока оставляется запасному варианту (вердикту без OCR)
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """ Очередь заполнена: запрос отклонен, не начав выполняться """
+
+
+class DeadlineExceeded(Exception):
+    """ Срок запроса истек, а запасного варианта нет """
+
+
+def call_before(deadline_at, call: Callable):
+    """
+    Выполняет call в воркере, только если срок (time.time(), общий для процессов) еще не истек:
+    задача, которая дождалась воркера слишком поздно, не тратит его время.
+    """
+    if deadline_at is not None and time.time() >= deadline_at:
+        raise DeadlineExceeded("срок запроса истек в очереди")
+    return call()
+
+
+class Scheduler:
+    """
+    Выполнение запросов в пуле (процессов или потоков) со сроками и ограниченной очередью.
+
+    Одновременно принимается не больше max_pending задач (выполняемых и ожидающих воркера), следующая
+    отклоняется (Overloaded) или ждет места (block=True). Если основной вариант (OCR) не ответил за срок без
+    fallback_reserve или упал, возвращается результат запасного варианта с пометкой degraded. Запасной вариант
+    проходит ту же очередь и тот же пул: при заполненной очереди запрос отклоняется (Overloaded), а не
+    выполняется в вызывающем потоке в обход ограничения. Метрики: queue_depth (принятые задачи),
+    queue_wait_seconds, rejected, deadline_misses, fallbacks.
+    """
+
+    def __init__(self, executor: Executor, max_pending, fallback_reserve=FALLBACK_RESERVE):
+        self.executor = executor
+        self.max_pending = max_pending
+        self.fallback_reserve = fallback_reserve
+        self.pending = 0
+        self._slots = threading.Condition()
+        set_gauge("queue_capacity", max_pending)
+        set_gauge("queue_depth", 0)
+
+    def _acquire(self, engine, block, timeout) -> None:
+        with self._slots:
+            if block:
+                self._slots.wait_for(lambda: self.pending < self.max_pending, timeout)
+            if self.pending >= self.max_pending:
+                inc("rejected", engine=engine)
+                raise Overloaded(f"очередь заполнена ({self.max_pending} запросов)")
+            self.pending += 1
+            set_gauge("queue_depth", self.pending)
+
+    def _release(self, _future) -> None:
+        with self._slots:
+            self.pending -= 1
+            set_gauge("queue_depth", self.pending)
+            self._slots.notify()
+
+    def _submit(self, call: Callable, deadline_at, engine, block=False, timeout=None) -> Future:
+        """ Занимает место в очереди (или Overloaded) и отправляет call в пул; место освобождается по завершении """
+        self._acquire(engine, block, timeout)
+        future = self.executor.submit(call_before, deadline_at, call)
+        future.add_done_callback(self._release)
+        return future
+
+    def primary_wait(self, deadline, fallback=True) -> Optional[float]:
+        """ Сколько секунд с приема ждать основной вариант: срок без запаса на запасной вариант (None - без срока) """
+        if deadline is None:
+            return None
+        return max(deadline - self.fallback_reserve, 0) if fallback else deadline
+
+    def run(self, call: Callable, deadline=None, fallback: Optional[Callable] = None, engine="none",
+            block=False) -> Dict:
+        """
+        Выполняет call() в пуле и ждет результат не дольше срока.
+
+        :param call: функция без аргументов (functools.partial), для пула процессов - сериализуемая pickle.
+        :param deadline: срок в секундах с момента приема запроса (ожидание места в очереди входит в него);
+            None - без срока.
+        :param fallback: запасной вариант без аргументов (выполняется в том же пуле); без него истекший срок -
+            DeadlineExceeded.
+        :param block: ждать места в очереди (не дольше deadline) вместо отклонения.
+        :return: результат call или fallback (словарь) с полями degraded и, для запасного, degraded_reason.
+        """
+        accepted_at = time.time()
+        wait = self.primary_wait(deadline, fallback is not None)
+        deadline_at = accepted_at + wait if wait is not None else None
+        future = self._submit(call, deadline_at, engine, block, deadline)
+        start_time = time.perf_counter()
+        try:
+            result = future.result(timeout=max(deadline_at - time.time(), 0) if deadline_at is not None else None)
+            timings = result.get("timings") or {}
+            if "total" in timings:
+                observe("queue_wait_seconds", max(time.perf_counter() - start_time - timings["total"], 0),
+                        engine=engine)
+            return dict(result, degraded=False)
+        except (FutureTimeoutError, DeadlineExceeded):
+            # еще не начатая задача снимается с очереди, начатая освобождает место по завершении
+            future.cancel()
+            inc("deadline_misses", engine=engine)
+            if fallback is None:
+                raise DeadlineExceeded(f"запрос не выполнен за {deadline} с")
+            reason = "deadline"
+        except InvalidImage:
+            # запасной вариант не поможет: изображение не читается ни одним движком
+            raise
+        except Exception as e:
+            if fallback is None:
+                raise
+            logger.warning("%s: %s, используется запасной вариант", engine, e)
+            reason = "error"
+        inc("fallbacks", engine=engine, reason=reason)
+        fallback_at = accepted_at + deadline if deadline is not None else None
+        fallback_future = self._submit(fallback, fallback_at, engine)
+        try:
+            result = fallback_future.result(timeout=max(fallback_at - time.time(), 0) if fallback_at is not None
+                                            else None)
+        except FutureTimeoutError:
+            fallback_future.cancel()
+            raise DeadlineExceeded(f"запрос и запасной вариант не выполнены за {deadline} с")
+        return dict(result, degraded=True, degraded_reason=reason)
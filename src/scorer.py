@@ -0,0 +1,105 @@
+import hashlib
+import os
+import threading
+from typing import Dict, Optional, Tuple
+import numpy as np
+from src.features import FEATURE_NAMES, FEATURES_VERSION
+
+MODEL_FORMAT = 2  # версия формата файла модели
+# полоса неуверенности hybrid по умолчанию для модели: сигмоида не похожа на формулу rules (HYBRID_BAND),
+# уверенность 1.0 почти не достигается, поэтому полоса - вокруг порога 0.7, а не до 1.0
+MODEL_BAND = (0.3, 0.9)
+MODEL_PATH = os.environ.get("SCORER_MODEL", os.path.join("models", "scorer.npz"))
+
+_models = {}  # путь -> ScorerModel, модель загружается один раз на процесс (воркер)
+_models_lock = threading.Lock()
+
+
+class ScorerModel:
+    """
+    Логистическая регрессия над вектором признаков src.features: признаки стандартизуются (mean, scale),
+    уверенность - сигмоида линейной комбинации. Все параметры - массивы NumPy, поэтому оценка одного
+    изображения или пачки (features - (признаки,) или (изображения, признаки)) - одно матричное умножение.
+    version входит в ключ кэша результатов: без явной версии это хэш параметров (digest), поэтому разные модели
+    не делят записи кэша. band - полоса неуверенности, в которой движок hybrid вызывает OCR.
+    """
+
+    def __init__(self, weights, bias, mean, scale, version=None, metadata: Optional[Dict] = None,
+                 band: Tuple[float, float] = MODEL_BAND):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.version = version or self.digest()
+        self.metadata = metadata or {}
+        self.band = (float(band[0]), float(band[1]))
+
+    def digest(self) -> str:
+        """ Хэш параметров модели (версия модели без явной версии) """
+        sha = hashlib.sha256()
+        for array in (self.weights, np.array([self.bias]), self.mean, self.scale):
+            sha.update(np.ascontiguousarray(array).tobytes())
+        return sha.hexdigest()[:16]
+
+    def predict(self, features) -> np.ndarray:
+        """ Уверенность, что изображение - переписка: число для вектора, массив для матрицы признаков """
+        logits = ((np.asarray(features, dtype=np.float64) - self.mean) / self.scale) @ self.weights + self.bias
+        return 1 / (1 + np.exp(-logits))
+
+    def save(self, path) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(f, weights=self.weights, bias=self.bias, mean=self.mean, scale=self.scale,
+                     format=MODEL_FORMAT, features_version=FEATURES_VERSION, feature_names=np.array(FEATURE_NAMES),
+                     version=self.version, band=np.array(self.band),
+                     metadata_keys=np.array(list(self.metadata), dtype=str),
+                     metadata_values=np.array([str(value) for value in self.metadata.values()], dtype=str))
+
+
+def load_model(path=MODEL_PATH) -> ScorerModel:
+    """ Читает модель и проверяет, что она обучена на тех же признаках, что считает src.features """
+    if not os.path.exists(path):
+        raise ValueError(f"Нет модели {path}: обучите ее (python train_scorer.py) или задайте SCORER_MODEL")
+    with np.load(path, allow_pickle=False) as f:
+        if int(f["format"]) != MODEL_FORMAT:
+            raise ValueError(f"Модель {path}: формат {int(f['format'])}, ожидается {MODEL_FORMAT}")
+        if int(f["features_version"]) != FEATURES_VERSION or tuple(f["feature_names"]) != FEATURE_NAMES:
+            raise ValueError(f"Модель {path} обучена на других признаках, переобучите ее (python train_scorer.py)")
+        metadata = dict(zip(f["metadata_keys"].tolist(), f["metadata_values"].tolist()))
+        return ScorerModel(f["weights"], f["bias"], f["mean"], f["scale"], str(f["version"]), metadata,
+                           tuple(f["band"].tolist()))
+
+
+def get_model(path=None) -> ScorerModel:
+    """ Модель процесса: читается при первом обращении (или прогреве воркера) и дальше переиспользуется """
+    path = path or MODEL_PATH
+    with _models_lock:
+        if path not in _models:
+            _models[path] = load_model(path)
+        return _models[path]
+
+
+def train_logistic(features, labels, l2=1.0, iterations=50, tolerance=1e-8) -> ScorerModel:
+    """
+    Обучает ScorerModel методом Ньютона (IRLS) с L2-регуляризацией l2 весов (не сдвига).
+    Признаков мало, поэтому каждая итерация - решение системы размера числа признаков.
+    """
+    features = np.asarray(features, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.float64)
+    mean = features.mean(axis=0)
+    scale = features.std(axis=0)
+    scale[scale == 0] = 1.0  # постоянный на корпусе признак не влияет на оценку
+    design = np.hstack([(features - mean) / scale, np.ones((len(features), 1))])
+    penalty = np.full(design.shape[1], float(l2))
+    penalty[-1] = 0.0
+    params = np.zeros(design.shape[1])
+    for _ in range(iterations):
+        probabilities = 1 / (1 + np.exp(-(design @ params)))
+        gradient = design.T @ (probabilities - labels) + penalty * params
+        hessian = (design * (probabilities * (1 - probabilities))[:, None]).T @ design + np.diag(penalty)
+        step = np.linalg.solve(hessian + 1e-9 * np.eye(len(params)), gradient)
+        params -= step
+        if np.abs(step).max() < tolerance:
+            break
+    return ScorerModel(params[:-1], params[-1], mean, scale)
@@ -1,8 +1,29 @@
 import os
-from typing import Dict, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 import cv2
 import numpy as np
 import pytesseract
+from src.block_merge import TESSERACT_RULES, classify_sides, merge_blocks
+from src.image_context import ImageContext
+from src.image_processing import BOX_DETECTORS, BOXES_MAX_SIZE, is_tall, iter_strip_boxes, scaled_size
+from src.metrics import bind_trace, span, inc, timed
+
+try:
+    import tesserocr
+except ImportError:  # Tesseract в процессе опционален, без него tesseract запускается отдельным процессом
+    tesserocr = None
+
+TESSERACT_LANG = 'eng+rus'
+TESSERACT_ENGINES = ("api", "cli")  # api - tesserocr в процессе, cli - pytesseract (процесс tesseract на запрос)
+TSV_HEADER = "level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext"
+ROI_PSM = 6  # SINGLE_BLOCK: каждый вырезанный блок - один блок текста
+ROI_PADDING = 4  # поля вокруг блока (в пикселях изображения, на котором ищутся блоки)
+ROI_WORKERS = min(4, os.cpu_count() or 1)
+_local = threading.local()
+_roi_pool = None
+_roi_pool_lock = threading.Lock()
 
 
 def parse_ocr_tesseract(processed_result) -> Tuple:
@@ -21,141 +42,192 @@ def parse_ocr_tesseract(processed_result) -> Tuple:
     return alteration, swap_count
 
 
-def process_image_tesseract(details, image_width, image_height, block_percentile) -> Dict:
-    text_blocks = []  # Список для хранения информации о текстовых блоках
-    reduce_factor = 1.37  # коэффициент для уменьшения границ для обнаружения широких блоков
-    full_text = ""  # тут храним весь найденный текст (для чего? кек)
-    current_message = {  # храним данные текущего сообщения
-        "text": "",
-        "coords": [0, 0, 0, -100],  # x1, y1, x2, y2
-        "side": ""  # "response", "user" or "middle"
-    }
-    for i in range(len(details['text'])):
-        if details['text'][i].strip() != '':
-            full_text += f"{details['text'][i]} "
-            # смотрим насколько далеко был предыдущий блок (сравниваем нижнюю y-координату предыдущего
-            # блока с верхней y-координатой текущего), если блок расположен слишком близко, он может относиться
-            # к предыдущей строке (или быть временной отметкой)
-            current_y = details['top'][i]  # текущая верхняя y-координата
-            previous_block_too_close = current_y < current_message["coords"][3] + image_height * 0.02
-            # если верхний левый угол блока находится слева, то предполагаем что это ответ на сообщение
-            if details['left'][i] < image_width * block_percentile:
-                # если текущее предложение отсутствует
-                if current_message["text"] == "":
-                    current_message["coords"] = [details['left'][i], details['top'][i],
-                                                 details['left'][i] + details['width'][i],
-                                                 details['top'][i] + details['height'][i]]
-                    current_message['side'] = "response"
-                else:
-                    # если блок расположен близко к предыдущему, считаем что он ему принадлежит
-                    if previous_block_too_close:
-                        current_message["coords"][0] = min(details['left'][i],
-                                                           current_message["coords"][0])
-                        current_message["coords"][2] = max(details['left'][i] + details['width'][i],
-                                                           current_message["coords"][2])
-                        current_message["coords"][3] = max(details['top'][i] + details['height'][i],
-                                                           current_message["coords"][3])
-                        if (current_message["coords"][2] <= image_width * (1 - block_percentile) and
-                                current_message["coords"][0] <= image_width * block_percentile):
-                            current_message['side'] = "response"
-                    # если это новый блок, добавляем предыдущее сообщение и создаем новое
-                    else:
-                        if not (current_message["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
-                                current_message["coords"][0] <= image_width * (block_percentile / reduce_factor)):
-                            text_blocks.append(current_message.copy())
-                        current_message["text"] = ""
-                        current_message["coords"] = [details['left'][i], details['top'][i],
-                                                     details['left'][i] + details['width'][i],
-                                                     details['top'][i] + details['height'][i]]
-                        current_message['side'] = "response"
-                current_message["text"] += f"{details['text'][i]} "
-            # или если верхний правый угол блока находится справа, то предполагаем что это сообщение пользователя
-            elif details['left'][i] + details['width'][i] > image_width * (1 - block_percentile):
-                # если текущее сообщение отсутствует
-                if current_message["text"] == "":
-                    current_message["coords"] = [details['left'][i], details['top'][i],
-                                                 details['left'][i] + details['width'][i],
-                                                 details['top'][i] + details['height'][i]]
-                    current_message['side'] = "user"
-                else:
-                    # если блок расположен близко к предыдущему, считаем что он ему принадлежит
-                    if previous_block_too_close:
-                        # расширяем х- и y-координаты влево, вправо и вниз
-                        current_message["coords"][0] = min(details['left'][i],
-                                                           current_message["coords"][0])
-                        current_message["coords"][1] = min(details['top'][i],
-                                                           current_message["coords"][1])
-                        current_message["coords"][2] = max(details['left'][i] + details['width'][i],
-                                                           current_message["coords"][2])
-                        current_message["coords"][3] = max(details['top'][i] + details['height'][i],
-                                                           current_message["coords"][3])
-                        # проверяем на сторону, возможно предыдущий блок был слишком близко расположен к процентилю
-                        # границы и неправильно записан в response. проверяем по block_percentile, если ближе к правой
-                        # границе чем к левой то меняем сторону. если сторона=response, то не сменится на user
-                        if (current_message["coords"][2] >= image_width * (1 - block_percentile) and
-                                current_message["coords"][0] >= image_width * block_percentile):
-                            current_message['side'] = "user"
-                    else:
-                        if not (current_message["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
-                                current_message["coords"][0] <= image_width * (block_percentile / reduce_factor)):
-                            text_blocks.append(current_message.copy())
-                        current_message["text"] = ""
-                        current_message["coords"] = [details['left'][i], details['top'][i],
-                                                     details['left'][i] + details['width'][i],
-                                                     details['top'][i] + details['height'][i]]
-                        current_message['side'] = "user"
-                current_message["text"] += f"{details['text'][i]} "
-            # если блок не входит в процентную зону краев картинки
-            else:
-                # если блок расположен близко к предыдущему, считаем что он ему принадлежит
-                if previous_block_too_close:
-                    # расширяем границы текущего блока влево, вправо и вниз
-                    current_message["coords"][0] = min(details['left'][i],
-                                                       current_message["coords"][0])
-                    current_message["coords"][2] = max(details['left'][i] + details['width'][i],
-                                                       current_message["coords"][2])
-                    current_message["coords"][3] = max(details['top'][i] + details['height'][i],
-                                                       current_message["coords"][3])
-                else:
-                    # если предыдущий блок не центральный, а относится к какой-то части, то добавляем его
-                    if (current_message["text"] != "" and not
-                       (current_message["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
-                       current_message["coords"][0] <= image_width * (block_percentile / reduce_factor))):
-                        text_blocks.append(current_message.copy())
-                    current_message["text"] = ""
-                    current_message["coords"] = [details['left'][i], details['top'][i],
-                                                 details['left'][i] + details['width'][i],
-                                                 details['top'][i] + details['height'][i]]
-                    current_message['side'] = "middle"
-                current_message["text"] += f"{details['text'][i]} "
-
-    if (current_message["text"] != "" and not
-       (current_message["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
-       current_message["coords"][0] <= image_width * (block_percentile / reduce_factor))):
-        text_blocks.append(current_message)
+def confidence_tesseract(processed_result) -> float:
+    """ Считает уверенность по результату process_image_tesseract """
+    metrics = parse_ocr_tesseract(processed_result)
+    return round(min(metrics[0] * 0.3 + metrics[1] * 0.05 + processed_result["blocks_overall"] * 0.07, 1.0), 2)
+
+
+@timed("process_image_tesseract")
+def process_image_tesseract(details, image_width, image_height, block_percentile, reduce_factor=1.37) -> Dict:
+    """
+    reduce_factor - коэффициент для уменьшения границ для обнаружения широких блоков.
+    Слова объединяются в сообщения операциями над массивами координат (src.block_merge).
+    """
+    words = [i for i, text in enumerate(details['text']) if text.strip() != '']
+    texts = [f"{details['text'][i]} " for i in words]
+    boxes = np.array([details[key] for key in ('left', 'top', 'width', 'height')], dtype=np.int64).T[words]
+    boxes[:, 2:] += boxes[:, :2]  # x1, y1, x2, y2
+    classes = classify_sides(boxes[:, 0], boxes[:, 2], image_width, block_percentile)
+    text_blocks = merge_blocks(boxes, classes, texts, image_width, image_height, block_percentile, reduce_factor,
+                               TESSERACT_RULES)
     result_dict = {
         "blocks_overall": len(text_blocks),
         "text_blocks": text_blocks,
-        "full_text": full_text
+        "full_text": "".join(texts)
     }
     return result_dict
 
 
-def parse_image_tesseract(file, from_bytes=True):
+REDUCED_GRAYSCALE_FLAGS = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                           (2, cv2.IMREAD_REDUCED_GRAYSCALE_2))
+
+
+def choose_decode_flag(size, max_size=None) -> Tuple[int, int]:
+    """ Флаг cv2.imdecode и коэффициент уменьшения: наибольшее уменьшение, при котором сторона не меньше max_size """
+    if max_size:
+        width, height = size
+        for factor, flag in REDUCED_GRAYSCALE_FLAGS:
+            if max(width, height) / factor >= max_size:
+                return flag, factor
+    return cv2.IMREAD_GRAYSCALE, 1
+
+
+def default_tesseract_engine() -> str:
+    """ Движок по умолчанию: переменная окружения TESSERACT_ENGINE, иначе api, если установлен tesserocr """
+    return os.environ.get("TESSERACT_ENGINE") or ("api" if tesserocr is not None else "cli")
+
+
+def get_tesseract_api():
+    """
+    Долгоживущий экземпляр TessBaseAPI текущего потока (в пуле процессов - по одному на воркер).
+    Языковые модели загружаются один раз при создании. Путь к tessdata берется из TESSDATA_PREFIX.
+    """
+    api = getattr(_local, 'api', None)
+    if api is None:
+        kwargs = {"lang": TESSERACT_LANG, "psm": tesserocr.PSM.SINGLE_COLUMN, "oem": tesserocr.OEM.DEFAULT}
+        if os.environ.get("TESSDATA_PREFIX"):
+            kwargs["path"] = os.environ["TESSDATA_PREFIX"]
+        elif os.name == 'nt':
+            kwargs["path"] = r'C:\Program Files\Tesseract-OCR\tessdata'
+        api = tesserocr.PyTessBaseAPI(**kwargs)
+        _local.api = api
+    return api
+
+
+def image_to_data_api(gray_image, psm=4) -> Dict:
+    """
+    Аналог pytesseract.image_to_data(output_type=DICT) через TessBaseAPI в процессе:
+    массив передается напрямую, без временных файлов и запуска tesseract. psm=4 (SINGLE_COLUMN) как в --psm 4.
+    """
+    api = get_tesseract_api()
+    api.SetPageSegMode(psm)
+    gray_image = np.ascontiguousarray(gray_image)
+    height, width = gray_image.shape
+    api.SetImageBytes(gray_image.tobytes(), width, height, 1, width)
+    api.Recognize()
+    # TSV тот же, что у tesseract с tessedit_create_tsv=1, поэтому разбираем его так же, как pytesseract
+    return pytesseract.pytesseract.file_to_dict(f"{TSV_HEADER}\n{api.GetTSVText(0)}", '\t', -1)
+
+
+def imdecode_gray(context: ImageContext, flag=cv2.IMREAD_GRAYSCALE) -> np.ndarray:
+    """ Оттенки серого cv2.imdecode (коэффициенты OpenCV), декодируются один раз на контекст изображения """
+    return context.cached(("imdecode", flag),
+                          lambda: cv2.imdecode(np.frombuffer(context.data, dtype=np.uint8), flag))
+
+
+def image_to_data(gray_image, psm=4, engine=None) -> Dict:
+    """ Распознает массив в оттенках серого выбранным движком и возвращает словарь как image_to_data """
+    if (engine or default_tesseract_engine()) == "api":
+        return image_to_data_api(gray_image, psm)
+    return pytesseract.image_to_data(gray_image, lang=TESSERACT_LANG, config=f'--oem 3 --psm {psm}',
+                                     output_type=pytesseract.Output.DICT)
+
+
+def parse_image_tesseract(file, from_bytes=True, max_size=None, engine=None):
+    """
+    Распознает текст Tesseract-ом.
+
+    engine - "api" (tesserocr в процессе) или "cli" (pytesseract); по умолчанию api, если установлен tesserocr.
+
+    Изображение сразу декодируется в оттенки серого. Если задан max_size, декодирование идет в уменьшенном
+    в 2/4/8 раз разрешении, а координаты слов пересчитываются обратно в масштаб исходного изображения.
+    file - путь, файловый объект или ImageContext (тогда используется уже декодированное в нем изображение);
+    from_bytes оставлен для совместимости, источник определяет ImageContext.from_file.
+    """
     # устанавливаем путь до тессеракта для Windows
     if os.name == 'nt':
         pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
-    if from_bytes:
-        # Читаем файл как массив байт
-        file_bytes = np.asarray(bytearray(file.read()), dtype=np.uint8)
-        image = cv2.imdecode(file_bytes, 1)
+    with span("decode"):
+        context = ImageContext.from_file(file)
+        flag, factor = choose_decode_flag(context.size, max_size)
+        gray_image = imdecode_gray(context, flag)
+    # Используем Tesseract для распознавания текста и получения детальной информации о расположении текста
+    inc("ocr_pixels", gray_image.size)
+    with span("tesseract_ocr"):
+        details = image_to_data(gray_image, engine=engine)
+    image_height, image_width = gray_image.shape
+    if factor != 1:
+        for key in ('left', 'top', 'width', 'height'):
+            details[key] = [value * factor for value in details[key]]
+        image_width, image_height = context.size
+    inc("ocr_words", sum(1 for text in details['text'] if text.strip() != ''))
+    return details, image_width, image_height
+
+
+def get_roi_pool() -> ThreadPoolExecutor:
+    """ Общий пул потоков для распознавания блоков: потоки живут долго, поэтому их TessBaseAPI переиспользуются """
+    global _roi_pool
+    with _roi_pool_lock:
+        if _roi_pool is None:
+            _roi_pool = ThreadPoolExecutor(max_workers=ROI_WORKERS, thread_name_prefix="tesseract_roi")
+    return _roi_pool
+
+
+def bubble_regions(context: ImageContext, block_percentile=0.18, detector="skimage") -> List:
+    """
+    Ищет блоки сообщений без OCR и возвращает их области (x1, y1, x2, y2) в координатах исходного изображения.
+    Блоки ищутся на уменьшенном изображении, поэтому координаты масштабируются обратно и расширяются на поля.
+    Высокие скриншоты, как и в process_image, обрабатываются полосами ширины STRIP_WIDTH (все полосы: нужны
+    все блоки, а не только уверенность), иначе уменьшение по длинной стороне оставило бы от блоков полоски.
+    """
+    image_width, image_height = context.size
+    if is_tall(context):
+        bounding_boxes, reduced_width = [], image_width
+        for _, strip_boxes, _, (_, reduced_width) in iter_strip_boxes(context, block_percentile, detector=detector):
+            bounding_boxes.extend(strip_boxes)
+        scale = image_width / reduced_width
     else:
-        # Загрузка изображения по пути файла
-        image = cv2.imread(file)
+        bounding_boxes, _ = BOX_DETECTORS[detector](context, block_percentile)
+        scale = image_width / scaled_size(image_width, image_height, BOXES_MAX_SIZE)[0]
+    regions = []
+    for (x, y, width, height), _ in bounding_boxes:
+        regions.append((max(int((x - ROI_PADDING) * scale), 0), max(int((y - ROI_PADDING) * scale), 0),
+                        min(int((x + width + ROI_PADDING) * scale), image_width),
+                        min(int((y + height + ROI_PADDING) * scale), image_height)))
+    return regions
 
-    # Перевод в серый для улучшения распознавания
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    # Используем Tesseract для распознавания текста и получения детальной информации о расположении текста
-    details = pytesseract.image_to_data(gray_image, lang='eng+rus', config=r'--oem 3 --psm 4',
-                                        output_type=pytesseract.Output.DICT)
-    return details, image.shape[1], image.shape[0]
+
+def parse_image_tesseract_roi(file, from_bytes=True, block_percentile=0.18, detector="skimage", engine=None):
+    """
+    Распознает текст только внутри найденных блоков сообщений.
+
+    Сначала блоки ищутся без OCR (image_processing.BOX_DETECTORS), затем каждый блок распознается отдельно
+    (--psm 6) в общем пуле потоков. Координаты слов переводятся в координаты исходного изображения, поэтому
+    результат совместим с process_image_tesseract и draw_rectangles_tesseract.
+    """
+    if os.name == 'nt':
+        pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+    with span("decode"):
+        context = ImageContext.from_file(file)
+        gray_image = imdecode_gray(context)
+    image_height, image_width = gray_image.shape
+    with span("roi"):
+        regions = bubble_regions(context, block_percentile, detector)
+    inc("ocr_regions", len(regions))
+    inc("ocr_pixels", sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in regions))
+    details = {key: [] for key in TSV_HEADER.split("\t")}
+    with span("tesseract_ocr"):
+        crops = [gray_image[y1:y2, x1:x2] for x1, y1, x2, y2 in regions]
+        # этапы и счетчики распознавания в потоках пула относятся к текущему запросу
+        recognize = bind_trace(lambda crop: image_to_data(crop, ROI_PSM, engine))
+        results = get_roi_pool().map(recognize, crops)
+        # блоки идут сверху вниз, как и слова при распознавании целой страницы
+        for block_num, ((x1, y1, _, _), result) in enumerate(zip(regions, results), start=1):
+            result['block_num'] = [block_num] * len(result['text'])
+            result['left'] = [value + x1 for value in result['left']]
+            result['top'] = [value + y1 for value in result['top']]
+            for key in details:
+                details[key].extend(result[key])
+    inc("ocr_words", sum(1 for text in details['text'] if text.strip() != ''))
+    return details, image_width, image_height
@@ -1,15 +1,14 @@
 import base64
+import os
 import cv2
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from PIL import Image
 import numpy as np
-from typing import Tuple
-from io import BytesIO
-from skimage.color import rgb2gray
-from skimage.feature import canny
-from skimage.measure import label, regionprops
-import scipy.ndimage as nd
+from typing import List, Tuple
+from src.buffers import get_buffers, take
+from src.image_context import ImageContext
+from src.image_processing import decode_gray, canny_cv, fill_holes_cv
+from src.metrics import span, inc, timed
+from src.render import GREEN, RED, draw_boxes, encode_png, load_rgb, mask_to_rgb
+from src.yandex import get_coords_yandex
 
 
 def encode_file_to_base64(file) -> str:
@@ -18,6 +17,26 @@ def encode_file_to_base64(file) -> str:
     return encoded_content.decode('utf-8')
 
 
+def get_image_files(directory, extensions=('.png', '.jpg', '.jpeg')) -> List[str]:
+    """ Возвращает отсортированный список путей к изображениям в указанной директории (рекурсивно) """
+    image_files = []
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if file.lower().endswith(extensions):
+                image_files.append(os.path.join(root, file))
+    return sorted(image_files)
+
+
+def read_file_bytes(file) -> bytes:
+    """ Возвращает содержимое файла (путь, загруженный файл streamlit, BytesIO или ImageContext) в виде байт """
+    if isinstance(file, ImageContext):
+        return file.data
+    if hasattr(file, 'getvalue'):
+        return file.getvalue()
+    with open(file, 'rb') as f:
+        return f.read()
+
+
 def elapsed_time(start_time, end_time) -> str:
     """ Получает разницу во времени и возвращает форматированное значение """
     elapsed = end_time - start_time
@@ -26,124 +45,81 @@ def elapsed_time(start_time, end_time) -> str:
     return f"{elapsed:.2f} секунд"
 
 
-def draw_rectangles_yandex(image_path, blocks, sentences) -> BytesIO:
+@timed("render")
+def draw_rectangles_yandex(image_path, blocks, sentences, encode=True):
     """
     Отображает прямоугольники на изображении.
 
     :param sentences: список найденных предложений с прямоугольниками (x1, x2, y1, y2)
-    :param image_path: путь к файлу изображения.
+    :param image_path: путь к файлу изображения или ImageContext.
     :param blocks: список прямоугольников, где каждый прямоугольник задается как (x, y, width, height).
+    :param encode: вернуть PNG в BytesIO; False - массив RGB uint8 без кодирования.
     """
-    # Загрузка изображения
-    img = Image.open(image_path)
-    if img.mode == 'P':
-        img = img.convert('RGBA').convert('RGB')
-    img_np = np.array(img)
-
-    dpi = 300  # Разрешение в точках на дюйм, можно адаптировать
-    height, width, _ = img_np.shape
-    figsize = width / float(dpi), height / float(dpi)  # Размер фигуры в дюймах
-    # Создание фигуры и осей
-    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
-    ax.imshow(img_np)
-
+    img = load_rgb(image_path)
     # Добавление прямоугольников OCR
-    for block in blocks:
-        x = int(block['boundingBox']['vertices'][0]['x'])
-        y = int(block['boundingBox']['vertices'][0]['y'])
-        width = int(block['boundingBox']['vertices'][2]['x']) - x
-        height = int(block['boundingBox']['vertices'][2]['y']) - y
-        rect = patches.Rectangle((x, y), width, height, linewidth=0.9, edgecolor='r', facecolor='none')
-        ax.add_patch(rect)
-
+    draw_boxes(img, (get_coords_yandex(block) for block in blocks), RED, 4)
     # Добавление прямоугольников Processed_OCR
-    for sent in sentences:
-        rect = patches.Rectangle((sent["coords"][0], sent["coords"][1]),
-                                 sent["coords"][2] - sent["coords"][0],
-                                 sent["coords"][3] - sent["coords"][1],
-                                 linewidth=1, edgecolor='g', facecolor='none')
-        ax.add_patch(rect)
-
-    # Убираем оси и белые поля
-    ax.axis('off')
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+    draw_boxes(img, (sent["coords"] for sent in sentences), GREEN, 4)
+    return encode_png(img) if encode else img
 
-    # Сохраняем фигуру в объект BytesIO для последующего использования в Streamlit
-    buf = BytesIO()
-    plt.savefig(buf, format='png')
-    plt.close(fig)
-    buf.seek(0)
 
-    # Возвращаем объект BytesIO, который можно отобразить в Streamlit
-    return buf
-
-
-def draw_rectangles_tesseract(image_path, ocr_result, text_blocks) -> BytesIO:
+@timed("render")
+def draw_rectangles_tesseract(image_path, ocr_result, text_blocks, encode=True):
     """
     Отображает прямоугольники на изображении.
 
-    :param image_path: путь к файлу изображения.
+    :param image_path: путь к файлу изображения или ImageContext.
     :param ocr_result: результат обработки OCR
     :param text_blocks: список обработанных предложений, где каждый прямоугольник задается как (x1, x2, y1, y2).
+    :param encode: вернуть PNG в BytesIO; False - массив RGB uint8 без кодирования.
     """
-    # Загрузка изображения
-    img = Image.open(image_path)
-    img_np = np.array(img)
-
-    dpi = 300  # Разрешение в точках на дюйм, можно адаптировать
-    height, width, _ = img_np.shape
-    figsize = width / float(dpi), height / float(dpi)  # Размер фигуры в дюймах
-    # Создание фигуры и осей
-    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
-    ax.imshow(img_np)
-
+    img = load_rgb(image_path)
     # Добавление сырых прямоугольников OCR
-    for i in range(len(ocr_result['text'])):
-        if ocr_result['text'][i] != '':
-            rect = patches.Rectangle((ocr_result["left"][i], ocr_result["top"][i]),
-                                     ocr_result["width"][i], ocr_result["height"][i],
-                                     linewidth=0.7, edgecolor='r', facecolor='none')
-            ax.add_patch(rect)
-
+    draw_boxes(img, ((left, top, left + width, top + height) for text, left, top, width, height
+                     in zip(ocr_result['text'], ocr_result['left'], ocr_result['top'], ocr_result['width'],
+                            ocr_result['height']) if text != ''), RED)
     # Добавление обработанных прямоугольников OCR
-    for sent in text_blocks:
-        rect = patches.Rectangle((sent["coords"][0], sent["coords"][1]),
-                                 sent["coords"][2] - sent["coords"][0],
-                                 sent["coords"][3] - sent["coords"][1],
-                                 linewidth=0.9, edgecolor='g', facecolor='none')
-        ax.add_patch(rect)
-
-    # Убираем оси и белые поля
-    ax.axis('off')
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    # Сохраняем фигуру в объект BytesIO для последующего использования в Streamlit
-    buf = BytesIO()
-    plt.savefig(buf, format='png')
-    plt.close(fig)
-    buf.seek(0)
-
-    # Возвращаем объект BytesIO, который можно отобразить в Streamlit
-    return buf
-
-
-def get_color_zones(file, ocr_responce, block_percentile=0.19, reduce_factor=1.7) -> Tuple:
-    image = Image.open(file)
-    if image.mode == 'RGBA':
-        image = image.convert('RGB')
-    if image.mode == 'P':
-        image = image.convert('RGBA').convert('RGB')
-    gray_image = rgb2gray(image)
-    # noise removal
-    kernel = np.ones((1, 1), np.uint8)
-    gray_image = cv2.morphologyEx(gray_image, cv2.MORPH_CLOSE, kernel, iterations=1)
-    # Если изображение слишком светлое, повышаем контрастность изображения
-    if np.mean(gray_image) > 0.93:
-        sigma = 0.8
-    else:
-        sigma = 1.1
-    # Выделяем края
-    edges = canny(gray_image, sigma=sigma, low_threshold=0)
+    draw_boxes(img, (sent["coords"] for sent in text_blocks), GREEN, 4)
+    return encode_png(img) if encode else img
+
+
+def color_zone_edges(file, detector="skimage") -> np.ndarray:
+    """
+    Края изображения для get_color_zones - часть обработки, не зависящая от ответа OCR.
+    file - путь, файловый объект или ImageContext (полноразмерное изображение в оттенках серого кэшируется в нем).
+    detector="lowmem" - как opencv, но промежуточные массивы пишутся в буферы потока (src.buffers).
+    """
+    buffers = get_buffers() if detector == "lowmem" else None
+    with span("decode"):
+        image = decode_gray(file)
+        gray_image = np.asarray(image) / 255.0 if detector == "skimage" else np.asarray(image)
+    with span("canny"):
+        # noise removal
+        kernel = np.ones((1, 1), np.uint8)
+        gray_image = cv2.morphologyEx(gray_image, cv2.MORPH_CLOSE, kernel, iterations=1,
+                                      dst=take(buffers, "slot1", gray_image.shape, gray_image.dtype))
+        brightness = np.mean(gray_image) if detector == "skimage" else np.mean(gray_image) / 255
+        # Если изображение слишком светлое, повышаем контрастность изображения
+        if brightness > 0.93:
+            sigma = 0.8
+        else:
+            sigma = 1.1
+        # Выделяем края
+        if detector == "skimage":
+            from skimage.feature import canny
+            edges = canny(gray_image, sigma=sigma, low_threshold=0)
+        else:
+            edges = canny_cv(gray_image, sigma, buffers=buffers)
+    # края живут дольше вызова (color_zone_regions их изменяет), поэтому из буфера копируются
+    return edges.copy() if buffers is not None else edges
+
+
+def color_zone_regions(edges, ocr_responce, detector="skimage") -> Tuple:
+    """
+    Убирает из краев найденный OCR текст, заполняет дыры и возвращает заполненное изображение и все области
+    (min_row, min_col, max_row, max_col). Области не зависят от block_percentile, поэтому их можно сохранить
+    (src.ocr_store) и перебирать параметры без повторной обработки изображения.
+    """
     # Убираем из краев найденный текст - таким образом уменьшаем шум для заполнения краев
     for block in ocr_responce['result']['textAnnotation']['blocks']:
         x, y, width, height = (int(block['boundingBox']['vertices'][0]['x']),
@@ -153,42 +129,66 @@ def get_color_zones(file, ocr_responce, block_percentile=0.19, reduce_factor=1.7
                                int(block['boundingBox']['vertices'][2]['y']) - int(
                                    block['boundingBox']['vertices'][0]['y']))
         edges[y:y + height, x:x + width] = False
-    # Заполняем дыры - для уменьшения шума при нахождении границ
-    fill_im = nd.binary_fill_holes(edges)
-    # Маркировка компонентов
-    labeled_image = label(fill_im)
-    # Получение свойств каждой маркированной области
-    props = regionprops(labeled_image)
-
-    dpi = 300  # Разрешение в точках на дюйм, можно адаптировать
-    height, width = image.height, image.width
-    figsize = width / float(dpi), height / float(dpi)  # Размер фигуры в дюймах
-    # Создание фигуры и осей
-    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
-    ax.imshow(fill_im)
+    if detector == "skimage":
+        import scipy.ndimage as nd
+        from skimage.measure import label, regionprops
+        # Заполняем дыры - для уменьшения шума при нахождении границ
+        with span("fill_holes"):
+            fill_im = nd.binary_fill_holes(edges)
+        # Маркировка компонентов
+        with span("label"):
+            labeled_image = label(fill_im)
+            # Получение свойств каждой маркированной области
+            regions = [prop.bbox for prop in regionprops(labeled_image)]
+    else:
+        buffers = get_buffers() if detector == "lowmem" else None
+        with span("fill_holes"):
+            fill_im = fill_holes_cv(edges, buffers)
+        with span("label"):
+            _, _, stats, _ = cv2.connectedComponentsWithStats(
+                fill_im, labels=take(buffers, "slot1", fill_im.shape, np.int32), connectivity=8, ltype=cv2.CV_32S)
+            regions = [(y, x, y + height, x + width) for x, y, width, height, _ in stats[1:].tolist()]
+        fill_im = fill_im > 0
+    inc("labels", len(regions))
+    return fill_im, regions
+
+
+def filter_color_zones(regions, image_width, block_percentile=0.19, reduce_factor=1.7) -> List:
+    """ Оставляет области, похожие на блоки сообщений, и возвращает их как (x1, y1, x2, y2) """
     bounding_boxes = []
-    for prop in props:
-        y, x, max_row, max_col = prop.bbox
+    for y, x, max_row, max_col in regions:
         # Рассчитываем width и height
         width = max_col - x
         height = max_row - y
         # не пропускаем мелкие блоки, а также смотрим на координаты блока,
         # принадлежит ли блок левой или правой стороне (но не обеим сторонам сразу с понижающим фактором)
         if ((width > 17 and height > 17)
-                and (x <= image.width * block_percentile or x + width >= image.width * (1 - block_percentile))
-                and not (x <= image.width * (block_percentile / reduce_factor) and
-                         x + width >= image.width * (1 - block_percentile / reduce_factor))):
-            rect = patches.Rectangle((x, y),
-                                     width, height,
-                                     linewidth=0.8, edgecolor='r', facecolor='none')
-            ax.add_patch(rect)  # добавляем на картинку
+                and (x <= image_width * block_percentile or x + width >= image_width * (1 - block_percentile))
+                and not (x <= image_width * (block_percentile / reduce_factor) and
+                         x + width >= image_width * (1 - block_percentile / reduce_factor))):
             bounding_boxes.append((x, y, x + width, y + height))  # добавляем в список
+    inc("boxes", len(bounding_boxes))
+    return bounding_boxes
+
+
+def draw_color_zones(fill_im, bounding_boxes) -> np.ndarray:
+    """ Рисует блоки (x1, y1, x2, y2) поверх заполненного изображения get_color_zones, возвращает массив RGB """
+    return draw_boxes(mask_to_rgb(fill_im), bounding_boxes, RED)
 
-    # Убираем оси и белые поля
-    ax.axis('off')
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-    buf = BytesIO()
-    plt.savefig(buf, format='png')
-    plt.close(fig)
-    buf.seek(0)
+
+def get_color_zones(file, ocr_responce, block_percentile=0.19, reduce_factor=1.7, detector="skimage",
+                    edges=None) -> Tuple:
+    """
+    detector - "skimage", "opencv" (uint8-примитивы OpenCV, см. image_processing.get_bounding_boxes_cv)
+    или "lowmem" (то же, что opencv, с переиспользуемыми буферами).
+    edges - уже посчитанный color_zone_edges(file, detector), например пока выполнялся запрос к OCR.
+    """
+    if edges is None:
+        edges = color_zone_edges(file, detector)
+    image_height, image_width = edges.shape
+    fill_im, regions = color_zone_regions(edges, ocr_responce, detector)
+    bounding_boxes = filter_color_zones(regions, image_width, block_percentile, reduce_factor)
+
+    with span("render"):
+        buf = encode_png(draw_color_zones(fill_im, bounding_boxes))
     return buf, bounding_boxes
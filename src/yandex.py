@@ -1,7 +1,11 @@
 from typing import List, Tuple, Dict
+import base64
 import re
 import numpy as np
-import requests
+from src.block_merge import YANDEX_RULES, classify_sides, merge_blocks
+from src.metrics import inc, timed
+
+TIMESTAMP_PATTERN = re.compile(r'^([0-9]|1[0-9]|2[0-3]):([0-5][0-9])$')
 
 
 def get_coords_yandex(block) -> List:
@@ -12,29 +16,18 @@ def get_coords_yandex(block) -> List:
 
 
 def send_ocr_request_yandex(iam_token, encoded_image, folder_id) -> str:
-    """ Отправляет OCR запрос и возвращает результат в json формате. """
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Api-Key {iam_token}",
-        "x-folder-id": folder_id,
-        "x-data-logging-enabled": "true"
-    }
-
-    body = {
-        "mimeType": "JPEG",
-        "languageCodes": ["*"],
-        "model": "page",
-        "content": encoded_image
-    }
+    """ Отправляет OCR запрос и возвращает результат в json формате (через общий клиент с пулом соединений). """
+    from src.yandex_client import get_yandex_client, mime_type_yandex
+    mime_type = mime_type_yandex(base64.b64decode(encoded_image[:12]))
+    return get_yandex_client(folder_id, iam_token).send(encoded_image, mime_type)
 
-    response = requests.post("https://ocr.api.cloud.yandex.net/ocr/v1/recognizeText", headers=headers, json=body)
-    return response.json()
 
-
-def process_ocr_yandex(ocr_text, block_percentile) -> Tuple[str, dict]:
-    """ Отправляет GPT запрос и возвращает результат в json формате. """
-    reduce_factor = 1.5
-    timestamp_pattern = re.compile(r'^([0-9]|1[0-9]|2[0-3]):([0-5][0-9])$')
+@timed("process_ocr_yandex")
+def process_ocr_yandex(ocr_text, block_percentile, reduce_factor=1.5) -> Tuple[str, dict]:
+    """
+    Объединяет блоки ответа YandexOCR в сообщения и возвращает полный текст и словарь с сообщениями.
+    Блоки объединяются операциями над массивами координат (src.block_merge).
+    """
     full_text = ""
     result_dict = {
         "sentences": []  # обработанные предложения
@@ -50,106 +43,26 @@ def process_ocr_yandex(ocr_text, block_percentile) -> Tuple[str, dict]:
         return full_text, result_dict
     image_width = int(text_annotation["width"])
     image_height = int(text_annotation["height"])
-    result_dict["blocks_overall"] = len(text_annotation['blocks'])
-    # храним данные предыдущего сообщения
-    current_sentence = {
-        "text": "",
-        "coords": [0, 0, 0, 0],  # x1, y1, x2, y2
-        "side": "middle",  # "response", "user" or "middle"
-    }
-    for block in text_annotation['blocks']:
+    blocks = text_annotation['blocks']
+    result_dict["blocks_overall"] = len(blocks)
+    inc("ocr_blocks", len(blocks))
+    inc("ocr_words", sum(len(line.get('words', [])) for block in blocks for line in block['lines']))
+    if not blocks:
+        return full_text, result_dict
+    # один проход по блокам: x1, y1, x2, y2 и x правого верхнего угла (по нему определяется сообщение
+    # пользователя), текст и признак отметки времени
+    vertices, texts, is_time_block = [], [], []
+    for block in blocks:
+        points, lines = block['boundingBox']['vertices'], block['lines']
+        vertices.append((points[0]['x'], points[0]['y'], points[2]['x'], points[2]['y'], points[3]['x']))
+        texts.append("".join([f"{line['text']} " for line in lines]))
         # если в блоке одна строка со временем, считаем её за временную отметку сообщения (надо?)
-        is_time_block = len(block['lines']) == 1 and timestamp_pattern.match(block['lines'][0]['text']) is not None
-        # смотрим насколько далеко был предыдущий блок (сравниваем нижнюю y-координату предыдущего
-        # блока с верхней y-координатой текущего)
-        # если блок расположен слишком близко, он может относиться
-        # к предыдущей строке (или быть временной отметкой)
-        current_y = int(block['boundingBox']['vertices'][0]['y'])  # текущая верхняя y-координата
-        previous_block_too_close = current_y < current_sentence["coords"][3] + image_height * 0.02
-        # если сообщение со временем и слишком близко - скорее всего это время сообщения, игнорируем
-        if is_time_block and previous_block_too_close:
-            continue
-        # если левая координата блока находится в левой части картинки, то предполагаем что это ответ на сообщение
-        if int(block['boundingBox']['vertices'][0]['x']) < image_width * block_percentile:
-            # если текущее предложение отсутствует
-            if current_sentence["text"] == "":
-                current_sentence["coords"] = get_coords_yandex(block)
-                current_sentence['side'] = "response"
-            else:
-                # если блок расположен близко к предыдущему, считаем что он ему принадлежит
-                if previous_block_too_close:
-                    current_sentence["coords"][2] = max(int(block['boundingBox']['vertices'][2]['x']),
-                                                        current_sentence["coords"][2])
-                    current_sentence["coords"][3] = max(int(block['boundingBox']['vertices'][2]['y']),
-                                                        current_sentence["coords"][3])
-                # если это новый блок, добавляем предыдущее сообщение и создаем новое
-                else:
-                    if (current_sentence['side'] != "middle" and
-                        not (current_sentence["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
-                             current_sentence["coords"][0] <= image_width * (block_percentile / reduce_factor))):
-                        result_dict["sentences"].append(current_sentence.copy())
-                    current_sentence["text"] = ""
-                    current_sentence["coords"] = get_coords_yandex(block)
-                    current_sentence['side'] = "response"
-            for line in block["lines"]:
-                current_sentence["text"] += f"{line['text']} "
-        # или если верхний правый угол блока находится справа, то предполагаем что это сообщение пользователя
-        elif int(block['boundingBox']['vertices'][3]['x']) > image_width * (1 - block_percentile):
-            # если текущее предложение отсутствует
-            if current_sentence["text"] == "":
-                current_sentence["coords"] = get_coords_yandex(block)
-                current_sentence['side'] = "user"
-            else:
-                # если блок расположен близко к предыдущему, считаем что он ему принадлежит
-                if previous_block_too_close:
-                    # расширяем х- и y-координаты влево, вправо и вниз
-                    current_sentence["coords"][0] = min(int(block['boundingBox']['vertices'][0]['x']),
-                                                        current_sentence["coords"][0])
-                    current_sentence["coords"][1] = min(int(block['boundingBox']['vertices'][0]['y']),
-                                                        current_sentence["coords"][1])
-                    current_sentence["coords"][2] = max(int(block['boundingBox']['vertices'][2]['x']),
-                                                        current_sentence["coords"][2])
-                    current_sentence["coords"][3] = max(int(block['boundingBox']['vertices'][2]['y']),
-                                                        current_sentence["coords"][3])
-                    # проверяем на сторону, возможно предыдущий блок был слишком близко расположен к процентилю
-                    # границы и неправильно записан в response. проверяем по block_percentile / 2
-                    # если ближе к правой границе чем к левой то меняем сторону
-                    if (current_sentence["coords"][2] >= image_width * (1 - block_percentile) and
-                            current_sentence["coords"][0] >= image_width * (block_percentile / reduce_factor)):
-                        current_sentence['side'] = "user"
-                else:
-                    result_dict["sentences"].append(current_sentence.copy())
-                    current_sentence["text"] = ""
-                    current_sentence["coords"] = get_coords_yandex(block)
-                    current_sentence['side'] = "user"
-            for line in block["lines"]:
-                current_sentence["text"] += f"{line['text']} "
-        # если блок не входит в процентную зону краев картинки
-        else:
-            # если блок расположен близко к предыдущему, считаем что он ему принадлежит
-            if previous_block_too_close:
-                # расширяем границы текущего блока влево, вправо и вниз
-                current_sentence["coords"][0] = min(int(block['boundingBox']['vertices'][0]['x']),
-                                                    current_sentence["coords"][0])
-                current_sentence["coords"][2] = max(int(block['boundingBox']['vertices'][2]['x']),
-                                                    current_sentence["coords"][2])
-                current_sentence["coords"][3] = max(int(block['boundingBox']['vertices'][2]['y']),
-                                                    current_sentence["coords"][3])
-            else:
-                # если предыдущий блок не центральный, а относится к какой-то части, то добавляем его
-                if (current_sentence['side'] != "middle" and
-                        not (current_sentence["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
-                             current_sentence["coords"][0] <= image_width * (block_percentile / reduce_factor))):
-                    result_dict["sentences"].append(current_sentence.copy())
-                current_sentence["text"] = ""
-                current_sentence["coords"] = get_coords_yandex(block)
-                current_sentence['side'] = "middle"
-            for line in block["lines"]:
-                current_sentence["text"] += f"{line['text']} "
-    if (current_sentence['side'] != "middle" and
-            not (current_sentence["coords"][2] >= image_width * (1 - block_percentile / reduce_factor) and
-                 current_sentence["coords"][0] <= image_width * (block_percentile / reduce_factor))):
-        result_dict["sentences"].append(current_sentence)
+        is_time_block.append(len(lines) == 1 and TIMESTAMP_PATTERN.match(lines[0]['text']) is not None)
+    vertices = np.array(vertices, dtype=np.int64)
+    is_time_block = np.array(is_time_block)
+    classes = classify_sides(vertices[:, 0], vertices[:, 4], image_width, block_percentile)
+    result_dict["sentences"] = merge_blocks(vertices[:, :4], classes, texts, image_width, image_height,
+                                            block_percentile, reduce_factor, YANDEX_RULES, skip=is_time_block)
     return full_text, result_dict
 
 
@@ -0,0 +1,255 @@
+import asyncio
+import base64
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Tuple
+import requests
+import urllib3
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from src.image_context import ImageContext
+from src.metrics import bind_trace, inc, timed
+
+YANDEX_OCR_URL = "https://ocr.api.cloud.yandex.net/ocr/v1/recognizeText"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_PAYLOAD_WIDTH = 1280  # шире текст скриншота не становится разборчивее, а запрос растет
+JPEG_QUALITY = 90
+RESPONSE_CHUNK = 64 * 1024  # ответ читается частями, между которыми проверяется общий срок запроса
+
+_clients = {}  # (folder_id, api_key, url) -> YandexOCRClient
+_clients_lock = threading.Lock()
+
+
+def mime_type_yandex(data: bytes) -> str:
+    """ Тип изображения для поля mimeType по сигнатуре файла """
+    return "PNG" if data[:8] == b'\x89PNG\r\n\x1a\n' else "JPEG"
+
+
+def flatten_alpha(image: Image.Image) -> Image.Image:
+    """ Изображение с прозрачностью накладывается на белый фон, как его показывает мессенджер; остальные - как есть """
+    if image.mode not in ('RGBA', 'LA', 'PA') and not (image.mode == 'P' and 'transparency' in image.info):
+        return image
+    image = image.convert('RGBA')
+    background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+    return Image.alpha_composite(background, image).convert('RGB')
+
+
+def read_before(response: requests.Response, deadline) -> bytes:
+    """
+    Читает тело ответа до общего срока (time.monotonic()): таймаут requests ограничивает каждое чтение сокета,
+    а не весь ответ, поэтому перед каждым чтением таймаут сокета уменьшается до оставшегося срока.
+    """
+    chunks = []
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            response.close()
+            raise requests.Timeout("deadline exceeded while reading response")
+        connection = response.raw.connection
+        if connection is not None and connection.sock is not None:
+            connection.sock.settimeout(remaining)
+        try:
+            chunk = response.raw.read1(RESPONSE_CHUNK, decode_content=True)
+        except urllib3.exceptions.HTTPError as e:
+            response.close()
+            raise requests.ConnectionError(e)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def shrink_payload(data, max_width=MAX_PAYLOAD_WIDTH, quality=JPEG_QUALITY) -> Tuple[bytes, str, Tuple]:
+    """
+    Уменьшает изображение перед отправкой в OCR.
+
+    Широкие изображения уменьшаются до max_width по ширине (высота для длинных скриншотов не ограничивается),
+    затем перекодируются в JPEG в оттенках серого; отправляется наименьший из вариантов (исходный файл
+    рассматривается, только если его не нужно уменьшать и в нем нет прозрачности).
+    data - байты или ImageContext: PNG берется из контекста (декодируется один раз вместе с остальными этапами),
+    JPEG по-прежнему уменьшается при декодировании (draft), поэтому результат не зависит от порядка этапов.
+    :return: (байты, mimeType, (масштаб по x, масштаб по y)) - масштаб переводит координаты ответа в исходные.
+    """
+    context = ImageContext.from_file(data)
+    data = context.data
+    image = Image.open(context.file()) if context.format == 'JPEG' else context.pil()
+    width, height = image.size
+    size = (width, height)
+    candidates = []
+    if width > max_width:
+        size = (max_width, max(1, round(height * max_width / width)))
+        if image.format == 'JPEG':
+            image.draft('L', size)
+    elif flatten_alpha(image) is image:
+        # исходный файл с прозрачностью не отправляется: прозрачный фон сервис может прочитать как черный
+        candidates.append((data, mime_type_yandex(data)))
+    if width > max_width or image.format != 'JPEG':
+        gray = flatten_alpha(image).convert('L')
+        if gray.size != size:
+            gray = gray.resize(size, Image.BILINEAR, reducing_gap=2.0)
+        buf = BytesIO()
+        gray.save(buf, format='JPEG', quality=quality)
+        candidates.append((buf.getvalue(), "JPEG"))
+    payload, mime_type = min(candidates, key=lambda candidate: len(candidate[0]))
+    return payload, mime_type, (width / size[0], height / size[1])
+
+
+def rescale_response(response: Dict, scale) -> Dict:
+    """ Переводит координаты ответа YandexOCR (блоки, строки, слова) в масштаб исходного изображения """
+    scale_x, scale_y = scale
+    if scale_x == 1 and scale_y == 1:
+        return response
+    text_annotation = response.get('result', {}).get('textAnnotation')
+    if text_annotation is None:
+        return response
+
+    def rescale(item):
+        for vertex in item.get('boundingBox', {}).get('vertices', []):
+            vertex['x'] = str(round(int(vertex.get('x', 0)) * scale_x))
+            vertex['y'] = str(round(int(vertex.get('y', 0)) * scale_y))
+
+    text_annotation['width'] = str(round(int(text_annotation['width']) * scale_x))
+    text_annotation['height'] = str(round(int(text_annotation['height']) * scale_y))
+    for block in text_annotation.get('blocks', []):
+        rescale(block)
+        for line in block.get('lines', []):
+            rescale(line)
+            for word in line.get('words', []):
+                rescale(word)
+    return response
+
+
+class YandexOCRClient:
+    """
+    Клиент YandexOCR с пулом соединений (одна сессия на клиент, без TLS-рукопожатия на каждый запрос),
+    общим сроком на запрос и повторами при сетевых ошибках и ответах 429/5xx.
+
+    Ошибки не пробрасываются: как и ответ API с ошибкой, они возвращаются словарем с ключом 'error'.
+    """
+
+    def __init__(self, api_key, folder_id, url=YANDEX_OCR_URL, deadline=20.0, connect_timeout=3.05, retries=2,
+                 backoff=0.5, pool_size=8, max_width=MAX_PAYLOAD_WIDTH):
+        self.api_key = api_key
+        self.folder_id = folder_id
+        self.url = url
+        self.deadline = deadline
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_width = max_width
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Api-Key {api_key}",
+            "x-folder-id": folder_id,
+            "x-data-logging-enabled": "true"
+        })
+
+    @timed("yandex_request")
+    def send(self, encoded_image, mime_type="JPEG") -> Dict:
+        """ Отправляет изображение в base64 как есть и возвращает ответ в json формате """
+        body = {
+            "mimeType": mime_type,
+            "languageCodes": ["*"],
+            "model": "page",
+            "content": encoded_image
+        }
+        deadline = time.monotonic() + self.deadline
+        error = "deadline exceeded"
+        for attempt in range(self.retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                # каждое ожидание сокета не дольше оставшегося срока, тело ответа читается до общего срока
+                response = self.session.post(self.url, json=body, stream=True,
+                                             timeout=(min(self.connect_timeout, remaining), remaining))
+                if response.status_code in RETRY_STATUSES:
+                    response.close()
+                    error = f"HTTP {response.status_code}"
+                else:
+                    content = read_before(response, deadline)
+                    try:
+                        result = json.loads(content)
+                    except ValueError:
+                        result = {}
+                    if not isinstance(result, dict):
+                        result = {}
+                    if not response.ok:
+                        result.setdefault("error", result.get("message", f"HTTP {response.status_code}"))
+                    return result
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = str(e)
+            if attempt < self.retries:
+                inc("yandex_retries")
+                time.sleep(max(min(self.backoff * 2 ** attempt, deadline - time.monotonic()), 0))
+        inc("yandex_errors")
+        return {"error": error}
+
+    def recognize(self, data) -> Dict:
+        """
+        Уменьшает изображение, распознает его и возвращает ответ в координатах исходного изображения.
+        data - байты или ImageContext запроса.
+        """
+        payload, mime_type, scale = shrink_payload(data, self.max_width)
+        inc("yandex_payload_bytes", len(payload))
+        response = self.send(base64.b64encode(payload).decode('utf-8'), mime_type)
+        if 'error' in response:
+            return response
+        return rescale_response(response, scale)
+
+    def submit(self, data) -> Future:
+        """
+        Запускает recognize в фоновом потоке клиента и сразу возвращает Future, чтобы пока идет запрос
+        выполнять локальную обработку. Этапы и счетчики запроса попадают в текущий запрос metrics.trace.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="yandex_ocr")
+        return self._executor.submit(bind_trace(self.recognize), data)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.session.close()
+
+
+class AsyncYandexOCRClient:
+    """
+    Асинхронная обертка над YandexOCRClient: запросы выполняются в потоках с общей сессией,
+    одновременно выполняется не больше max_concurrency запросов.
+    """
+
+    def __init__(self, client: YandexOCRClient, max_concurrency=8):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+
+    async def recognize(self, data: bytes) -> Dict:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await asyncio.to_thread(self.client.recognize, data)
+
+    async def recognize_many(self, images: List[bytes]) -> List[Dict]:
+        return await asyncio.gather(*(self.recognize(data) for data in images))
+
+
+def get_yandex_client(folder_id, api_key) -> YandexOCRClient:
+    """ Долгоживущий клиент для пары folder_id/api_key (один на процесс, чтобы переиспользовать соединения) """
+    # переменная окружения позволяет направить запросы в локальную замену сервиса (benchmarks.yandex_stub);
+    # она читается при каждом вызове и входит в ключ, чтобы смена адреса не возвращала клиент со старым
+    url = os.environ.get("YANDEX_OCR_URL", YANDEX_OCR_URL)
+    key = (folder_id, api_key, url)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = YandexOCRClient(api_key, folder_id, url)
+        return _clients[key]
@@ -1,6 +1,34 @@
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+from io import BytesIO
+import numpy as np
 import pytest
-from src.image_processing import process_image
+from PIL import Image, ImageDraw
+from benchmarks.bench_merge import make_tesseract_details, make_yandex_response, process_image_tesseract_loop, \
+    process_ocr_yandex_loop
+from benchmarks.corpus import encode_image, make_chat_screenshot, make_photo
+from benchmarks.yandex_stub import make_response, start_stub
+from src.cache import VerdictCache, make_cache_key
+from src.calibration import RULE_PARAMS, WEIGHT_PARAMS, collect_regions, sweep
+from src.image_context import ImageContext, InvalidImage
+from src.image_processing import STRIP_MARGIN, STRIP_WIDTH, TALL_ASPECT, process_image, strip_layout
+from src.ocr_store import OCRStore
+from src.prefilter import make_thumbnail, prefilter
+from src.pipeline import classify
+from src.scheduler import Overloaded, Scheduler
+from src.features import FEATURE_NAMES, extract_features
+from src.scorer import load_model, train_logistic
+import service
+from src import tesseract
+from src.tesseract import TSV_HEADER, process_image_tesseract
+from src.yandex import get_coords_yandex, process_ocr_yandex
+from src.yandex_client import YandexOCRClient
 
 
 def get_image_files(directory):
@@ -27,3 +55,357 @@ def test_image_processing(image_file):
         assert confidence < confidence_level, f"Confidence TOO HIGH for {image_file} with confidence {confidence}"
     else:
         assert confidence >= confidence_level, f"Processing failed for {image_file} with confidence {confidence}"
+
+
+def test_tall_screenshot_strips():
+    """
+    Тест проверяет, что длинный скриншот прокрутки (1080x8000) распознается как переписка: блоки ищутся
+    полосами в ширине обычного скриншота, и обработка останавливается, когда уверенность достигла 1.0.
+    """
+    data = make_chat_screenshot(1080, 8000, seed=3)
+    confidence, bounding_boxes, fill_im = process_image(BytesIO(data))
+    assert confidence == 1.0
+    assert fill_im.shape[1] == STRIP_WIDTH
+    assert all(y + height <= fill_im.shape[0] for (_, y, _, height), _ in bounding_boxes)
+
+
+@pytest.mark.parametrize("offset", [-3, 0, 3])
+def test_bubble_at_strip_step(offset):
+    """
+    Тест проверяет, что пузырь, который начинается на границе перекрытия полос (в строке шага полос), не
+    теряется и не учитывается дважды: в process_image обоими детекторами и в collect_regions калибровки.
+    """
+    width = STRIP_WIDTH
+    height = int(width * TALL_ASPECT * 2)
+    _, _, step = strip_layout(height, width)
+    image = Image.new("RGB", (width, height), (255, 255, 255))
+    bubble_width, bubble_height = int(width * 0.5), int(width * 0.15)
+    x, y = int(width * 0.04), step + offset
+    ImageDraw.Draw(image).rounded_rectangle([x, y, x + bubble_width, y + bubble_height], radius=bubble_height // 3,
+                                           fill=(80, 140, 250))
+    data = encode_image(image, "PNG")
+    for detector in ("skimage", "opencv"):
+        _, bounding_boxes, _ = process_image(BytesIO(data), detector=detector)
+        assert [side for _, side in bounding_boxes] == ["left"], detector
+        assert abs(bounding_boxes[0][0][1] - y) <= STRIP_MARGIN
+    regions = collect_regions(data)["boxes"]
+    assert sum(abs(box[1] - y) <= STRIP_MARGIN and box[2] > bubble_width // 2 for box in regions) == 1
+
+
+def box_iou(first, second):
+    """ Пересечение над объединением для прямоугольников (x, y, width, height) """
+    x1, y1 = max(first[0], second[0]), max(first[1], second[1])
+    x2 = min(first[0] + first[2], second[0] + second[2])
+    y2 = min(first[1] + first[3], second[1] + second[3])
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    union = first[2] * first[3] + second[2] * second[3] - intersection
+    return intersection / union if union else 0
+
+
+@pytest.mark.parametrize("image_file", get_image_files("imgs"))
+def test_opencv_detector_parity(image_file):
+    """
+    Тест проверяет, что движок на OpenCV дает тот же вердикт, что и skimage, а найденные блоки
+    совпадают с точностью до пары пикселей (IoU >= 0.9 хотя бы для 90% блоков с той же стороны).
+    """
+    confidence_level = 0.7
+    expected_confidence, expected_boxes, _ = process_image(image_file)
+    confidence, boxes, _ = process_image(image_file, detector="opencv")
+    assert (confidence >= confidence_level) == (expected_confidence >= confidence_level), \
+        f"Verdict differs for {image_file}: skimage {expected_confidence}, opencv {confidence}"
+    matched = sum(1 for box, side in expected_boxes
+                  if any(side == other_side and box_iou(box, other_box) >= 0.9 for other_box, other_side in boxes))
+    assert matched >= 0.9 * len(expected_boxes), f"Boxes differ for {image_file}: {expected_boxes} vs {boxes}"
+
+
+def test_lowmem_detector_parity():
+    """
+    Тест проверяет, что движок lowmem (промежуточные массивы в буферах воркера) совпадает с opencv побитово,
+    в том числе когда буферы переиспользуются изображениями меньшего и большего размера.
+    """
+    for data in (make_chat_screenshot(1080, 2400, seed=1), make_photo(640, 480, seed=2),
+                 make_chat_screenshot(720, 1280, seed=4), make_chat_screenshot(1080, 8000, seed=3)):
+        expected_confidence, expected_boxes, expected_fill = process_image(BytesIO(data), detector="opencv")
+        confidence, boxes, fill_im = process_image(BytesIO(data), detector="lowmem")
+        assert confidence == expected_confidence
+        assert boxes == expected_boxes
+        assert (fill_im is None and expected_fill is None) or np.array_equal(fill_im, expected_fill)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_prefilter(seed):
+    """
+    Тест проверяет предварительный фильтр по миниатюре: фотографии отсекаются до поиска блоков, а синтетические
+    скриншоты переписки (PNG и JPEG разных размеров) не отсекаются никогда, и результат process_image с фильтром
+    для них тот же, что без него.
+    """
+    photo = make_photo(1200 + 200 * seed, 900, seed=seed)
+    is_candidate, _, features = prefilter(make_thumbnail(BytesIO(photo))[0])
+    assert not is_candidate and features["reason"] == "photo"
+    assert process_image(BytesIO(photo), use_prefilter=True) == (0, [], None)
+    for width, height, image_format in ((720, 1280, "PNG"), (1080, 2400, "JPEG"), (1440, 3200, "PNG")):
+        data = make_chat_screenshot(width, height, seed=seed, image_format=image_format)
+        assert prefilter(make_thumbnail(BytesIO(data))[0])[0]
+        confidence, boxes, _ = process_image(BytesIO(data), detector="opencv", use_prefilter=True)
+        expected_confidence, expected_boxes, _ = process_image(BytesIO(data), detector="opencv")
+        assert confidence == expected_confidence > 0 and boxes == expected_boxes
+
+
+def test_yandex_client_retry_and_rescale():
+    """
+    Тест проверяет клиент YandexOCR на локальной замене сервиса: после ответа 503 запрос повторяется,
+    а координаты ответа для уменьшенного перед отправкой изображения переводятся в исходный масштаб.
+    """
+    data = make_chat_screenshot(2160, 4800, seed=4)
+    server, url = start_stub(fail_first=1)
+    try:
+        response = YandexOCRClient("test", "test", url=url, backoff=0.01).recognize(data)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert server.RequestHandlerClass.requests_count == 2
+    annotation = response["result"]["textAnnotation"]
+    assert (annotation["width"], annotation["height"]) == ("2160", "4800")
+    expected_blocks = make_response(data)["result"]["textAnnotation"]["blocks"]
+    assert len(annotation["blocks"]) == len(expected_blocks)
+    for block, expected_block in zip(annotation["blocks"], expected_blocks):
+        assert all(abs(a - b) <= 2160 * 0.01 for a, b in zip(get_coords_yandex(block),
+                                                               get_coords_yandex(expected_block)))
+
+
+@pytest.mark.parametrize("height", [2400, 8000])
+def test_tesseract_roi_regions(monkeypatch, height):
+    """
+    Тест проверяет распознавание только блоков сообщений (roi) без Tesseract (image_to_data_api заменен):
+    у обычного и высокого (полосами) скриншота распознается каждый найденный блок, области блоков - в
+    координатах исходного изображения и не меньше самих пузырей, координаты слов переводятся обратно.
+    """
+    crops = []
+
+    def fake_image_to_data(gray_image, psm=4):
+        crops.append(gray_image.shape)
+        return {key: [0] if key != "text" else ["word"] for key in TSV_HEADER.split("\t")}
+
+    monkeypatch.setattr(tesseract, "image_to_data_api", fake_image_to_data)
+    data = make_chat_screenshot(1080, height, seed=3)
+    regions = tesseract.bubble_regions(ImageContext(data))
+    details, image_width, image_height = tesseract.parse_image_tesseract_roi(BytesIO(data), engine="api")
+    assert (image_width, image_height) == (1080, height)
+    assert len(regions) >= height // 400 and len(crops) == len(regions)
+    assert all(0 <= x1 < x2 <= 1080 and 0 <= y1 < y2 <= height and y2 - y1 >= 1080 * 0.12
+               for x1, y1, x2, y2 in regions)
+    assert list(zip(details["left"], details["top"])) == [region[:2] for region in regions]
+    assert details["block_num"] == list(range(1, len(regions) + 1))
+
+
+def test_verdict_cache_disk_eviction(tmp_path):
+    """
+    Тест проверяет дисковый уровень кэша: при превышении лимита удаляются давно использованные записи (по времени
+    изменения файла, которое обновляет чтение), пока размер не станет не больше 90% лимита; новый экземпляр кэша
+    читает оставшиеся записи с диска и переносит их в память.
+    """
+    keys = [make_cache_key(bytes([i]), "no_ocr") for i in range(6)]
+    entry_size = len(json.dumps({"confidence": 0.5, "boxes": [0]}))
+    cache = VerdictCache(2, str(tmp_path), entry_size * 5 + entry_size // 2)
+    for i, key in enumerate(keys[:5]):
+        cache.put(key, {"confidence": 0.5, "boxes": [i]})
+        os.utime(cache._disk_path(key), (1000 + i, 1000 + i))
+    assert cache.stats()["disk_bytes"] == entry_size * 5
+    assert VerdictCache(2, str(tmp_path))._disk_get(keys[0]) == {"confidence": 0.5, "boxes": [0]}  # чтение освежает
+    cache.put(keys[5], {"confidence": 0.5, "boxes": [5]})
+    assert cache.stats()["disk_bytes"] == entry_size * 4 <= cache.max_disk_bytes * 0.9
+    survivors = [os.path.exists(cache._disk_path(key)) for key in keys]
+    assert survivors == [True, False, False, True, True, True]
+    reopened = VerdictCache(2, str(tmp_path), cache.max_disk_bytes)
+    assert reopened.stats() == {"hits": 0, "misses": 0, "memory_items": 0, "disk_bytes": entry_size * 4}
+    assert reopened.get(keys[1]) is None
+    assert reopened.get(keys[3]) == {"confidence": 0.5, "boxes": [3]}
+    os.remove(reopened._disk_path(keys[3]))
+    assert reopened.get(keys[3]) == {"confidence": 0.5, "boxes": [3]}  # уже из памяти
+    assert reopened.stats()["memory_items"] == 1 and (reopened.hits, reopened.misses) == (2, 1)
+
+
+def test_ocr_store_replay(tmp_path):
+    """
+    Тест проверяет, что ответ OCR, записанный в OCRStore, воспроизводится без изменений,
+    а в режиме воспроизведения отсутствие записи приводит к ошибке, а не к запросу в OCR.
+    """
+    data = make_chat_screenshot(1080, 2400, seed=1)
+    response = make_response(data)
+    path = str(tmp_path / "ocr.sqlite")
+    OCRStore(path).record(data, "yandex", {"model": "page"}, response)
+    store = OCRStore(path, mode="replay")
+    assert store.lookup(data, "yandex", {"model": "page"}) == response
+    with pytest.raises(LookupError):
+        store.lookup(data, "yandex", {"model": "handwritten"})
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_block_merge_parity(seed):
+    """
+    Тест проверяет, что векторное объединение блоков (src.block_merge) дает те же сообщения, что и прежние
+    циклы по словам Tesseract и блокам YandexOCR, в том числе на ответах со словами в случайных местах.
+    """
+    noise = (0, 0.05, 0.3, 1.0)[seed % 4]
+    details, width, height = make_tesseract_details(400, seed=seed, noise=noise)
+    response = make_yandex_response(100, seed=seed, noise=noise)
+    for block_percentile, reduce_factor in ((0.18, 1.37), (0.1, 1.5), (0.3, 1.1)):
+        for image_height in (height, height * 4):
+            assert process_image_tesseract(details, width, image_height, block_percentile, reduce_factor) == \
+                process_image_tesseract_loop(details, width, image_height, block_percentile, reduce_factor)
+        assert process_ocr_yandex(response, block_percentile, reduce_factor) == \
+            process_ocr_yandex_loop(response, block_percentile, reduce_factor)
+
+
+@pytest.mark.parametrize("detector", ["skimage", "opencv", "lowmem"])
+def test_calibration_sweep_parity(detector):
+    """
+    Тест проверяет, что уверенность, посчитанная calibrate.py по сохраненным областям для сетки параметров,
+    совпадает с process_image при тех же параметрах, в том числе для высокого скриншота (полосы).
+    """
+    images = [make_chat_screenshot(1080, 2400, seed=1), make_chat_screenshot(1080, 8000, seed=3),
+              make_photo(1200, 900, seed=5)]
+    records = [collect_regions(data, detector) for data in images]
+    rule_axes = {name: [value] for name, value in RULE_PARAMS.items()}
+    rule_axes.update(block_percentile=[0.1, 0.18, 0.3], reduce_factor=[1.3, 1.7])
+    result = sweep(records, [1, 1, 0], rule_axes, {name: [value] for name, value in WEIGHT_PARAMS.items()}, [0.7])
+    for index in range(len(result["auc"])):
+        for data, score in zip(images, result["scores"][index]):
+            confidence, _, _ = process_image(BytesIO(data), result["block_percentile"][index],
+                                             result["reduce_factor"][index], detector)
+            assert score == confidence
+    with pytest.raises(ValueError):
+        collect_regions(images[0], "unknown")
+
+
+def slow_result(seconds, confidence):
+    time.sleep(seconds)
+    return {"confidence": confidence}
+
+
+def test_scheduler_deadline_and_rejection():
+    """
+    Тест проверяет планировщик: ответ до срока возвращается как есть, после срока - запасной вариант с пометкой
+    degraded. Запасной вариант занимает место в той же очереди: пока медленные запросы занимают все места, он
+    отклоняется. Тело запроса, которое не является изображением, - InvalidImage, а не запасной вариант.
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        scheduler = Scheduler(pool, max_pending=2, fallback_reserve=0.1)
+        fallback = partial(slow_result, 0, 0.5)
+        result = scheduler.run(partial(slow_result, 0, 1.0), deadline=1.0, fallback=fallback)
+        assert result == {"confidence": 1.0, "degraded": False}
+        start_time = time.perf_counter()
+        result = scheduler.run(partial(slow_result, 0.5, 1.0), deadline=0.2, fallback=fallback)
+        assert time.perf_counter() - start_time < 0.4
+        assert result == {"confidence": 0.5, "degraded": True, "degraded_reason": "deadline"}
+        with pytest.raises(Overloaded):
+            scheduler.run(partial(slow_result, 0.5, 1.0), deadline=0.2, fallback=fallback)
+        assert scheduler.run(partial(slow_result, 0, 1.0), deadline=1.0, block=True)["degraded"] is False
+        with pytest.raises(InvalidImage):
+            scheduler.run(partial(ImageContext, b"notanimage"), deadline=1.0, fallback=fallback)
+
+
+def request_service(port, method, path, body=None):
+    connection = HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        return response.status, response.getheaders(), response.read()
+    finally:
+        connection.close()
+
+
+def test_service_classify(monkeypatch):
+    """
+    Тест проверяет HTTP-сервис в одном процессе (пул потоков вместо пула процессов): 400 для тела, которое
+    не является изображением, и неизвестных engine и detector, 413 для слишком большого тела, 503 при
+    заполненной очереди, вердикт без OCR с пометкой degraded при ошибке OCR, классификацию no_ocr и /metrics.
+    """
+    classify_bytes = service.classify_bytes
+
+    def classify_without_ocr(data, **kwargs):
+        if kwargs["engine"] != "no_ocr":
+            raise RuntimeError("OCR недоступен")
+        return classify_bytes(data, **kwargs)
+
+    data = make_chat_screenshot(1080, 2400, seed=1)
+    monkeypatch.setattr(service, "classify_bytes", classify_without_ocr)
+    monkeypatch.setattr(service.ClassifyHandler, "cache", None)
+    monkeypatch.setattr(service.ClassifyHandler, "deadline", None)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), service.ClassifyHandler)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            monkeypatch.setattr(service.ClassifyHandler, "scheduler", Scheduler(pool, max_pending=2))
+            for query, body in (("", b"notanimage"), ("?engine=unknown", data), ("?detector=unknown", data)):
+                status, _, response = request_service(port, "POST", "/classify" + query, body)
+                assert status == 400, query
+                assert "error" in json.loads(response)
+            with monkeypatch.context() as patch:
+                patch.setattr(service, "MAX_BODY_SIZE", len(data) - 1)
+                assert request_service(port, "POST", "/classify", data)[0] == 413
+            status, _, response = request_service(port, "POST", "/classify?engine=no_ocr&detector=opencv", data)
+            result = json.loads(response)
+            assert status == 200
+            assert result["is_conversation"] is True and result["degraded"] is False
+            status, _, response = request_service(port, "POST", "/classify?engine=tesseract", data)
+            degraded = json.loads(response)
+            assert status == 200
+            assert degraded["degraded"] is True and degraded["degraded_reason"] == "error"
+            assert degraded["engine"] == "no_ocr" and degraded["is_conversation"] is True
+            monkeypatch.setattr(service.ClassifyHandler, "scheduler", Scheduler(pool, max_pending=0))
+            status, headers, _ = request_service(port, "POST", "/classify", data)
+            assert status == 503 and dict(headers)["Retry-After"] == "1"
+        status, _, response = request_service(port, "GET", "/metrics")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert status == 200
+    text = response.decode("utf-8")
+    assert "request_seconds" in text and "fallbacks" in text and "rejected" in text
+
+
+def test_hybrid_escalation(monkeypatch):
+    """
+    Тест проверяет движок hybrid: уверенное решение без OCR принимается без вызова OCR, а при уверенности
+    в полосе band вызывается OCR (локальная замена YandexOCR) и уверенности объединяются.
+    """
+    data = make_chat_screenshot(1080, 2400, seed=1)
+    server, url = start_stub()
+    monkeypatch.setenv("YANDEX_OCR_URL", url)
+    try:
+        confident = classify(BytesIO(data), engine="hybrid", folder_id="test", api_key="test", detector="opencv")
+        escalated = classify(BytesIO(data), engine="hybrid", folder_id="test", api_key="test", detector="opencv",
+                             band=(0.0, 1.1))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert confident["ocr_confidence"] is None and confident["confidence"] == confident["pixel_confidence"]
+    assert server.RequestHandlerClass.requests_count == 1
+    assert escalated["ocr_engine"] == "yandex" and escalated["counters"]["escalations"] == 1
+    assert min(escalated["pixel_confidence"], escalated["ocr_confidence"]) <= escalated["confidence"] <= \
+        max(escalated["pixel_confidence"], escalated["ocr_confidence"])
+
+
+def test_scorer_train_save_load(tmp_path):
+    """
+    Тест проверяет обученную оценку: признаки переписки и фото разделяются логистической регрессией,
+    модель сохраняется и читается с версией (по умолчанию - хэш параметров) и полосой hybrid, а оценка пачки
+    совпадает с оценкой изображений по одному.
+    """
+    images = [(make_chat_screenshot(1080, 2400, seed=seed), 1) for seed in (1, 2)] + \
+             [(make_photo(1200, 900, seed=seed), 0) for seed in (5, 6)]
+    features = np.array([extract_features(BytesIO(data), detector="opencv")["features"] for data, _ in images])
+    labels = np.array([label for _, label in images])
+    assert features.shape == (len(images), len(FEATURE_NAMES))
+    model = train_logistic(features, labels)
+    assert model.version == model.digest() != train_logistic(features, labels, l2=10.0).version
+    model.version, model.band = "test", (0.4, 0.8)
+    path = str(tmp_path / "scorer.npz")
+    model.save(path)
+    loaded = load_model(path)
+    assert (loaded.version, loaded.band) == ("test", (0.4, 0.8))
+    scores = loaded.predict(features)
+    assert np.allclose(scores, [loaded.predict(vector) for vector in features])
+    assert ((scores >= 0.5) == labels).all()
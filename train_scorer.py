@@ -0,0 +1,93 @@
+import argparse
+import json
+import sys
+import time
+from io import BytesIO
+from typing import Dict, List
+import numpy as np
+from benchmarks.corpus import load_corpus
+from src.features import FEATURES_VERSION, extract_features
+from src.image_processing import BOX_DETECTORS
+from src.ocr_store import OCRStore, image_hash
+from src.scorer import MODEL_BAND, MODEL_PATH, train_logistic
+
+
+def load_features(corpus, detector, block_percentile, store=None) -> List[Dict]:
+    """ Признаки и уверенность по правилам для каждого изображения корпуса; с store они считаются один раз """
+    config = {"detector": detector, "block_percentile": block_percentile, "features_version": FEATURES_VERSION}
+    records = []
+    for name, data, _ in corpus:
+        record = store.get(image_hash(data), "features", config) if store is not None else None
+        if record is None:
+            result = extract_features(BytesIO(data), block_percentile, detector=detector)
+            record = {"features": result["features"].tolist(), "confidence": result["confidence"]}
+            if store is not None:
+                store.put(image_hash(data), "features", config, record)
+        records.append(record)
+    return records
+
+
+def cross_validate(features, labels, l2, folds, threshold) -> Dict:
+    """ Точность модели на отложенных частях корпуса (k-fold, части чередуются по индексу) """
+    folds = max(2, min(folds, len(labels)))
+    predicted = np.zeros(len(labels))
+    for fold in range(folds):
+        test = np.arange(len(labels)) % folds == fold
+        if labels[~test].min() == labels[~test].max():
+            # в обучающей части один класс: модель предсказывает его
+            predicted[test] = labels[~test][0]
+            continue
+        predicted[test] = train_logistic(features[~test], labels[~test], l2).predict(features[test])
+    return {"cv_accuracy": round(float(np.mean((predicted >= threshold) == labels)), 4), "folds": folds}
+
+
+def inference_microseconds(model, features, repeats=1000) -> Dict:
+    """ Время оценки одного изображения и изображения в пачке (мкс) """
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        model.predict(features[0])
+    single = (time.perf_counter() - start_time) / repeats * 1e6
+    batch = np.repeat(features, max(1, 10000 // len(features)), axis=0)
+    start_time = time.perf_counter()
+    model.predict(batch)
+    return {"single_us": round(single, 2), "batch_us_per_image": round((time.perf_counter() - start_time) /
+                                                                         len(batch) * 1e6, 4)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Обучение оценки переписки по признакам изображения (src.scorer): "
+                                                 "логистическая регрессия, сохраняется с версией в файл .npz")
+    parser.add_argument("--images", default="imgs", help="директория корпуса (изображения в 0 - не переписка)")
+    parser.add_argument("--no-synthetic", action="store_true", help="не добавлять синтетические изображения")
+    parser.add_argument("--store", default=None, help="файл sqlite для кэша признаков (OCRStore)")
+    parser.add_argument("--detector", default="skimage", choices=BOX_DETECTORS)
+    parser.add_argument("--block-percentile", type=float, default=0.18)
+    parser.add_argument("--l2", type=float, default=1.0, help="L2-регуляризация весов")
+    parser.add_argument("--folds", type=int, default=5, help="частей для перекрестной проверки")
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--version", default=None,
+                        help="версия модели (входит в ключ кэша), по умолчанию - хэш параметров модели")
+    parser.add_argument("--band", type=float, nargs=2, default=MODEL_BAND, metavar=("LOW", "HIGH"),
+                        help="полоса уверенности модели, в которой движок hybrid вызывает OCR")
+    parser.add_argument("-o", "--output", default=MODEL_PATH, help="файл модели")
+    args = parser.parse_args()
+    corpus = load_corpus(args.images, not args.no_synthetic)
+    labels = np.array([label for _, _, label in corpus], dtype=float)
+    if len(corpus) < 2 or labels.min() == labels.max():
+        sys.exit(f"Нужны изображения обоих классов, в корпусе {len(corpus)}")
+    store = OCRStore(args.store) if args.store else None
+    records = load_features(corpus, args.detector, args.block_percentile, store)
+    features = np.array([record["features"] for record in records])
+    rules = np.array([record["confidence"] for record in records])
+    model = train_logistic(features, labels, args.l2)
+    model.version = args.version or model.version
+    model.band = tuple(args.band)
+    summary = {"images": len(corpus), "version": model.version, "band": list(model.band),
+               "detector": args.detector, "l2": args.l2,
+               "train_accuracy": round(float(np.mean((model.predict(features) >= args.threshold) == labels)), 4),
+               "rules_accuracy": round(float(np.mean((rules >= args.threshold) == labels)), 4),
+               **cross_validate(features, labels, args.l2, args.folds, args.threshold),
+               **inference_microseconds(model, features)}
+    model.metadata = {key: summary[key] for key in ("images", "detector", "l2", "cv_accuracy")}
+    model.save(args.output)
+    print(json.dumps(summary, ensure_ascii=False))